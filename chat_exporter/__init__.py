@@ -3,7 +3,12 @@ from chat_exporter.chat_exporter import (
     AttachmentToDiscordChannelHandler,
     AttachmentToLocalFileHostHandler,
     AttachmentToWebhookHandler,
+    LRUCache,
+    RetryPolicy,
+    batch_export,
     export,
+    export_to,
+    incremental_export,
     quick_export,
     raw_export,
 )
@@ -12,10 +17,15 @@ __version__ = "3.1.0"
 
 __all__ = (
     export,
+    export_to,
+    incremental_export,
+    batch_export,
     raw_export,
     quick_export,
     AttachmentHandler,
     AttachmentToLocalFileHostHandler,
     AttachmentToWebhookHandler,
     AttachmentToDiscordChannelHandler,
+    LRUCache,
+    RetryPolicy,
 )
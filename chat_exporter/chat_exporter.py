@@ -1,6 +1,13 @@
+import asyncio
 import datetime
 import io
-from typing import List, Optional
+import itertools
+import os
+import tempfile
+from concurrent.futures import Executor
+from typing import AsyncIterator, Iterable, List, Optional, Set, Tuple, Union
+
+import aiohttp
 
 from chat_exporter.construct.attachment_handler import (
     AttachmentHandler,
@@ -8,17 +15,26 @@ from chat_exporter.construct.attachment_handler import (
     AttachmentToLocalFileHostHandler,
     AttachmentToWebhookHandler,
 )
+from chat_exporter.construct.checkpoint import load_checkpoint, save_checkpoint
 from chat_exporter.construct.transcript import Transcript
+from chat_exporter.ext.cache import Cache, LRUCache
 from chat_exporter.ext.discord_import import discord
+from chat_exporter.ext.http_session import create_session
+from chat_exporter.ext.retry import RetryPolicy
 
 __all__ = [
     "quick_export",
     "export",
+    "export_to",
+    "incremental_export",
+    "batch_export",
     "raw_export",
     "AttachmentHandler",
     "AttachmentToLocalFileHostHandler",
     "AttachmentToDiscordChannelHandler",
     "AttachmentToWebhookHandler",
+    "LRUCache",
+    "RetryPolicy",
 ]
 
 
@@ -82,6 +98,13 @@ async def export(
     support_dev: Optional[bool] = True,
     attachment_handler: Optional[AttachmentHandler] = None,
     raise_exceptions: bool = False,
+    concurrency: int = 1,
+    cache: Optional[Cache] = None,
+    prefetch_members: bool = False,
+    history_slices: int = 1,
+    session: Optional[aiohttp.ClientSession] = None,
+    attachment_concurrency: int = 1,
+    render_executor: Optional[Executor] = None,
 ):
     """
     Create a customised transcript of your Discord channel.
@@ -97,6 +120,13 @@ async def export(
     :param after: (optional) datetime.datetime - allows after time for history
     :param attachment_handler: (optional) attachment_handler.AttachmentHandler - allows custom asset handling
     :param raise_exceptions: boolean - raise exceptions if they occur
+    :param concurrency: (optional) integer - amount of messages rendered at the same time
+    :param cache: (optional) LRUCache - share member lookups between exports
+    :param prefetch_members: (optional) boolean - request all members in bulk before rendering
+    :param history_slices: (optional) integer - without a limit, read history in this many parts at the same time
+    :param session: (optional) aiohttp.ClientSession - used for the downloads and uploads of attachments
+    :param attachment_concurrency: (optional) integer - amount of attachments processed at the same time
+    :param render_executor: (optional) concurrent.futures.Executor - renders the markdown of messages, e.g. in processes
     :return: string - transcript file make up
     """
     if guild:
@@ -116,10 +146,279 @@ async def export(
             bot=bot,
             attachment_handler=attachment_handler,
             raise_exceptions=raise_exceptions,
+            concurrency=concurrency,
+            cache=cache,
+            prefetch_members=prefetch_members,
+            history_slices=history_slices,
+            session=session,
+            attachment_concurrency=attachment_concurrency,
+            render_executor=render_executor,
         ).export()
     ).html
 
 
+async def export_to(
+    channel: discord.TextChannel,
+    sink: Union[str, os.PathLike, io.TextIOBase],
+    limit: Optional[int] = None,
+    tz_info="UTC",
+    guild: Optional[discord.Guild] = None,
+    bot: Optional[discord.Client] = None,
+    military_time: Optional[bool] = True,
+    fancy_times: Optional[bool] = True,
+    before: Optional[datetime.datetime] = None,
+    after: Optional[datetime.datetime] = None,
+    support_dev: Optional[bool] = True,
+    attachment_handler: Optional[AttachmentHandler] = None,
+    raise_exceptions: bool = False,
+    concurrency: int = 1,
+    cache: Optional[Cache] = None,
+    prefetch_members: bool = False,
+    history_slices: int = 1,
+    session: Optional[aiohttp.ClientSession] = None,
+    attachment_concurrency: int = 1,
+    render_executor: Optional[Executor] = None,
+):
+    """
+    Stream a customised transcript of your Discord channel straight in to a file or writer.
+    Messages are rendered as they are read from the history, so neither the messages nor the full HTML
+    are ever held in memory. A file path is only replaced once the whole transcript is written.
+    :param channel: discord.TextChannel - channel to Export
+    :param sink: file path, or an object with a (sync or async) write(str) method
+    :param limit: (optional) integer - limit of messages to capture
+    :param tz_info: (optional) TZ Database Name - set the timezone of your transcript
+    :param guild: (optional) discord.Guild - solution for edpy
+    :param bot: (optional) discord.Client - set getting member role colour
+    :param military_time: (optional) boolean - set military time (24hour clock)
+    :param fancy_times: (optional) boolean - set javascript around time display
+    :param before: (optional) datetime.datetime - allows before time for history
+    :param after: (optional) datetime.datetime - allows after time for history
+    :param attachment_handler: (optional) attachment_handler.AttachmentHandler - allows custom asset handling
+    :param raise_exceptions: boolean - raise exceptions if they occur
+    :param concurrency: (optional) integer - amount of messages rendered at the same time
+    :param cache: (optional) LRUCache - share member lookups between exports
+    :param prefetch_members: (optional) boolean - request all members in bulk before rendering
+    :param history_slices: (optional) integer - unused, the history is read in order as it is rendered
+    :param session: (optional) aiohttp.ClientSession - used for the downloads and uploads of attachments
+    :param attachment_concurrency: (optional) integer - amount of attachments processed at the same time
+    :param render_executor: (optional) concurrent.futures.Executor - renders the markdown of messages, e.g. in processes
+    :return: boolean - whether the transcript was written successfully
+    """
+    if guild:
+        channel.guild = guild
+
+    transcript = Transcript(
+        channel=channel,
+        limit=limit,
+        messages=None,
+        pytz_timezone=tz_info,
+        military_time=military_time,
+        fancy_times=fancy_times,
+        before=before,
+        after=after,
+        support_dev=support_dev,
+        bot=bot,
+        attachment_handler=attachment_handler,
+        raise_exceptions=raise_exceptions,
+        concurrency=concurrency,
+        cache=cache,
+        prefetch_members=prefetch_members,
+        history_slices=history_slices,
+        session=session,
+        attachment_concurrency=attachment_concurrency,
+        render_executor=render_executor,
+    )
+
+    if isinstance(sink, (str, os.PathLike)):
+        # Written next to the path and renamed over it, so a failed export leaves no half written file behind
+        fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(os.path.abspath(sink)))
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                written = await transcript.export_to(f)
+            if written:
+                os.replace(temp_path, sink)
+            return written
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+    return await transcript.export_to(sink)
+
+
+async def incremental_export(
+    channel: discord.TextChannel,
+    checkpoint: Union[str, os.PathLike],
+    tz_info="UTC",
+    guild: Optional[discord.Guild] = None,
+    bot: Optional[discord.Client] = None,
+    military_time: Optional[bool] = True,
+    fancy_times: Optional[bool] = True,
+    support_dev: Optional[bool] = True,
+    attachment_handler: Optional[AttachmentHandler] = None,
+    raise_exceptions: bool = False,
+    concurrency: int = 1,
+    cache: Optional[Cache] = None,
+    prefetch_members: bool = False,
+    history_slices: int = 1,
+    session: Optional[aiohttp.ClientSession] = None,
+    attachment_concurrency: int = 1,
+    render_executor: Optional[Executor] = None,
+):
+    """
+    Create a transcript of your whole Discord channel, only rendering the messages sent since the last run.
+    The rendered messages are kept in the checkpoint file, which is created on the first run.
+    :param channel: discord.TextChannel - channel to Export
+    :param checkpoint: file path - where the progress of the export is kept between runs
+    :param tz_info: (optional) TZ Database Name - set the timezone of your transcript
+    :param guild: (optional) discord.Guild - solution for edpy
+    :param bot: (optional) discord.Client - set getting member role colour
+    :param military_time: (optional) boolean - set military time (24hour clock)
+    :param fancy_times: (optional) boolean - set javascript around time display
+    :param attachment_handler: (optional) attachment_handler.AttachmentHandler - allows custom asset handling
+    :param raise_exceptions: boolean - raise exceptions if they occur
+    :param concurrency: (optional) integer - amount of messages rendered at the same time
+    :param cache: (optional) LRUCache - share member lookups between exports
+    :param prefetch_members: (optional) boolean - request all members in bulk before rendering
+    :param history_slices: (optional) integer - read history in this many parts at the same time
+    :param session: (optional) aiohttp.ClientSession - used for the downloads and uploads of attachments
+    :param attachment_concurrency: (optional) integer - amount of attachments processed at the same time
+    :param render_executor: (optional) concurrent.futures.Executor - renders the markdown of messages, e.g. in processes
+    :return: string - transcript file make up
+    """
+    if guild:
+        channel.guild = guild
+
+    transcript = await Transcript(
+        channel=channel,
+        limit=None,
+        messages=None,
+        pytz_timezone=tz_info,
+        military_time=military_time,
+        fancy_times=fancy_times,
+        before=None,
+        after=None,
+        support_dev=support_dev,
+        bot=bot,
+        attachment_handler=attachment_handler,
+        raise_exceptions=raise_exceptions,
+        concurrency=concurrency,
+        cache=cache,
+        prefetch_members=prefetch_members,
+        history_slices=history_slices,
+        session=session,
+        attachment_concurrency=attachment_concurrency,
+        render_executor=render_executor,
+    ).export_incremental(load_checkpoint(checkpoint))
+
+    if transcript.checkpoint is not None:
+        save_checkpoint(checkpoint, transcript.checkpoint)
+    return transcript.html
+
+
+async def batch_export(
+    channels: Union[Iterable[discord.TextChannel], discord.Guild],
+    limit: Optional[int] = None,
+    tz_info="UTC",
+    bot: Optional[discord.Client] = None,
+    military_time: Optional[bool] = True,
+    fancy_times: Optional[bool] = True,
+    before: Optional[datetime.datetime] = None,
+    after: Optional[datetime.datetime] = None,
+    support_dev: Optional[bool] = True,
+    attachment_handler: Optional[AttachmentHandler] = None,
+    raise_exceptions: bool = False,
+    concurrency: int = 1,
+    cache: Optional[Cache] = None,
+    prefetch_members: bool = False,
+    history_slices: int = 1,
+    session: Optional[aiohttp.ClientSession] = None,
+    attachment_concurrency: int = 1,
+    render_executor: Optional[Executor] = None,
+    channel_concurrency: int = 4,
+) -> AsyncIterator[Tuple[discord.TextChannel, Optional[str]]]:
+    """
+    Create a transcript of each of many Discord channels, e.g. to back up a whole guild.
+    Up to `channel_concurrency` channels are exported at the same time, sharing one cache and HTTP session,
+    and each transcript is yielded as soon as it is done.
+    :param channels: list of discord.TextChannel, or a discord.Guild to export all of its text channels
+    :param limit: (optional) integer - limit of messages to capture per channel
+    :param tz_info: (optional) TZ Database Name - set the timezone of your transcripts
+    :param bot: (optional) discord.Client - set getting member role colour
+    :param military_time: (optional) boolean - set military time (24hour clock)
+    :param fancy_times: (optional) boolean - set javascript around time display
+    :param before: (optional) datetime.datetime - allows before time for history
+    :param after: (optional) datetime.datetime - allows after time for history
+    :param attachment_handler: (optional) attachment_handler.AttachmentHandler - allows custom asset handling
+    :param raise_exceptions: boolean - raise exceptions if they occur
+    :param concurrency: (optional) integer - amount of messages of a channel rendered at the same time
+    :param cache: (optional) LRUCache - share member lookups with other exports, a new one is shared by the batch
+    :param prefetch_members: (optional) boolean - request all members in bulk before rendering
+    :param history_slices: (optional) integer - without a limit, read history in this many parts at the same time
+    :param session: (optional) aiohttp.ClientSession - used for the downloads and uploads of attachments
+    :param attachment_concurrency: (optional) integer - amount of attachments processed at the same time
+    :param render_executor: (optional) concurrent.futures.Executor - renders the markdown of messages, e.g. in processes
+    :param channel_concurrency: (optional) integer - amount of channels exported at the same time
+    :return: async iterator of (discord.TextChannel, string - transcript file make up) in the order they finish,
+        the transcript is None for a channel whose history could not be read
+    """
+    if isinstance(channels, discord.Guild):
+        channels = channels.text_channels
+    channels = iter(channels)
+    # Members are keyed by guild, so channels of the same guild share their lookups
+    cache = cache if cache is not None else LRUCache()
+    owned_session = session is None
+    session = session or create_session()
+
+    async def export_channel(channel: discord.TextChannel) -> Tuple[discord.TextChannel, Optional[str]]:
+        transcript = Transcript(
+            channel=channel,
+            limit=limit,
+            messages=None,
+            pytz_timezone=tz_info,
+            military_time=military_time,
+            fancy_times=fancy_times,
+            before=before,
+            after=after,
+            support_dev=support_dev,
+            bot=bot,
+            attachment_handler=attachment_handler,
+            raise_exceptions=raise_exceptions,
+            concurrency=concurrency,
+            cache=cache,
+            prefetch_members=prefetch_members,
+            history_slices=history_slices,
+            session=session,
+            attachment_concurrency=attachment_concurrency,
+            render_executor=render_executor,
+        )
+        try:
+            return channel, (await transcript.export()).html
+        except discord.HTTPException as e:
+            # Usually a channel the bot can not read, which should not stop the rest of the batch
+            if raise_exceptions:
+                raise
+            print(f"Skipped #{channel.name} | Error - {e}")
+            return channel, None
+
+    pending: Set[asyncio.Future] = set()
+    try:
+        while True:
+            for channel in itertools.islice(channels, max(1, channel_concurrency) - len(pending)):
+                pending.add(asyncio.ensure_future(export_channel(channel)))
+            if not pending:
+                break
+
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+        # Waited for, so no cancelled export is still using the session when it is closed
+        await asyncio.gather(*pending, return_exceptions=True)
+        if owned_session:
+            await session.close()
+
+
 async def raw_export(
     channel: discord.TextChannel,
     messages: List[discord.Message],
@@ -131,6 +430,12 @@ async def raw_export(
     support_dev: Optional[bool] = True,
     attachment_handler: Optional[AttachmentHandler] = None,
     raise_exceptions: bool = False,
+    concurrency: int = 1,
+    cache: Optional[Cache] = None,
+    prefetch_members: bool = False,
+    session: Optional[aiohttp.ClientSession] = None,
+    attachment_concurrency: int = 1,
+    render_executor: Optional[Executor] = None,
 ):
     """
     Create a customised transcript with your own captured Discord messages
@@ -144,6 +449,12 @@ async def raw_export(
     :param fancy_times: (optional) boolean - set javascript around time display
     :param attachment_handler: (optional) AttachmentHandler - allows custom asset handling
     :param raise_exceptions: boolean - raise exceptions if they occur
+    :param concurrency: (optional) integer - amount of messages rendered at the same time
+    :param cache: (optional) LRUCache - share member lookups between exports
+    :param prefetch_members: (optional) boolean - request all members in bulk before rendering
+    :param session: (optional) aiohttp.ClientSession - used for the downloads and uploads of attachments
+    :param attachment_concurrency: (optional) integer - amount of attachments processed at the same time
+    :param render_executor: (optional) concurrent.futures.Executor - renders the markdown of messages, e.g. in processes
     :return: string - transcript file make up
     """
     if guild:
@@ -163,5 +474,11 @@ async def raw_export(
             bot=bot,
             attachment_handler=attachment_handler,
             raise_exceptions=raise_exceptions,
+            concurrency=concurrency,
+            cache=cache,
+            prefetch_members=prefetch_members,
+            session=session,
+            attachment_concurrency=attachment_concurrency,
+            render_executor=render_executor,
         ).export()
     ).html
@@ -23,6 +23,7 @@ from chat_exporter.ext.html_generator import (
     component_thumbnail,
     fill_out,
 )
+from chat_exporter.ext.render_context import current_context
 
 modules_which_use_none = ["nextcord", "disnake"]
 
@@ -33,6 +34,25 @@ def _gather_checker():
     return None
 
 
+def count_menus(component) -> int:
+    """The dropdown menus `Component(component, ...).flow()` renders, nested ones included."""
+    if isinstance(component, discord.SelectMenu):
+        return 1
+    component_type = getattr(component, "type", None)
+    if getattr(component_type, "value", component_type) == 3:
+        return 1
+    nested = list(
+        getattr(component, "children", None)
+        or getattr(component, "components", None)
+        or getattr(component, "items", None)
+        or []
+    )
+    accessory = getattr(component, "accessory", None)
+    if accessory is not None:
+        nested.append(accessory)
+    return sum(count_menus(c) for c in nested)
+
+
 class Component:
     styles = {
         "primary": "#5865F2",
@@ -63,12 +83,13 @@ class Component:
     components: str = ""
     menus: str = ""
     buttons: str = ""
-    menu_div_id: int = 0
     check_against = None
 
-    def __init__(self, component, guild, attachments=None):
+    def __init__(self, component, guild, attachments=None, menu_ids=None):
         self.component = component
         self.guild = guild
+        # Ids claimed for the menus of the message in transcript order, see `count_menus`
+        self.menu_ids = menu_ids if menu_ids is not None else iter(())
         self.attachments = []
         if attachments:
             attachment_iterable = attachments if isinstance(attachments, (list, tuple, set)) else [attachments]
@@ -113,9 +134,7 @@ class Component:
         if isinstance(c, discord.Button):
             return await self.build_button(c)
         if isinstance(c, discord.SelectMenu):
-            menu_html = await self.build_menu(c)
-            Component.menu_div_id += 1
-            return menu_html
+            return await self.build_menu(c)
 
         # Handle components v2 based on type
         if component_type is None:
@@ -126,10 +145,7 @@ class Component:
         method_name = self._type_map.get(type_value)
         if method_name:
             method = getattr(self, method_name)
-            result = await method(c)
-            if type_value == 3:  # StringSelect
-                Component.menu_div_id += 1
-            return result
+            return await method(c)
             
         return ""
 
@@ -200,6 +216,10 @@ class Component:
         )
 
     async def build_menu(self, c):
+        menu_id = next(self.menu_ids, None)
+        if menu_id is None:
+            menu_id = current_context().next_menu_id()
+
         placeholder = self._get_attr(c, "placeholder", "") or ""
         options = self._get_attr(c, "options", []) or []
         disabled = bool(self._get_attr(c, "disabled", False))
@@ -219,7 +239,7 @@ class Component:
             placeholder = "Select an option"
 
         if not disabled:
-            content = await self.build_menu_options(options)
+            content = await self.build_menu_options(options, menu_id)
 
         selected_label = html.escape(selected_label) if selected_label else ""
         placeholder = html.escape(placeholder) if placeholder else ""
@@ -229,7 +249,7 @@ class Component:
             component_menu,
             [
                 ("DISABLED", "chatlog__component-disabled" if disabled else "", PARSE_MODE_NONE),
-                ("ID", str(self.menu_div_id), PARSE_MODE_NONE),
+                ("ID", str(menu_id), PARSE_MODE_NONE),
                 ("PLACEHOLDER", str(selected_label), PARSE_MODE_MARKDOWN),
                 ("PLACEHOLDER_TITLE", str(placeholder), PARSE_MODE_MARKDOWN),
                 ("CONTENT", str(content), PARSE_MODE_NONE),
@@ -238,7 +258,7 @@ class Component:
         )
         return menu_html
 
-    async def build_menu_options(self, options):
+    async def build_menu_options(self, options, menu_id):
         content = []
         for option in options:
             label = self._get_attr(option, "label", "")
@@ -280,7 +300,7 @@ class Component:
                 )
 
         if content:
-            content = f'<div id="dropdownMenu{self.menu_div_id}" class="dropdownContent">{"".join(content)}</div>'
+            content = f'<div id="dropdownMenu{menu_id}" class="dropdownContent">{"".join(content)}</div>'
 
         return content
 
@@ -1,4 +1,5 @@
 import html
+from typing import List
 
 from pytz import timezone
 
@@ -21,6 +22,7 @@ from chat_exporter.ext.html_generator import (
     embed_title,
     fill_out,
 )
+from chat_exporter.ext.render_context import current_context
 
 modules_which_use_none = ["nextcord", "disnake"]
 
@@ -31,6 +33,19 @@ def _gather_checker():
     return None
 
 
+def embed_markup(embed) -> List[str]:
+    """The texts of the embed which `Embed` renders as markdown, escaped as it passes them on."""
+    check_against = _gather_checker()
+    texts = []
+    if embed.title != check_against:
+        texts.append(html.escape(embed.title))
+    if embed.description != check_against:
+        texts.append(html.escape(embed.description))
+    for field in embed.fields or ():
+        texts += [html.escape(field.name), html.escape(field.value)]
+    return texts
+
+
 class Embed:
     r: str
     g: str
@@ -81,7 +96,7 @@ class Embed:
         if not getattr(time_value, "tzinfo", None):
             time_value = timezone("UTC").localize(time_value)
 
-        tz_name = self.pytz_timezone or getattr(self.guild, "timezone", "UTC") or "UTC"
+        tz_name = self.pytz_timezone or current_context().timezone or "UTC"
         try:
             tz = timezone(tz_name)
         except Exception:
@@ -145,14 +160,14 @@ class Embed:
         for row in rows:
             if len(row) == 1 and not getattr(row[0], "inline", False):
                 field = row[0]
-                field.name = html.escape(field.name)
-                field.value = html.escape(field.value)
+                # Escaped copies, the embed may be rendered again
+                name, value = html.escape(field.name), html.escape(field.value)
                 self.fields += await fill_out(
                     self.guild,
                     embed_field,
                     [
-                        ("FIELD_NAME", field.name, PARSE_MODE_SPECIAL_EMBED),
-                        ("FIELD_VALUE", field.value, PARSE_MODE_EMBED),
+                        ("FIELD_NAME", name, PARSE_MODE_SPECIAL_EMBED),
+                        ("FIELD_VALUE", value, PARSE_MODE_EMBED),
                         ("GRID_COLUMN", "1 / 13", PARSE_MODE_NONE),
                     ],
                 )
@@ -165,14 +180,13 @@ class Embed:
                     cols = ["1 / 13"]
 
                 for idx, field in enumerate(row):
-                    field.name = html.escape(field.name)
-                    field.value = html.escape(field.value)
+                    name, value = html.escape(field.name), html.escape(field.value)
                     self.fields += await fill_out(
                         self.guild,
                         embed_field_inline,
                         [
-                            ("FIELD_NAME", field.name, PARSE_MODE_SPECIAL_EMBED),
-                            ("FIELD_VALUE", field.value, PARSE_MODE_EMBED),
+                            ("FIELD_NAME", name, PARSE_MODE_SPECIAL_EMBED),
+                            ("FIELD_VALUE", value, PARSE_MODE_EMBED),
                             ("GRID_COLUMN", cols[idx], PARSE_MODE_NONE),
                         ],
                     )
@@ -1,6 +1,6 @@
 import re
 
-from chat_exporter.ext.emoji_convert import convert_emoji
+from chat_exporter.ext.emoji_convert import emojify
 from chat_exporter.ext.html_generator import (
     PARSE_MODE_NONE,
     custom_emoji,
@@ -43,7 +43,7 @@ class Reaction:
         )
 
     async def create_standard_emoji(self):
-        react_emoji = await convert_emoji(self.reaction.emoji)
+        react_emoji = emojify(self.reaction.emoji)
         self.reaction = await fill_out(
             self.guild,
             emoji,
@@ -1,14 +1,27 @@
 import asyncio
 import datetime
+import hashlib
 import io
+import json
 import os
 import pathlib
+import tempfile
 import urllib.parse
-from typing import Union
-
-import aiohttp
+from contextlib import ExitStack
+from typing import IO, AsyncIterator, Dict, List, Optional, Union
 
 from chat_exporter.ext.discord_import import discord
+from chat_exporter.ext.http_session import http_session
+from chat_exporter.ext.retry import RetryPolicy
+
+# Attachments are downloaded in chunks of this size, so only one chunk of a file is held at a time
+CHUNK_SIZE = 64 * 1024
+# Attachments up to this size are kept in memory between download and upload, larger ones on disk
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+# The most bytes of attachments kept in memory at the same time, across all uploads running
+SPOOL_MEMORY_LIMIT = 32 * 1024 * 1024
+# Discord takes up to 10 files per message
+MAX_FILES_PER_MESSAGE = 10
 
 
 class AttachmentHandler:
@@ -16,6 +29,11 @@ class AttachmentHandler:
 
     Subclass this to implement your own asset handler."""
 
+    # How many assets the handler may process at the same time, None to only be bound by the export
+    max_concurrency: Optional[int] = None
+    # How many queued assets the export hands to process_assets at once
+    batch_size: int = 1
+
     async def process_asset(self, attachment: discord.Attachment) -> discord.Attachment:
         """Implement this to process the asset and return a url to the stored attachment.
         :param attachment: discord.Attachment
@@ -23,61 +41,300 @@ class AttachmentHandler:
         """
         raise NotImplementedError
 
+    async def process_assets(self, attachments: List[discord.Attachment]) -> List[discord.Attachment]:
+        """Implement this together with `batch_size` to process several assets at once.
+        :param attachments: List[discord.Attachment]
+        :return: List[discord.Attachment] - in the same order as the attachments
+        """
+        return [await self.process_asset(attachment) for attachment in attachments]
+
+
+def pack_uploads(sizes: List[int], size_limit: int, max_files: int = MAX_FILES_PER_MESSAGE) -> List[List[int]]:
+    """Group the indexes of the files in to as few uploads as possible, each within the file and size limit.
+    Files are placed largest first, each in the first upload with room left. A file over the size limit
+    is uploaded on its own."""
+    uploads: List[List[int]] = []
+    room: List[int] = []
+    for i in sorted(range(len(sizes)), key=lambda i: -sizes[i]):
+        for n, upload in enumerate(uploads):
+            if len(upload) < max_files and sizes[i] <= room[n]:
+                upload.append(i)
+                room[n] -= sizes[i]
+                break
+        else:
+            uploads.append([i])
+            room.append(size_limit - sizes[i])
+    # Kept in the order of the transcript within each upload
+    return [sorted(upload) for upload in uploads]
+
+
+def uploaded_attachments(message: discord.Message, sent: int) -> List[discord.Attachment]:
+    """The attachments of an upload, which Discord returns in the order the files were sent."""
+    # Never resent, that would post the files which did arrive a second time
+    if len(message.attachments) != sent:
+        raise ValueError(f"Uploaded {sent} attachments, but Discord returned {len(message.attachments)}")
+    return message.attachments
+
+
+async def iter_attachment(attachment: discord.Attachment) -> AsyncIterator[bytes]:
+    """Download the attachment chunk by chunk."""
+    async with http_session() as session:
+        async with session.get(attachment.url) as res:
+            if res.status != 200:
+                res.raise_for_status()
+            async for chunk in res.content.iter_chunked(CHUNK_SIZE):
+                yield chunk
+
+
+class SpoolBudget:
+    """Counts the bytes of the attachments spooled in memory, so uploads running together stay within a limit."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+
+    def reserve(self, size: int) -> bool:
+        if self.used + size > self.limit:
+            return False
+        self.used += size
+        return True
+
+    def release(self, size: int):
+        self.used -= size
+
+
+spool_budget = SpoolBudget(SPOOL_MEMORY_LIMIT)
+
+
+class _MemorySpool(io.BytesIO):
+    # Hands its bytes back to the budget when closed, or when collected without being closed
+    def __init__(self, size: int):
+        super().__init__()
+        self.size = size
+
+    def close(self):
+        if not self.closed:
+            spool_budget.release(self.size)
+        super().close()
+
+
+async def spool_attachment(attachment: discord.Attachment) -> IO[bytes]:
+    """Download the attachment in to a file object positioned at its start, which the caller has to close.
+    Small attachments are kept in memory while the budget allows, everything else goes to a temporary file."""
+    if attachment.size <= SPOOL_MAX_SIZE and spool_budget.reserve(attachment.size):
+        spool = _MemorySpool(attachment.size)
+    else:
+        spool = tempfile.TemporaryFile()
+    try:
+        async for chunk in iter_attachment(attachment):
+            spool.write(chunk)
+    except BaseException:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool
+
+
+async def spool_files(stack: ExitStack, attachments: List[discord.Attachment]) -> List[discord.File]:
+    """Download the attachments at the same time, each in to a file which is closed with the stack."""
+    spools = await asyncio.gather(*(spool_attachment(a) for a in attachments), return_exceptions=True)
+    for spool in spools:
+        if not isinstance(spool, BaseException):
+            stack.enter_context(spool)
+    for spool in spools:
+        if isinstance(spool, BaseException):
+            raise spool
+
+    files = []
+    for attachment, spool in zip(attachments, spools):
+        file = discord.File(spool, attachment.filename, spoiler=attachment.is_spoiler())
+        # discord.File keeps the spool open until it is closed itself
+        stack.callback(file.close)
+        files.append(file)
+    return files
+
 
 class AttachmentToLocalFileHostHandler(AttachmentHandler):
-    """Save the assets to a local file host and embed the assets in the transcript from there."""
+    """Save the assets to a local file host and embed the assets in the transcript from there.
+
+    By default every export saves its own copy of each attachment. With `address` set, each attachment
+    is stored once and later exports link to the stored file instead of downloading it again:
+    "id" stores it under its attachment id, "sha256" under the hash of its content, so the same file
+    posted twice is stored once as well. Stored files are recorded in an index file in `base_path`.
+    Failed downloads are retried by the `retry_policy`."""
 
-    def __init__(self, base_path: Union[str, pathlib.Path], url_base: str):
+    INDEX_FILE = "index.jsonl"
+    ADDRESSES = ("id", "sha256")
+
+    def __init__(
+        self,
+        base_path: Union[str, pathlib.Path],
+        url_base: str,
+        address: Optional[str] = None,
+        retry_policy: Optional[RetryPolicy] = None,
+    ):
         if isinstance(base_path, str):
             base_path = pathlib.Path(base_path)
+        if address is not None and address not in self.ADDRESSES:
+            raise ValueError(f"address must be one of {', '.join(self.ADDRESSES)}")
         self.base_path = base_path
         self.url_base = url_base
+        self.address = address
+        self.retry_policy = retry_policy or RetryPolicy()
+        self._index: Optional[Dict[str, str]] = None
 
     async def process_asset(self, attachment: discord.Attachment) -> discord.Attachment:
         """Implement this to process the asset and return a url to the stored attachment.
         :param attachment: discord.Attachment
         :return: str
         """
-        file_name = urllib.parse.quote_plus(f"{datetime.datetime.utcnow().timestamp()}_{attachment.filename}")
-        asset_path = self.base_path / file_name
-        await attachment.save(asset_path)
+        if self.address is None:
+            file_name = urllib.parse.quote_plus(f"{datetime.datetime.utcnow().timestamp()}_{attachment.filename}")
+            await self.retry_policy.run(self._download, attachment, file_name)
+        else:
+            file_name = await self._store(attachment)
         file_url = f"{self.url_base}/{file_name}"
         attachment.url = file_url
         attachment.proxy_url = file_url
         return attachment
 
+    @property
+    def index(self) -> Dict[str, str]:
+        """Attachment ids mapped to the path of their stored file, relative to `base_path`."""
+        if self._index is None:
+            self._index = {}
+            index_path = self.base_path / self.INDEX_FILE
+            if index_path.exists():
+                with open(index_path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        if line.strip():
+                            entry = json.loads(line)
+                            self._index[entry["id"]] = entry["path"]
+        return self._index
+
+    async def _store(self, attachment: discord.Attachment) -> str:
+        attachment_id = str(attachment.id)
+        stored = self.index.get(attachment_id)
+        if stored is not None and (self.base_path / stored).exists():
+            return stored
+
+        if self.address == "id":
+            # Snowflakes end in a per-process counter, which spreads them evenly over the shards
+            file_name = urllib.parse.quote_plus(attachment.filename)
+            stored = f"{attachment.id % 256:02x}/{attachment_id}/{file_name}"
+            if not (self.base_path / stored).exists():
+                await self.retry_policy.run(self._download, attachment, stored)
+        else:
+            stored = await self.retry_policy.run(self._download_by_hash, attachment)
+
+        self._add_to_index(attachment_id, stored)
+        return stored
+
+    async def _download_by_hash(self, attachment: discord.Attachment) -> str:
+        # The name depends on the content, so it is only known once the download is done
+        digest = hashlib.sha256()
+        self.base_path.mkdir(parents=True, exist_ok=True)
+        # A unique name, so two stores of the same attachment never write to one file
+        fd, temp_name = tempfile.mkstemp(suffix=".tmp", dir=self.base_path)
+        temp_path = pathlib.Path(temp_name)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                async for chunk in iter_attachment(attachment):
+                    digest.update(chunk)
+                    f.write(chunk)
+            suffix = urllib.parse.quote_plus(pathlib.PurePath(attachment.filename).suffix.lower())
+            stored = f"{digest.hexdigest()[:2]}/{digest.hexdigest()[2:4]}/{digest.hexdigest()}{suffix}"
+            asset_path = self.base_path / stored
+            if not asset_path.exists():
+                asset_path.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(temp_path, asset_path)
+        finally:
+            if temp_path.exists():
+                temp_path.unlink()
+        return stored
+
+    async def _download(self, attachment: discord.Attachment, stored: str):
+        asset_path = self.base_path / stored
+        asset_path.parent.mkdir(parents=True, exist_ok=True)
+        # Written next to the target and swapped in, so an interrupted export never leaves half a file behind
+        fd, temp_name = tempfile.mkstemp(prefix=f"{asset_path.name}.", suffix=".tmp", dir=asset_path.parent)
+        temp_path = pathlib.Path(temp_name)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                async for chunk in iter_attachment(attachment):
+                    f.write(chunk)
+            os.replace(temp_path, asset_path)
+        finally:
+            if temp_path.exists():
+                temp_path.unlink()
+
+    def _add_to_index(self, attachment_id: str, stored: str):
+        self.index[attachment_id] = stored
+        self.base_path.mkdir(parents=True, exist_ok=True)
+        # Appended rather than rewritten, so recording a file costs the same however large the index gets
+        with open(self.base_path / self.INDEX_FILE, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"id": attachment_id, "path": stored}) + "\n")
+
 
 class AttachmentToDiscordChannelHandler(AttachmentHandler):
-    """Save the attachment to a discord channel and embed the assets in the transcript from there."""
+    """Save the attachment to a discord channel and embed the assets in the transcript from there.
+
+    Attachments are uploaded up to 10 at a time, in as few messages as the upload limit of the guild allows.
+    Failed uploads are retried by the `retry_policy`, which also spaces the messages sent to the channel."""
 
-    def __init__(self, channel: discord.TextChannel):
+    # Discord lets a channel take 5 messages at a time before rate limiting
+    max_concurrency = 5
+    batch_size = MAX_FILES_PER_MESSAGE
+
+    def __init__(self, channel: discord.TextChannel, retry_policy: Optional[RetryPolicy] = None):
         self.channel = channel
+        # Discord lets a channel take about 5 messages every 5 seconds
+        self.retry_policy = retry_policy or RetryPolicy(rate=5, per=5)
 
     async def process_asset(self, attachment: discord.Attachment) -> discord.Attachment:
         """Implement this to process the asset and return a url to the stored attachment.
         :param attachment: discord.Attachment
         :return: str
         """
+        return (await self.process_assets([attachment]))[0]
+
+    async def process_assets(self, attachments: List[discord.Attachment]) -> List[discord.Attachment]:
+        """Upload the attachments in as few messages as possible.
+        :param attachments: List[discord.Attachment]
+        :return: List[discord.Attachment] - in the same order as the attachments
+        """
+        results: List[Optional[discord.Attachment]] = [None] * len(attachments)
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(attachment.url) as res:
-                    if res.status != 200:
-                        res.raise_for_status()
-                    data = io.BytesIO(await res.read())
-                    data.seek(0)
-                    attach = discord.File(data, attachment.filename)
-                    msg: discord.Message = await self.channel.send(file=attach)
-                    return msg.attachments[0]
+            for upload in pack_uploads([a.size for a in attachments], self.channel.guild.filesize_limit):
+                msg: discord.Message = await self.retry_policy.run(
+                    self._upload, [attachments[i] for i in upload], bucket=self.channel.id
+                )
+                for i, uploaded in zip(upload, uploaded_attachments(msg, len(upload))):
+                    results[i] = uploaded
         except discord.errors.HTTPException as e:
             # discords http errors, including missing permissions
             raise e
+        return results
+
+    async def _upload(self, attachments: List[discord.Attachment]) -> discord.Message:
+        with ExitStack() as stack:
+            return await self.channel.send(files=await spool_files(stack, attachments))
 
 
 class AttachmentToWebhookHandler(AttachmentHandler):
-    """Save the attachment to a discord channel using webhook and embed the assets in the transcript from there."""
+    """Save the attachment to a discord channel using webhook and embed the assets in the transcript from there.
+
+    Attachments are uploaded up to 10 at a time, in as few messages as the upload limit allows.
+    Failed uploads are retried by the `retry_policy`, which also spaces the messages sent to the webhook."""
+
+    # Discord lets a webhook take 5 messages at a time before rate limiting
+    max_concurrency = 5
+    batch_size = MAX_FILES_PER_MESSAGE
 
-    def __init__(self, webhook_link: str) -> None:
+    def __init__(self, webhook_link: str, retry_policy: Optional[RetryPolicy] = None) -> None:
         self.webhook_link = webhook_link
+        # Discord lets a webhook take about 5 messages every 2 seconds
+        self.retry_policy = retry_policy or RetryPolicy(rate=5, per=2)
         self.size_limit = 8 * 1024 * 1024  # 8 MB = 8 * 1024 KB * 1024 B
         self.placeholder_path = os.path.join(os.path.dirname(__file__), "too_large.png")
 
@@ -85,24 +342,127 @@ class AttachmentToWebhookHandler(AttachmentHandler):
         """Implement this to process the asset and return a url to the stored attachment.
         :param attachment: discord.Attachment
         :return: str"""
-        try:
-            if attachment.size > self.size_limit:
-                file = discord.File(self.placeholder_path, filename="too_large.png")
-            else:
-                file = await attachment.to_file()
+        return (await self.process_assets([attachment]))[0]
 
-            async with aiohttp.ClientSession() as session:
+    async def process_assets(self, attachments: List[discord.Attachment]) -> List[discord.Attachment]:
+        """Upload the attachments in as few messages as possible, replacing those over the size limit.
+        :param attachments: List[discord.Attachment]
+        :return: List[discord.Attachment] - in the same order as the attachments"""
+        placeholder_size = os.path.getsize(self.placeholder_path)
+        sizes = [placeholder_size if a.size > self.size_limit else a.size for a in attachments]
+        results: List[Optional[discord.Attachment]] = [None] * len(attachments)
+        try:
+            async with http_session() as session:
                 webhook = discord.Webhook.from_url(self.webhook_link, session=session)
-                for i in range(3):
-                    try:
-                        message = await webhook.send(file=file, wait=True)
-                        break
-                    except aiohttp.ClientConnectionError:
-                        print(f"Retry {i + 1}/3 | Error - Webhook connection failed.")
-                        await asyncio.sleep(3)  # to prevent frequent retries on connection error
-
+                for upload in pack_uploads(sizes, self.size_limit):
+                    message = await self.retry_policy.run(
+                        self._upload, webhook, [attachments[i] for i in upload], bucket=self.webhook_link
+                    )
+                    for i, uploaded in zip(upload, uploaded_attachments(message, len(upload))):
+                        results[i] = uploaded
         except discord.errors.HTTPException as e:
             # discords http errors, including missing permissions
             raise e
-        else:
-            return message.attachments[0]
+        return results
+
+    async def _upload(self, webhook: discord.Webhook, attachments: List[discord.Attachment]) -> discord.Message:
+        with ExitStack() as stack:
+            within_limit = [a for a in attachments if a.size <= self.size_limit]
+            spooled = iter(await spool_files(stack, within_limit))
+            files = []
+            for attachment in attachments:
+                if attachment.size > self.size_limit:
+                    file = discord.File(self.placeholder_path, filename="too_large.png")
+                    stack.callback(file.close)
+                    files.append(file)
+                else:
+                    files.append(next(spooled))
+            return await webhook.send(files=files, wait=True)
+
+
+class AttachmentQueue(AttachmentHandler):
+    """Process the attachments of a whole export with one handler, up to `concurrency` at the same time.
+
+    Attachments are queued a few messages ahead of the one being rendered, so their downloads and uploads
+    run ahead of rendering. Every attachment gets its own result, so callers get them back in their own
+    order whatever order they finish in. A result leaves the window once it is handed out, and is kept
+    aside so an attachment shown again, e.g. in a forward, is not processed a second time."""
+
+    def __init__(self, handler: AttachmentHandler, concurrency: int = 1):
+        self.handler = handler
+        self.concurrency = max(1, concurrency)
+        if handler.max_concurrency:
+            self.concurrency = min(self.concurrency, handler.max_concurrency)
+        self._queue: "asyncio.Queue" = asyncio.Queue()
+        # Keyed by attachment id, only attachments which are queued and not yet handed out are held
+        self._results: Dict[int, asyncio.Future] = {}
+        # Results already handed out, by attachment id
+        self._completed: Dict[int, discord.Attachment] = {}
+        self._workers: List[asyncio.Future] = []
+
+    def __len__(self):
+        return len(self._results)
+
+    @property
+    def window(self) -> int:
+        """How many attachments to hold queued, enough to hand every worker a full batch."""
+        return self.concurrency * max(1, self.handler.batch_size)
+
+    def submit(self, attachment: discord.Attachment) -> asyncio.Future:
+        """Queue the attachment unless it is queued already, and return the future of its result."""
+        future = self._results.get(attachment.id)
+        if future is None and attachment.id in self._completed:
+            future = asyncio.get_event_loop().create_future()
+            future.set_result(self._completed[attachment.id])
+        elif future is None:
+            future = asyncio.get_event_loop().create_future()
+            self._results[attachment.id] = future
+            self._queue.put_nowait((attachment, future))
+            if len(self._workers) < self.concurrency:
+                self._workers.append(asyncio.ensure_future(self._work()))
+        return future
+
+    async def process_asset(self, attachment: discord.Attachment) -> discord.Attachment:
+        future = self.submit(attachment)
+        try:
+            # Shielded so a cancelled message does not leave the worker with a cancelled future
+            return await asyncio.shield(future)
+        finally:
+            if future.done() and self._results.get(attachment.id) is future:
+                del self._results[attachment.id]
+                if not future.cancelled() and future.exception() is None:
+                    # Failures are not kept, the next message showing the attachment tries again
+                    self._completed[attachment.id] = future.result()
+
+    async def _work(self):
+        batch_size = max(1, self.handler.batch_size)
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            batch = [(attachment, future) for attachment, future in batch if not future.done()]
+            if not batch:
+                continue
+
+            try:
+                if batch_size == 1:
+                    results = [await self.handler.process_asset(batch[0][0])]
+                else:
+                    results = await self.handler.process_assets([attachment for attachment, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+            else:
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+
+    def close(self):
+        """Stop the workers, dropping whatever is still queued."""
+        for worker in self._workers:
+            worker.cancel()
+        for future in self._results.values():
+            if not future.done():
+                future.cancel()
+            elif not future.cancelled():
+                # Failures of messages which were never rendered are not worth a warning
+                future.exception()
@@ -0,0 +1,133 @@
+import json
+import os
+from datetime import datetime
+from typing import Optional
+
+from chat_exporter.construct.message_record import MessageRecord
+from chat_exporter.ext.discord_import import discord
+
+CHECKPOINT_VERSION = 1
+
+
+class Checkpoint:
+    """
+    Everything needed to carry on an export after the last message it rendered.
+
+    The rendered messages are stored without the closing tag of the last message group,
+    so messages rendered later can still join that group.
+    """
+
+    def __init__(
+        self,
+        channel_id: int,
+        options: dict,
+        last_message_id: Optional[int] = None,
+        message_count: int = 0,
+        messages_html: str = "",
+        meta_data: Optional[dict] = None,
+        previous_message: Optional[dict] = None,
+        menu_div_id: int = 0,
+    ):
+        self.channel_id = channel_id
+        self.options = options
+        self.last_message_id = last_message_id
+        self.message_count = message_count
+        self.messages_html = messages_html
+        self.meta_data = meta_data if meta_data is not None else {}
+        self.previous_message = previous_message
+        self.menu_div_id = menu_div_id
+
+    def matches(self, channel_id: int, options: dict) -> bool:
+        # Messages rendered with another timezone or time format can not be mixed with new ones
+        return self.channel_id == channel_id and self.options == options
+
+    def previous_message_stub(self) -> Optional[MessageRecord]:
+        """The fields of the last rendered message which decide whether the next one starts a new group."""
+        if not self.previous_message:
+            return None
+
+        return MessageRecord(
+            id=self.last_message_id,
+            type=discord.MessageType.default if self.previous_message["default_type"] else None,
+            author_id=self.previous_message["author_id"],
+            created_at=datetime.fromisoformat(self.previous_message["created_at"]),
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            "version": CHECKPOINT_VERSION,
+            "channel_id": self.channel_id,
+            "options": self.options,
+            "last_message_id": self.last_message_id,
+            "message_count": self.message_count,
+            "messages_html": self.messages_html,
+            "meta_data": {str(user_id): _dump_participant(data) for user_id, data in self.meta_data.items()},
+            "previous_message": self.previous_message,
+            "menu_div_id": self.menu_div_id,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> Optional["Checkpoint"]:
+        if data.get("version") != CHECKPOINT_VERSION:
+            return None
+
+        return cls(
+            channel_id=data["channel_id"],
+            options=data["options"],
+            last_message_id=data["last_message_id"],
+            message_count=data["message_count"],
+            messages_html=data["messages_html"],
+            meta_data={int(user_id): _load_participant(value) for user_id, value in data["meta_data"].items()},
+            previous_message=data["previous_message"],
+            menu_div_id=data["menu_div_id"],
+        )
+
+
+def describe_message(message: discord.Message) -> dict:
+    return {
+        "author_id": message.author.id,
+        "created_at": message.created_at.isoformat(),
+        "default_type": message.type is discord.MessageType.default,
+    }
+
+
+def load_checkpoint(path) -> Optional[Checkpoint]:
+    if not os.path.exists(path):
+        return None
+
+    with open(path, "r", encoding="utf-8") as f:
+        return Checkpoint.from_dict(json.load(f))
+
+
+def save_checkpoint(path, checkpoint: Checkpoint):
+    # Written next to the old checkpoint and swapped in, so a crash never leaves half a checkpoint behind
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(checkpoint.to_dict(), f)
+    os.replace(temp_path, path)
+
+
+# Participants are stored by MessageConstruct.build_meta_data as
+# [name, created_at, bot tag, avatar, message count, joined_at, display name]
+def _dump_participant(data: list) -> list:
+    return [
+        data[0],
+        data[1].isoformat(),
+        data[2],
+        str(data[3]),
+        data[4],
+        data[5].isoformat() if data[5] else None,
+        data[6],
+    ]
+
+
+def _load_participant(data: list) -> list:
+    return [
+        data[0],
+        datetime.fromisoformat(data[1]),
+        data[2],
+        data[3],
+        data[4],
+        datetime.fromisoformat(data[5]) if data[5] else None,
+        data[6],
+    ]
@@ -1,12 +1,28 @@
+import asyncio
 import html
+import itertools
+import re
+from collections import deque
+from concurrent.futures import Executor
+from contextlib import nullcontext
 from datetime import timedelta
-from typing import List, Optional
+from typing import AsyncIterable, AsyncIterator, Deque, Iterable, Iterator, List, Optional, Sequence, Union
 
 from pytz import timezone
 
 from chat_exporter.construct.assets import Attachment, AttachmentGrid, Component, Embed, Reaction
-from chat_exporter.construct.attachment_handler import AttachmentHandler
-from chat_exporter.ext.cache import cache
+from chat_exporter.construct.assets.component import count_menus
+from chat_exporter.construct.assets.embed import embed_markup
+from chat_exporter.construct.attachment_handler import AttachmentHandler, AttachmentQueue
+from chat_exporter.construct.message_record import (
+    AttachmentRecord,
+    AuthorRecord,
+    MessageRecord,
+    attachment_record,
+    message_record,
+    starts_group,
+)
+from chat_exporter.ext.cache import Cache, LRUCache, cache, current_cache, has_cache, use_cache
 from chat_exporter.ext.discord_import import discord
 from chat_exporter.ext.discord_utils import DiscordUtils
 from chat_exporter.ext.discriminator import discriminator
@@ -31,10 +47,12 @@ from chat_exporter.ext.html_generator import (
     message_thread_remove,
     start_message,
 )
+from chat_exporter.ext.render_context import current_context
+from chat_exporter.parse.render_pool import MarkdownPrerenderer
 
 
-def _gather_user_bot(author: discord.Member):
-    if author.bot and author.public_flags.verified_bot:
+def _gather_user_bot(author: AuthorRecord):
+    if author.verified_bot:
         return bot_tag_verified
     elif author.bot:
         return bot_tag
@@ -60,23 +78,30 @@ class MessageConstruct:
 
     def __init__(
         self,
-        message: discord.Message,
-        previous_message: Optional[discord.Message],
+        record: MessageRecord,
+        previous_message: Optional[MessageRecord],
         pytz_timezone,
         military_time: bool,
         guild: discord.Guild,
         meta_data: dict,
-        message_dict: dict,
+        references: Cache,
         attachment_handler: Optional[AttachmentHandler],
+        channel: Optional[discord.abc.Messageable] = None,
+        menu_ids: Optional[Iterator[int]] = None,
     ):
-        self.message = message
+        self.record = record
+        # Where replies outside of the export are fetched from
+        self.channel = channel
         self.rendered_content = ""
+        self.reference = ""
         self.previous_message = previous_message
         self.pytz_timezone = pytz_timezone
         self.military_time = military_time
         self.guild = guild
-        self.message_dict = message_dict
+        # Records of the messages read before this one and of replied-to messages, by id
+        self.references = references
         self.attachment_handler = attachment_handler
+        self.menu_ids = menu_ids
         self.time_format = "%A, %e %B %Y %I:%M %p"
         if self.military_time:
             self.time_format = "%A, %e %B %Y %H:%M"
@@ -86,11 +111,7 @@ class MessageConstruct:
         self.forwarded = False
 
     def get_message_snapshots(self):
-        if hasattr(self.message, "message_snapshots"):
-            return self.message.message_snapshots
-        elif hasattr(self.message, "snapshots"):
-            return self.message.snapshots
-        return []
+        return self.record.snapshots
 
     @staticmethod
     def _collect_attachment_urls(attachment):
@@ -128,13 +149,13 @@ class MessageConstruct:
     async def construct_message(
         self,
     ) -> (str, dict):
-        if discord.MessageType.pins_add == self.message.type:
+        if discord.MessageType.pins_add == self.record.type:
             await self.build_pin()
-        elif discord.MessageType.thread_created == self.message.type:
+        elif discord.MessageType.thread_created == self.record.type:
             await self.build_thread()
-        elif discord.MessageType.recipient_remove == self.message.type:
+        elif discord.MessageType.recipient_remove == self.record.type:
             await self.build_thread_remove()
-        elif discord.MessageType.recipient_add == self.message.type:
+        elif discord.MessageType.recipient_add == self.record.type:
             await self.build_thread_add()
         else:
             await self.build_message()
@@ -167,23 +188,20 @@ class MessageConstruct:
         await self.build_add()
 
     async def build_meta_data(self):
-        user_id = self.message.author.id
+        author = self.record.author
+        user_id = author.id
 
         if user_id in self.meta_data:
             self.meta_data[user_id][4] += 1
         else:
-            user_name_discriminator = await discriminator(self.message.author.name, self.message.author.discriminator)
-            user_created_at = self.message.author.created_at
-            user_bot = _gather_user_bot(self.message.author)
-            user_avatar = (
-                self.message.author.display_avatar
-                if self.message.author.display_avatar
-                else DiscordUtils.default_avatar
-            )
-            user_joined_at = self.message.author.joined_at if hasattr(self.message.author, "joined_at") else None
+            user_name_discriminator = await discriminator(author.name, author.discriminator)
+            user_created_at = author.created_at
+            user_bot = _gather_user_bot(author)
+            user_avatar = author.display_avatar if author.display_avatar else DiscordUtils.default_avatar
+            user_joined_at = author.joined_at
             user_display_name = (
-                f'<div class="meta__display-name">{self.message.author.display_name}</div>'
-                if self.message.author.display_name != self.message.author.name
+                f'<div class="meta__display-name">{author.display_name}</div>'
+                if author.display_name != author.name
                 else ""
             )
             self.meta_data[user_id] = [
@@ -197,22 +215,16 @@ class MessageConstruct:
             ]
 
     async def build_content(self):
-        if not self.message.content and not self.get_message_snapshots():
+        if not self.record.content and not self.get_message_snapshots():
             self.rendered_content = ""
             return
 
         if self.message_edited_at:
             self.message_edited_at = _set_edit_at(self.message_edited_at)
 
-        snapshots = self.get_message_snapshots()
-        if snapshots:
-            combined = f"{self.message.content} {' '.join(s.content for s in snapshots if hasattr(s, 'content'))}"
+        if self.get_message_snapshots():
             self.forwarded = True
-        else:
-            combined = self.message.content
-
-        combined = html.escape(combined or "")
-
+        combined = message_content_markup(self.record)
 
         self.rendered_content = await fill_out(
             self.guild,
@@ -224,23 +236,17 @@ class MessageConstruct:
         )
 
     async def build_reference(self):
-        if not self.message.reference:
-            self.message.reference = ""
+        if not self.record.reference_id:
             return
 
-        message: discord.Message = self.message_dict.get(self.message.reference.message_id)
+        try:
+            message = await self._fetch_reference(self.record.reference_id)
+        except discord.HTTPException:
+            return
 
         if not message:
-            try:
-                message: discord.Message = await self.message.channel.fetch_message(self.message.reference.message_id)
-            except (discord.NotFound, discord.HTTPException) as e:
-                self.message.reference = ""
-                if self.forwarded:
-                    self.message.reference = ""
-                    return
-                if isinstance(e, discord.NotFound):
-                    self.message.reference = message_reference_unknown
-                return
+            self.reference = "" if self.forwarded else message_reference_unknown
+            return
 
         is_bot = _gather_user_bot(message.author)
         user_colour = await self._gather_user_colour(message.author)
@@ -248,29 +254,23 @@ class MessageConstruct:
         icon = ""
         dummy = ""
 
-        def get_interaction_status(interaction_message):
-            if hasattr(interaction_message, "interaction_metadata"):
-                return interaction_message.interaction_metadata
-            return interaction_message.interaction
-
-        interaction_status = get_interaction_status(message)
-        if not interaction_status and (message.embeds or message.attachments):
+        if not message.interaction and (message.embeds or message.attachments):
             icon = DiscordUtils.reference_attachment_icon
             dummy = "Click to see attachment"
-        elif interaction_status:
+        elif message.interaction:
             icon = DiscordUtils.interaction_command_icon
             dummy = "Click to see command"
 
-        if not message.content:
-            message.content = dummy
+        # The referenced message may be rendered at the same time, so it must not be changed here
+        content = message.content or dummy
 
         _, message_edited_at = self.set_time(message)
 
         if message_edited_at:
             message_edited_at = _set_edit_at(message_edited_at)
 
-        avatar_url = message.author.display_avatar if message.author.display_avatar else DiscordUtils.default_avatar
-        self.message.reference = await fill_out(
+        avatar_url = message.author.display_avatar or DiscordUtils.default_avatar
+        self.reference = await fill_out(
             self.guild,
             message_reference,
             [
@@ -279,33 +279,37 @@ class MessageConstruct:
                 ("NAME_TAG", await discriminator(message.author.name, message.author.discriminator), PARSE_MODE_NONE),
                 ("NAME", str(html.escape(message.author.display_name))),
                 ("USER_COLOUR", user_colour, PARSE_MODE_NONE),
-                ("CONTENT", message.content.replace("\n", "").replace("<br>", ""), PARSE_MODE_REFERENCE),
+                ("CONTENT", content.replace("\n", "").replace("<br>", ""), PARSE_MODE_REFERENCE),
                 ("EDIT", message_edited_at, PARSE_MODE_NONE),
                 ("ICON", icon, PARSE_MODE_NONE),
                 ("USER_ID", str(message.author.id), PARSE_MODE_NONE),
-                ("MESSAGE_ID", str(self.message.reference.message_id), PARSE_MODE_NONE),
+                ("MESSAGE_ID", str(self.record.reference_id), PARSE_MODE_NONE),
             ],
         )
 
+    async def _fetch_reference(self, message_id: int) -> Optional[MessageRecord]:
+        """The record of a referenced message, fetched if it is not among the references, None if it was deleted.
+        Results are shared through the references, which MessageHistory fills as it reads the messages."""
+        message = self.references.get(message_id, _UNRESOLVED)
+        if message is not _UNRESOLVED:
+            return message
+
+        try:
+            message = message_record(await self.channel.fetch_message(message_id))
+        except discord.NotFound:
+            message = None
+        self.references.set(message_id, message)
+        return message
+
     async def build_interaction(self):
-        if hasattr(self.message, "interaction_metadata"):
-            if not self.message.interaction_metadata:
-                self.interaction = ""
-                return
-            command = "a slash command"
-            user = self.message.interaction_metadata.user
-            interaction_id = self.message.interaction_metadata.id
-        elif self.message.interaction:
-            command = f"/{self.message.interaction.name}"
-            user = self.message.interaction.user
-            interaction_id = self.message.interaction.id
-        else:
+        if not self.record.interaction:
             self.interaction = ""
             return
+        interaction_id, command, user = self.record.interaction
 
         is_bot = _gather_user_bot(user)
         user_colour = await self._gather_user_colour(user)
-        avatar_url = user.display_avatar if user.display_avatar else DiscordUtils.default_avatar
+        avatar_url = user.display_avatar or DiscordUtils.default_avatar
 
         self.interaction = await fill_out(
             self.guild,
@@ -327,13 +331,13 @@ class MessageConstruct:
         sticker = None
         sticker_image_url = None
 
-        if self.message.stickers and hasattr(self.message.stickers[0], "url"):
-            sticker_image_url = self.message.stickers[0].url
+        if self.record.stickers and hasattr(self.record.stickers[0], "url"):
+            sticker_image_url = self.record.stickers[0].url
         if not sticker_image_url:
             for snapshot in self.get_message_snapshots():
-                if hasattr(snapshot, "stickers") and snapshot.stickers and hasattr(snapshot.stickers[0], "url"):
+                if snapshot.stickers and hasattr(snapshot.stickers[0], "url"):
                     sticker_image_url = snapshot.stickers[0].url
-                    self.message.reference = ""
+                    self.reference = ""
                     break
 
         if not sticker_image_url:
@@ -341,10 +345,10 @@ class MessageConstruct:
 
         if sticker_image_url.endswith(".json"):
             try:
-                sticker = await self.message.stickers[0].fetch()
+                sticker = await self.record.stickers[0].fetch()
             except Exception:
                 for snapshot in self.get_message_snapshots():
-                    if hasattr(snapshot, "stickers") and snapshot.stickers and hasattr(snapshot.stickers[0], "url"):
+                    if snapshot.stickers and hasattr(snapshot.stickers[0], "url"):
                         sticker = await snapshot.stickers[0].fetch()
                         break
             sticker_image_url = (
@@ -383,23 +387,29 @@ class MessageConstruct:
             return res
         return [n]
 
+    async def process_attachments(self, attachments: Sequence[AttachmentRecord]) -> List[AttachmentRecord]:
+        """Pass the attachments through the attachment handler, which takes and returns `discord.Attachment`."""
+        if not isinstance(self.attachment_handler, AttachmentHandler):
+            return list(attachments)
+        handler = self.attachment_handler
+        processed = await asyncio.gather(*(handler.process_asset(a.to_attachment()) for a in attachments))
+        # Spoilers are marked by the message, whatever the handler made of the file name
+        return [attachment_record(p, a.state)._replace(spoiler=a.spoiler) for a, p in zip(attachments, processed)]
+
     async def build_assets(self):
         processed_attachments = []
         attachment_urls = set()
 
         for snapshot in self.get_message_snapshots():
-            if hasattr(snapshot, "embeds"):
-                for se in snapshot.embeds:
-                    self.forwarded_embeds += await Embed(se, self.guild).flow()
-                    self.message.reference = ""
-
-        for a in self.message.attachments:
-            if self.attachment_handler and isinstance(self.attachment_handler, AttachmentHandler):
-                a = await self.attachment_handler.process_asset(a)
+            for se in snapshot.embeds:
+                self.forwarded_embeds += await Embed(se, self.guild).flow()
+                self.reference = ""
+
+        for a in await self.process_attachments(self.record.attachments):
             processed_attachments.append(a)
             attachment_urls.update(self._collect_attachment_urls(a))
 
-        for e in self.message.embeds:
+        for e in self.record.embeds:
             if self._is_duplicate_image_embed(e, attachment_urls):
                 continue
             self.embeds += await Embed(e, self.guild, self.pytz_timezone, self.military_time).flow()
@@ -430,23 +440,19 @@ class MessageConstruct:
             self.attachments += await flush_media_group(media_group)
 
         for snapshot in self.get_message_snapshots():
-            if hasattr(snapshot, "attachments"):
-                for sa in snapshot.attachments:
-                    if self.attachment_handler:
-                        sa = await self.attachment_handler.process_asset(sa)
-                    self.attachments += await Attachment(sa, self.guild).flow()
-                    self.message.reference = ""
+            for sa in await self.process_attachments(snapshot.attachments):
+                self.attachments += await Attachment(sa, self.guild).flow()
+                self.reference = ""
 
-        for c in self.message.components:
-            self.components += await Component(c, self.guild, self.message.attachments).flow()
+        for c in self.record.components:
+            self.components += await Component(c, self.guild, self.record.attachments, self.menu_ids).flow()
 
         for snapshot in self.get_message_snapshots():
-            if hasattr(snapshot, "components"):
-                for ac in snapshot.components:
-                    self.components += await Component(ac, self.guild).flow()
-                    self.message.reference = ""
+            for ac in snapshot.components:
+                self.components += await Component(ac, self.guild, menu_ids=self.menu_ids).flow()
+                self.reference = ""
 
-        for r in self.message.reactions:
+        for r in self.record.reactions:
             self.reactions += await Reaction(r, self.guild).flow()
 
         if self.reactions:
@@ -475,7 +481,7 @@ class MessageConstruct:
             self.guild,
             message_body,
             [
-                ("MESSAGE_ID", str(self.message.id)),
+                ("MESSAGE_ID", str(self.record.id)),
                 ("MESSAGE_CONTENT", self.rendered_content, PARSE_MODE_NONE),
                 ("EMBEDS", self.embeds, PARSE_MODE_NONE),
                 ("ATTACHMENTS", self.attachments, PARSE_MODE_NONE),
@@ -489,15 +495,7 @@ class MessageConstruct:
         return self.message_html
 
     def _generate_message_divider_check(self):
-        return bool(
-            self.previous_message is None
-            or self.message.reference != ""
-            or self.previous_message.type is not discord.MessageType.default
-            or self.interaction != ""
-            or self.previous_message.author.id != self.message.author.id
-            or self.message.webhook_id is not None
-            or self.message.created_at > (self.previous_message.created_at + timedelta(minutes=4))
-        )
+        return bool(starts_group(self.previous_message, self.record) or self.reference != "" or self.interaction != "")
 
     async def generate_message_divider(self, channel_audit=False):
         if channel_audit or self._generate_message_divider_check():
@@ -509,16 +507,15 @@ class MessageConstruct:
                 return
 
             followup_symbol = ""
-            is_bot = _gather_user_bot(self.message.author)
-            avatar_url = self.message.author.display_avatar
-            if not avatar_url:
-                avatar_url = DiscordUtils.default_avatar
+            author = self.record.author
+            is_bot = _gather_user_bot(author)
+            avatar_url = author.display_avatar or DiscordUtils.default_avatar
 
-            if self.message.reference != "" or self.interaction:
+            if self.reference != "" or self.interaction:
                 followup_symbol = "<div class='chatlog__followup-symbol'></div>"
 
-            time = self.message.created_at
-            if not self.message.created_at.tzinfo:
+            time = self.record.created_at
+            if not time.tzinfo:
                 time = timezone("UTC").localize(time)
 
             if self.military_time:
@@ -533,23 +530,23 @@ class MessageConstruct:
                     ("REFERENCE_SYMBOL", followup_symbol, PARSE_MODE_NONE),
                     (
                         "REFERENCE",
-                        self.message.reference if self.message.reference else self.interaction,
+                        self.reference if self.reference else self.interaction,
                         PARSE_MODE_NONE,
                     ),
                     ("AVATAR_URL", str(avatar_url), PARSE_MODE_NONE),
                     (
                         "NAME_TAG",
-                        await discriminator(self.message.author.name, self.message.author.discriminator),
+                        await discriminator(author.name, author.discriminator),
                         PARSE_MODE_NONE,
                     ),
-                    ("USER_ID", str(self.message.author.id)),
-                    ("USER_COLOUR", await self._gather_user_colour(self.message.author)),
-                    ("USER_ICON", await self._gather_user_icon(self.message.author), PARSE_MODE_NONE),
-                    ("NAME", str(html.escape(self.message.author.display_name))),
+                    ("USER_ID", str(author.id)),
+                    ("USER_COLOUR", await self._gather_user_colour(author)),
+                    ("USER_ICON", await self._gather_user_icon(author), PARSE_MODE_NONE),
+                    ("NAME", str(html.escape(author.display_name))),
                     ("BOT_TAG", str(is_bot), PARSE_MODE_NONE),
                     ("TIMESTAMP", str(self.message_created_at)),
                     ("DEFAULT_TIMESTAMP", str(default_timestamp), PARSE_MODE_NONE),
-                    ("MESSAGE_ID", str(self.message.id)),
+                    ("MESSAGE_ID", str(self.record.id)),
                     ("MESSAGE_CONTENT", self.rendered_content, PARSE_MODE_NONE),
                     ("EMBEDS", self.embeds, PARSE_MODE_NONE),
                     ("ATTACHMENTS", self.attachments, PARSE_MODE_NONE),
@@ -566,17 +563,17 @@ class MessageConstruct:
             message_pin,
             [
                 ("PIN_URL", DiscordUtils.pinned_message_icon, PARSE_MODE_NONE),
-                ("USER_COLOUR", await self._gather_user_colour(self.message.author)),
-                ("NAME", str(html.escape(self.message.author.display_name))),
+                ("USER_COLOUR", await self._gather_user_colour(self.record.author)),
+                ("NAME", str(html.escape(self.record.author.display_name))),
                 (
                     "NAME_TAG",
-                    await discriminator(self.message.author.name, self.message.author.discriminator),
+                    await discriminator(self.record.author.name, self.record.author.discriminator),
                     PARSE_MODE_NONE,
                 ),
-                ("MESSAGE_ID", str(self.message.id), PARSE_MODE_NONE),
+                ("MESSAGE_ID", str(self.record.id), PARSE_MODE_NONE),
                 (
                     "REF_MESSAGE_ID",
-                    str(self.message.reference.message_id) if self.message.reference else "",
+                    str(self.record.reference_id) if self.record.reference_id else "",
                     PARSE_MODE_NONE,
                 ),
             ],
@@ -588,30 +585,30 @@ class MessageConstruct:
             message_thread,
             [
                 ("THREAD_URL", DiscordUtils.thread_channel_icon, PARSE_MODE_NONE),
-                ("THREAD_NAME", self.message.content, PARSE_MODE_NONE),
-                ("USER_COLOUR", await self._gather_user_colour(self.message.author)),
-                ("NAME", str(html.escape(self.message.author.display_name))),
+                ("THREAD_NAME", self.record.content, PARSE_MODE_NONE),
+                ("USER_COLOUR", await self._gather_user_colour(self.record.author)),
+                ("NAME", str(html.escape(self.record.author.display_name))),
                 (
                     "NAME_TAG",
-                    await discriminator(self.message.author.name, self.message.author.discriminator),
+                    await discriminator(self.record.author.name, self.record.author.discriminator),
                     PARSE_MODE_NONE,
                 ),
-                ("MESSAGE_ID", str(self.message.id), PARSE_MODE_NONE),
+                ("MESSAGE_ID", str(self.record.id), PARSE_MODE_NONE),
             ],
         )
 
     async def build_remove(self):
-        removed_member: discord.Member = self.message.mentions[0]
+        removed_member = self.record.recipient
         self.message_html += await fill_out(
             self.guild,
             message_thread_remove,
             [
                 ("THREAD_URL", DiscordUtils.thread_remove_recipient, PARSE_MODE_NONE),
-                ("USER_COLOUR", await self._gather_user_colour(self.message.author)),
-                ("NAME", str(html.escape(self.message.author.display_name))),
+                ("USER_COLOUR", await self._gather_user_colour(self.record.author)),
+                ("NAME", str(html.escape(self.record.author.display_name))),
                 (
                     "NAME_TAG",
-                    await discriminator(self.message.author.name, self.message.author.discriminator),
+                    await discriminator(self.record.author.name, self.record.author.discriminator),
                     PARSE_MODE_NONE,
                 ),
                 ("RECIPIENT_USER_COLOUR", await self._gather_user_colour(removed_member)),
@@ -621,22 +618,22 @@ class MessageConstruct:
                     await discriminator(removed_member.name, removed_member.discriminator),
                     PARSE_MODE_NONE,
                 ),
-                ("MESSAGE_ID", str(self.message.id), PARSE_MODE_NONE),
+                ("MESSAGE_ID", str(self.record.id), PARSE_MODE_NONE),
             ],
         )
 
     async def build_add(self):
-        removed_member: discord.Member = self.message.mentions[0]
+        removed_member = self.record.recipient
         self.message_html += await fill_out(
             self.guild,
             message_thread_add,
             [
                 ("THREAD_URL", DiscordUtils.thread_add_recipient, PARSE_MODE_NONE),
-                ("USER_COLOUR", await self._gather_user_colour(self.message.author)),
-                ("NAME", str(html.escape(self.message.author.display_name))),
+                ("USER_COLOUR", await self._gather_user_colour(self.record.author)),
+                ("NAME", str(html.escape(self.record.author.display_name))),
                 (
                     "NAME_TAG",
-                    await discriminator(self.message.author.name, self.message.author.discriminator),
+                    await discriminator(self.record.author.name, self.record.author.discriminator),
                     PARSE_MODE_NONE,
                 ),
                 ("RECIPIENT_USER_COLOUR", await self._gather_user_colour(removed_member)),
@@ -646,28 +643,19 @@ class MessageConstruct:
                     await discriminator(removed_member.name, removed_member.discriminator),
                     PARSE_MODE_NONE,
                 ),
-                ("MESSAGE_ID", str(self.message.id), PARSE_MODE_NONE),
+                ("MESSAGE_ID", str(self.record.id), PARSE_MODE_NONE),
             ],
         )
 
-    @cache()
-    async def _gather_member(self, author: discord.Member):
-        member = self.guild.get_member(author.id)
-
-        if member:
-            return member
+    async def _gather_member(self, author: AuthorRecord):
+        return await gather_member(self.guild, author.id)
 
-        try:
-            return await self.guild.fetch_member(author.id)
-        except Exception:
-            return None
-
-    async def _gather_user_colour(self, author: discord.Member):
+    async def _gather_user_colour(self, author: AuthorRecord):
         member = await self._gather_member(author)
         user_colour = member.colour if member and str(member.colour) != "#000000" else "#FFFFFF"
         return f"color: {user_colour};"
 
-    async def _gather_user_icon(self, author: discord.Member):
+    async def _gather_user_icon(self, author: AuthorRecord):
         member = await self._gather_member(author)
 
         if not member:
@@ -679,15 +667,15 @@ class MessageConstruct:
             return f"<img class='chatlog__role-icon' src='{member.top_role.icon}' alt='Role Icon'>"
         return ""
 
-    def set_time(self, message: Optional[discord.Message] = None):
-        message = message if message else self.message
+    def set_time(self, message: Optional[MessageRecord] = None):
+        message = message if message else self.record
         created_at_str = self.to_local_time_str(message.created_at)
         edited_at_str = self.to_local_time_str(message.edited_at) if message.edited_at else ""
 
         return created_at_str, edited_at_str
 
     def to_local_time_str(self, time):
-        if not self.message.created_at.tzinfo:
+        if not self.record.created_at.tzinfo:
             time = timezone("UTC").localize(time)
 
         local_time = time.astimezone(timezone(self.pytz_timezone))
@@ -695,43 +683,459 @@ class MessageConstruct:
         return local_time.strftime(self.time_format)
 
 
+def message_markup(record: MessageRecord) -> List[str]:
+    """Everything of the message which is rendered as markdown: its content and the texts of its embeds."""
+    texts = [message_content_markup(record)]
+    for embed in itertools.chain(record.embeds, *(s.embeds for s in record.snapshots)):
+        texts += embed_markup(embed)
+    return texts
+
+
+def message_content_markup(record: MessageRecord) -> str:
+    """The escaped content rendered as the body of the message, followed by that of any forwarded messages."""
+    if record.snapshots:
+        combined = f"{record.content} {' '.join(s.content for s in record.snapshots if s.content is not None)}"
+    else:
+        combined = record.content
+    return html.escape(combined or "")
+
+
+@cache(key=lambda guild, user_id: (guild.id, user_id))
+async def gather_member(guild: discord.Guild, user_id: int):
+    member = guild.get_member(user_id)
+
+    if member:
+        return member
+
+    try:
+        return await guild.fetch_member(user_id)
+    except Exception:
+        return None
+
+
 async def gather_messages(
     messages: List[discord.Message],
     guild: discord.Guild,
     pytz_timezone,
     military_time,
     attachment_handler: Optional[AttachmentHandler],
+    concurrency: int = 1,
+    prefetch_members: bool = False,
+    attachment_concurrency: int = 1,
+    render_executor: Optional[Executor] = None,
 ) -> (str, dict):
-    message_html_chunks: List[str] = []
     meta_data: dict = {}
-    previous_message: Optional[discord.Message] = None
+    # Called outside of an export, the lookups are shared for this call only
+    with use_cache(Cache()) if not has_cache() else nullcontext():
+        message_html_chunks: List[str] = [
+            chunk
+            async for chunk in iter_messages(
+                messages,
+                guild,
+                pytz_timezone,
+                military_time,
+                attachment_handler,
+                meta_data,
+                concurrency,
+                prefetch_members,
+                attachment_concurrency=attachment_concurrency,
+                render_executor=render_executor,
+            )
+        ]
+    return "".join(message_html_chunks), meta_data
+
 
-    message_dict = {message.id: message for message in messages}
+async def iter_messages(
+    messages: Union[Iterable[discord.Message], AsyncIterable[discord.Message]],
+    guild: discord.Guild,
+    pytz_timezone,
+    military_time,
+    attachment_handler: Optional[AttachmentHandler],
+    meta_data: dict,
+    concurrency: int = 1,
+    prefetch_members: bool = False,
+    previous_message: Optional[MessageRecord] = None,
+    attachment_concurrency: int = 1,
+    render_executor: Optional[Executor] = None,
+) -> AsyncIterator[str]:
+    """Render the messages, oldest first, yielding the HTML of each in order as soon as it is built.
+    The messages may be an async iterator such as `channel.history()`, they are read only as far ahead of
+    rendering as is needed, so the history is never held as a whole.
+    Up to `concurrency` messages are rendered at the same time, so their network lookups overlap.
+    The participant meta data is collected in to the passed in dict as the messages are yielded.
+    With `prefetch_members`, the members the messages refer to are requested in bulk a page of messages at a time.
+    A `previous_message` continues an earlier render, the first message may then join its group.
+    Attachments are processed by one queue for all messages, `attachment_concurrency` at the same time,
+    queued a few messages ahead of rendering.
+    Lookups are cached in the cache bound by the export, called on its own nothing is cached.
+    With a `render_executor`, the markdown of the message contents is rendered across it a window of messages ahead.
+    """
+    history = MessageHistory(messages, guild, concurrency, prefetch_members, previous_message)
+
+    prerenderer = None
+    if render_executor is not None:
+        prerenderer = MarkdownPrerenderer(history, guild, render_executor, message_markup)
+
+    queue = None
+    if isinstance(attachment_handler, AttachmentHandler):
+        queue = attachment_handler = AttachmentQueue(attachment_handler, attachment_concurrency)
+    # Messages whose attachments are queued
+    queued = 0
+
+    # A message only looks at the record of the message before it (author, type, time), so every message
+    # can be rendered independently once it is paired with its predecessor.
+    pending: Deque[asyncio.Future] = deque()
+    built = 0
+    index = 0
+    previous_record = previous_message
+    try:
+        while index < await history.read_to(index + 1):
+            record = history[index]
+            if queue is not None:
+                # Ahead of rendering by no more than the queue's window, but always up to this message
+                while queued <= index or (len(queue) < queue.window and queued < index + ATTACHMENT_LOOKAHEAD):
+                    if queued >= await history.read_to(queued + 1):
+                        break
+                    queue_attachments(queue, history[queued])
+                    queued += 1
+            if prerenderer is not None:
+                await prerenderer.ready(index)
+            # Claimed here, in transcript order, so menu ids do not depend on which message finishes first
+            menu_ids = iter(current_context().claim_menu_ids(message_menus(record)))
+            pending.append(
+                asyncio.ensure_future(
+                    MessageConstruct(
+                        record,
+                        previous_record,
+                        pytz_timezone,
+                        military_time,
+                        guild,
+                        {},
+                        history.references,
+                        attachment_handler,
+                        history.channel,
+                        menu_ids,
+                    ).construct_message()
+                )
+            )
+            previous_record = record
+            index += 1
+            # The message keeps its own record, only the messages ahead of it are still needed
+            history.release(index)
+
+            if len(pending) >= concurrency:
+                content_html, message_meta_data = await pending.popleft()
+                _merge_meta_data(meta_data, message_meta_data)
+                built += 1
+                if prerenderer is not None:
+                    prerenderer.release(built)
+                yield content_html
+
+        while pending:
+            content_html, message_meta_data = await pending.popleft()
+            _merge_meta_data(meta_data, message_meta_data)
+            built += 1
+            if prerenderer is not None:
+                prerenderer.release(built)
+            yield content_html
+    finally:
+        for task in pending:
+            task.cancel()
+        if queue is not None:
+            queue.close()
+        if prerenderer is not None:
+            prerenderer.close()
+
+    yield "</div>"
+
+
+# Records of the messages read are kept this long for the replies after them, along with replied-to messages
+# from outside of the export. Replies mostly answer recent messages, older ones are fetched again if needed.
+REFERENCE_CACHE_SIZE = 4096
+# Attachments are queued at most this many messages ahead of rendering
+ATTACHMENT_LOOKAHEAD = 100
+_UNRESOLVED = object()
+
+
+async def _iterate(messages: Iterable[discord.Message]) -> AsyncIterator[discord.Message]:
+    for message in messages:
+        yield message
 
-    if messages and "thread" in str(messages[0].channel.type) and messages[0].reference:
-        channel = guild.get_channel(messages[0].reference.channel_id)
 
-        if not channel:
-            channel = await guild.fetch_channel(messages[0].reference.channel_id)
+class MessageHistory:
+    """
+    The records of the messages being rendered, read from the messages only as far as rendering has asked for.
+    Records are indexed by their place in the transcript, and dropped once rendering has taken them.
 
-        message = await channel.fetch_message(messages[0].reference.message_id)
-        messages[0] = message
-        messages[0].reference = None
+    Messages are read a page at a time. Every page has its replies resolved, and with `prefetch_members` its
+    members requested, before it is rendered. The records read, and the replied-to messages, are kept in
+    `references` for the replies which follow them.
+    """
+
+    def __init__(
+        self,
+        messages: Union[Iterable[discord.Message], AsyncIterable[discord.Message]],
+        guild: discord.Guild,
+        concurrency: int = 1,
+        prefetch_members: bool = False,
+        previous_message: Optional[MessageRecord] = None,
+    ):
+        if not hasattr(messages, "__aiter__"):
+            messages = _iterate(messages)
+        self._messages = messages.__aiter__()
+        self.guild = guild
+        self.concurrency = concurrency
+        self.prefetch_members = prefetch_members
+        self.previous_message = previous_message
+        self.references = LRUCache(maxsize=REFERENCE_CACHE_SIZE)
+        # Replies to messages outside of the export are fetched from here, set by the first message
+        self.channel: Optional[discord.abc.Messageable] = None
+        self.start = 0
+        self.exhausted = False
+        self._records: Deque[MessageRecord] = deque()
+
+    @property
+    def stop(self) -> int:
+        return self.start + len(self._records)
+
+    def __getitem__(self, index: Union[int, slice]):
+        if isinstance(index, slice):
+            return [self._records[i - self.start] for i in range(index.start, index.stop)]
+        return self._records[index - self.start]
+
+    def release(self, stop: int):
+        """Drop the records before `stop`."""
+        while self.start < stop and self._records:
+            self._records.popleft()
+            self.start += 1
+
+    async def read_to(self, stop: int) -> int:
+        """Read until the records up to `stop` are held, or the messages run out, and return where the records
+        held end. Anything read is read a page at least, so replies and members are looked up a page at a time."""
+        if self.stop >= stop or self.exhausted:
+            return self.stop
+
+        page: List[discord.Message] = []
+        while self.stop + len(page) < stop or len(page) < HISTORY_PAGE_SIZE:
+            try:
+                page.append(await self._messages.__anext__())
+            except StopAsyncIteration:
+                self.exhausted = True
+                break
+
+        records = []
+        for message in page:
+            record = message_record(message)
+            self.references.set(record.id, record)
+            if self.channel is None:
+                self.channel = message.channel
+                record = await self._thread_start(message, record)
+            records.append(record)
+
+        await prefetch_references(page, self.references, self.concurrency)
+        if self.prefetch_members:
+            await prefetch_guild_members(records, self.guild, self.references)
+        self._records.extend(records)
+        return self.stop
+
+    async def _thread_start(self, message: discord.Message, record: MessageRecord) -> MessageRecord:
+        """A thread opens with the message it was started from, shown without its reference, unless an earlier
+        render is continued. The message passed in is left as it is."""
+        if self.previous_message is not None or "thread" not in str(message.channel.type) or not message.reference:
+            return record
+
+        parent = self.guild.get_channel(message.reference.channel_id)
+
+        if not parent:
+            parent = await self.guild.fetch_channel(message.reference.channel_id)
+
+        starter = await parent.fetch_message(message.reference.message_id)
+        return message_record(starter)._replace(reference_id=None)
+
+
+# Rendered as one line without the attachments, embeds or components of the message
+SYSTEM_MESSAGE_TYPES = (
+    discord.MessageType.pins_add,
+    discord.MessageType.thread_created,
+    discord.MessageType.recipient_add,
+    discord.MessageType.recipient_remove,
+)
+
+
+def message_menus(record: MessageRecord) -> int:
+    """The dropdown menus rendered for the message, and for the messages it forwards."""
+    if record.type in SYSTEM_MESSAGE_TYPES:
+        return 0
+    components = list(record.components)
+    for snapshot in record.snapshots:
+        components.extend(snapshot.components)
+    return sum(count_menus(c) for c in components)
+
+
+def queue_attachments(queue: AttachmentQueue, record: MessageRecord):
+    """Queue the attachments of the message, and of the messages it forwards, in transcript order."""
+    if record.type in SYSTEM_MESSAGE_TYPES:
+        # Their results would never be collected and hold a place in the window for the rest of the export
+        return
+    for attachment in record.attachments:
+        queue.submit(attachment.to_attachment())
+    for snapshot in record.snapshots:
+        for attachment in snapshot.attachments:
+            queue.submit(attachment.to_attachment())
+
+
+def _merge_meta_data(meta_data: dict, message_meta_data: dict):
+    # Merged in message order, so participants are listed the same way however the messages were rendered
+    for user_id, data in message_meta_data.items():
+        if user_id in meta_data:
+            meta_data[user_id][4] += data[4]
+        else:
+            meta_data[user_id] = data
+
+
+# Replies to messages this close together are looked up with one history request instead of one fetch each
+REFERENCE_CLUSTER_GAP = timedelta(minutes=30)
+HISTORY_PAGE_SIZE = 100
+
+
+async def prefetch_references(
+    messages: List[discord.Message],
+    references: Cache,
+    concurrency: int = 1,
+):
+    """Resolve every replied-to message which is not among the references yet, once per message id.
+    Results are stored in the references as the record of the message, or None if it was deleted.
+    Anything which fails to resolve here is fetched on demand by MessageConstruct instead."""
+    deleted_reference = getattr(discord, "DeletedReferencedMessage", None)
+    channels = {}
+    missing = {}
 
     for message in messages:
-        content_html, meta_data = await MessageConstruct(
-            message,
-            previous_message,
-            pytz_timezone,
-            military_time,
-            guild,
-            meta_data,
-            message_dict,
-            attachment_handler,
-        ).construct_message()
-
-        message_html_chunks.append(content_html)
-        previous_message = message
-
-    message_html_chunks.append("</div>")
-    return "".join(message_html_chunks), meta_data
+        reference = getattr(message, "reference", None)
+        if not hasattr(reference, "message_id"):
+            continue
+        if reference.message_id in references:
+            continue
+
+        # The library already includes the referenced message with replies it receives
+        resolved = getattr(reference, "resolved", None)
+        if isinstance(resolved, discord.Message):
+            references.set(reference.message_id, message_record(resolved))
+            continue
+        if deleted_reference and isinstance(resolved, deleted_reference):
+            references.set(reference.message_id, None)
+            continue
+
+        # Forwards reference other channels, those keep being looked up on demand
+        if reference.channel_id != message.channel.id:
+            continue
+
+        channels[message.channel.id] = message.channel
+        missing.setdefault(message.channel.id, set()).add(reference.message_id)
+
+    lookups = []
+    for channel_id, message_ids in missing.items():
+        for cluster in _cluster_message_ids(sorted(message_ids)):
+            lookups.append(_resolve_reference_cluster(channels[channel_id], cluster, references))
+
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+
+    async def bounded(lookup):
+        async with semaphore:
+            await lookup
+
+    await asyncio.gather(*(bounded(lookup) for lookup in lookups))
+
+
+def _cluster_message_ids(message_ids: List[int]) -> List[List[int]]:
+    clusters: List[List[int]] = []
+    for message_id in message_ids:
+        if clusters and (
+            discord.utils.snowflake_time(message_id) - discord.utils.snowflake_time(clusters[-1][-1])
+            <= REFERENCE_CLUSTER_GAP
+        ):
+            clusters[-1].append(message_id)
+        else:
+            clusters.append([message_id])
+    return clusters
+
+
+async def _resolve_reference_cluster(channel, message_ids: List[int], references: Cache):
+    try:
+        if len(message_ids) == 1:
+            try:
+                references.set(message_ids[0], message_record(await channel.fetch_message(message_ids[0])))
+            except discord.NotFound:
+                references.set(message_ids[0], None)
+            return
+
+        found = {}
+        async for message in channel.history(
+            limit=HISTORY_PAGE_SIZE,
+            after=discord.Object(id=message_ids[0] - 1),
+            before=discord.Object(id=message_ids[-1] + 1),
+            oldest_first=True,
+        ):
+            found[message.id] = message_record(message)
+    except discord.HTTPException:
+        return
+
+    # A full page may stop short of the end of the cluster, ids past it are left for on demand fetching
+    covered_until = max(found) if len(found) >= HISTORY_PAGE_SIZE else message_ids[-1]
+    for message_id in message_ids:
+        if message_id in found:
+            references.set(message_id, found[message_id])
+        elif message_id <= covered_until:
+            references.set(message_id, None)
+
+
+# The gateway answers a member request with at most 100 members
+MEMBER_REQUEST_SIZE = 100
+USER_MENTION = re.compile(r"<@!?([0-9]+)>")
+
+
+def _referenced_user_ids(record: MessageRecord, references: Cache):
+    yield record.author_id
+
+    if record.interaction:
+        yield record.interaction.user.id
+
+    if record.reference_id:
+        referenced = references.peek(record.reference_id)
+        if referenced:
+            yield referenced.author_id
+
+    if isinstance(record.content, str):
+        for user_id in USER_MENTION.findall(record.content):
+            yield int(user_id)
+
+
+async def prefetch_guild_members(
+    records: List[MessageRecord],
+    guild: discord.Guild,
+    references: Cache,
+):
+    """Request every member the messages refer to which the library has not cached, 100 per gateway request.
+    Results are cached by the library, so mentions resolve too, and seeded in to the cache of gather_member.
+    If the gateway is unavailable the members keep being fetched one by one as they are rendered."""
+    user_ids = set()
+    for record in records:
+        user_ids.update(
+            user_id
+            for user_id in _referenced_user_ids(record, references)
+            if isinstance(user_id, int)
+        )
+    user_ids = sorted(user_id for user_id in user_ids if not guild.get_member(user_id))
+
+    storage = current_cache()
+    for i in range(0, len(user_ids), MEMBER_REQUEST_SIZE):
+        chunk = user_ids[i : i + MEMBER_REQUEST_SIZE]
+        try:
+            members = await guild.query_members(user_ids=chunk, limit=MEMBER_REQUEST_SIZE, cache=True)
+        except Exception:
+            return
+
+        found = {member.id: member for member in members}
+        for user_id in chunk:
+            # Users missing from the answer are no longer in the guild, fetching them one by one would fail too
+            storage.set(gather_member.make_key(guild, user_id), found.get(user_id))
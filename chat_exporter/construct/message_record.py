@@ -0,0 +1,208 @@
+from datetime import datetime, timedelta
+from typing import Any, NamedTuple, Optional, Tuple
+
+from chat_exporter.ext.discord_import import discord
+
+
+class AuthorRecord(NamedTuple):
+    """The fields of a user shown beside their messages and in the participant list."""
+
+    id: int
+    name: str
+    discriminator: str
+    display_name: str
+    display_avatar: Optional[str] = None
+    bot: bool = False
+    verified_bot: bool = False
+    created_at: Optional[datetime] = None
+    joined_at: Optional[datetime] = None
+
+
+class AttachmentRecord(NamedTuple):
+    """
+    The fields of an attachment which are rendered. `state` is the connection of the client the
+    message came from, shared by all of its messages, which `to_attachment` needs for downloads.
+    """
+
+    id: int
+    filename: str
+    url: str
+    proxy_url: str
+    size: int
+    content_type: Optional[str] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+    description: Optional[str] = None
+    spoiler: bool = False
+    state: Any = None
+
+    def to_attachment(self) -> discord.Attachment:
+        """The attachment as the library object, which is what attachment handlers take."""
+        data = {
+            "id": self.id,
+            "filename": self.filename,
+            "url": self.url,
+            "proxy_url": self.proxy_url,
+            "size": self.size,
+            "content_type": self.content_type,
+            "width": self.width,
+            "height": self.height,
+            "description": self.description,
+        }
+        return discord.Attachment(data=data, state=self.state)
+
+
+class ReactionRecord(NamedTuple):
+    emoji: str
+    count: int
+
+
+class InteractionRecord(NamedTuple):
+    """The command a message answers and the user who used it."""
+
+    id: int
+    command: str
+    user: AuthorRecord
+
+
+class SnapshotRecord(NamedTuple):
+    """A forwarded message, rendered inside the message which forwards it."""
+
+    content: Optional[str] = None
+    embeds: Tuple[Any, ...] = ()
+    attachments: Tuple[AttachmentRecord, ...] = ()
+    components: Tuple[Any, ...] = ()
+    stickers: Tuple[Any, ...] = ()
+
+
+class MessageRecord(NamedTuple):
+    """
+    Everything a message is rendered from. Taken as the message is received, so rendering never
+    changes the message it was given, and the message itself need not be kept while it is rendered.
+
+    Embeds, components and stickers are kept as the library objects, which hold their own data and
+    no reference to the message. Everything else is copied in to the records above, attachments are
+    turned back in to `discord.Attachment` only for the attachment handler.
+    A record with only the first fields is enough to decide the group of the message after it.
+    """
+
+    id: int
+    type: Any
+    author_id: int
+    created_at: datetime
+    edited_at: Optional[datetime] = None
+    webhook_id: Optional[int] = None
+    reference_id: Optional[int] = None
+    content: str = ""
+    author: Optional[AuthorRecord] = None
+    interaction: Optional[InteractionRecord] = None
+    # The user added or removed by a recipient message
+    recipient: Optional[AuthorRecord] = None
+    embeds: Tuple[Any, ...] = ()
+    attachments: Tuple[AttachmentRecord, ...] = ()
+    components: Tuple[Any, ...] = ()
+    reactions: Tuple[ReactionRecord, ...] = ()
+    stickers: Tuple[Any, ...] = ()
+    snapshots: Tuple[SnapshotRecord, ...] = ()
+
+
+def author_record(user) -> AuthorRecord:
+    avatar = user.display_avatar
+    return AuthorRecord(
+        id=user.id,
+        name=user.name,
+        discriminator=user.discriminator,
+        display_name=user.display_name,
+        display_avatar=str(avatar) if avatar else None,
+        bot=user.bot,
+        verified_bot=bool(user.bot and user.public_flags.verified_bot),
+        created_at=user.created_at,
+        joined_at=getattr(user, "joined_at", None),
+    )
+
+
+def attachment_record(attachment: discord.Attachment, state=None) -> AttachmentRecord:
+    return AttachmentRecord(
+        id=attachment.id,
+        filename=attachment.filename,
+        url=attachment.url,
+        proxy_url=attachment.proxy_url,
+        size=attachment.size,
+        content_type=attachment.content_type,
+        width=getattr(attachment, "width", None),
+        height=getattr(attachment, "height", None),
+        description=getattr(attachment, "description", None),
+        spoiler=bool(attachment.is_spoiler()),
+        state=state,
+    )
+
+
+def interaction_record(message: discord.Message) -> Optional[InteractionRecord]:
+    if hasattr(message, "interaction_metadata"):
+        if not message.interaction_metadata:
+            return None
+        interaction = message.interaction_metadata
+        command = "a slash command"
+    elif message.interaction:
+        interaction = message.interaction
+        command = f"/{interaction.name}"
+    else:
+        return None
+    return InteractionRecord(id=interaction.id, command=command, user=author_record(interaction.user))
+
+
+def snapshot_record(snapshot, state=None) -> SnapshotRecord:
+    return SnapshotRecord(
+        content=getattr(snapshot, "content", None),
+        embeds=tuple(getattr(snapshot, "embeds", ())),
+        attachments=tuple(attachment_record(a, state) for a in getattr(snapshot, "attachments", ())),
+        components=tuple(getattr(snapshot, "components", ())),
+        stickers=tuple(getattr(snapshot, "stickers", None) or ()),
+    )
+
+
+def message_snapshots(message: discord.Message) -> list:
+    if hasattr(message, "message_snapshots"):
+        return message.message_snapshots
+    elif hasattr(message, "snapshots"):
+        return message.snapshots
+    return []
+
+
+def message_record(message: discord.Message) -> MessageRecord:
+    reference = message.reference
+    state = getattr(message, "_state", None)
+    recipient = None
+    if message.type in (discord.MessageType.recipient_add, discord.MessageType.recipient_remove):
+        recipient = author_record(message.mentions[0])
+    return MessageRecord(
+        id=message.id,
+        type=message.type,
+        author_id=message.author.id,
+        created_at=message.created_at,
+        edited_at=message.edited_at,
+        webhook_id=message.webhook_id,
+        reference_id=reference.message_id if reference else None,
+        content=message.content,
+        author=author_record(message.author),
+        interaction=interaction_record(message),
+        recipient=recipient,
+        embeds=tuple(message.embeds),
+        attachments=tuple(attachment_record(a, state) for a in message.attachments),
+        components=tuple(message.components),
+        reactions=tuple(ReactionRecord(str(r.emoji), r.count) for r in message.reactions),
+        stickers=tuple(message.stickers or ()),
+        snapshots=tuple(snapshot_record(s, state) for s in message_snapshots(message)),
+    )
+
+
+def starts_group(previous: Optional[MessageRecord], record: MessageRecord) -> bool:
+    """Whether the message starts a new message group, as far as the records tell. A rendered reference
+    or interaction starts one as well."""
+    return bool(
+        previous is None
+        or previous.type is not discord.MessageType.default
+        or previous.author_id != record.author_id
+        or record.webhook_id is not None
+        or record.created_at > previous.created_at + timedelta(minutes=4)
+    )
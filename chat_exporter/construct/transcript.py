@@ -1,15 +1,21 @@
+import asyncio
 import html
+import inspect
 import re
+import tempfile
 import traceback
+from concurrent.futures import Executor
+from contextlib import asynccontextmanager
 from datetime import datetime
-from typing import List, Optional
+from typing import AsyncIterator, List, Optional
 
+import aiohttp
 import pytz
 
-from chat_exporter.construct.assets.component import Component
 from chat_exporter.construct.attachment_handler import AttachmentHandler
-from chat_exporter.construct.message import gather_messages
-from chat_exporter.ext.cache import clear_cache
+from chat_exporter.construct.checkpoint import Checkpoint, describe_message
+from chat_exporter.construct.message import gather_messages, iter_messages
+from chat_exporter.ext.cache import Cache, use_cache
 from chat_exporter.ext.discord_import import discord
 from chat_exporter.ext.discord_utils import DiscordUtils
 from chat_exporter.ext.html_generator import (
@@ -20,9 +26,16 @@ from chat_exporter.ext.html_generator import (
     fancy_time,
     fill_out,
     meta_data_temp,
-    total,
+    render,
+    resolve,
+    total_head,
+    total_tail,
 )
-from chat_exporter.parse.markdown import pass_bot
+from chat_exporter.ext.http_session import use_session
+from chat_exporter.ext.render_context import RenderContext, use_context
+
+# Characters copied from the spooled messages to the sink at a time
+SINK_CHUNK_SIZE = 64 * 1024
 
 
 class TranscriptDAO:
@@ -42,6 +55,13 @@ class TranscriptDAO:
         bot: Optional[discord.Client],
         attachment_handler: Optional[AttachmentHandler],
         raise_exceptions: bool = False,
+        concurrency: int = 1,
+        cache: Optional[Cache] = None,
+        prefetch_members: bool = False,
+        history_slices: int = 1,
+        session: Optional[aiohttp.ClientSession] = None,
+        attachment_concurrency: int = 1,
+        render_executor: Optional[Executor] = None,
     ):
         self.channel = channel
         self.messages = messages
@@ -54,36 +74,161 @@ class TranscriptDAO:
         self.pytz_timezone = pytz_timezone
         self.attachment_handler = attachment_handler
         self.raise_exceptions = raise_exceptions
+        self.concurrency = concurrency
+        self.prefetch_members = prefetch_members
+        self.history_slices = history_slices
+        self.attachment_concurrency = attachment_concurrency
+        self.render_executor = render_executor
+        # A cache of its own unless one is passed in to share between exports
+        self.cache = cache if cache is not None else Cache()
+        self.session = session
+        self._transcript_replacements: Optional[dict] = None
+        self.checkpoint: Optional[Checkpoint] = None
+        # Messages rendered by earlier runs of an incremental export
+        self.previous_message_count = 0
+        # Messages read from the history by a streamed export, which never holds them as a list
+        self.streamed_message_count = 0
 
-        # This is to pass timezone in to mention.py without rewriting
-        setattr(discord.Guild, "timezone", self.pytz_timezone)
+        self.render_context = RenderContext(self.pytz_timezone, bot)
 
-        if bot:
-            pass_bot(bot)
+    @asynccontextmanager
+    async def export_scope(self):
+        """Bind the cache, HTTP session and render context to everything rendered within the block."""
+        with use_cache(self.cache), use_context(self.render_context):
+            async with use_session(self.session):
+                yield
 
     async def build_transcript(self):
-        message_html, meta_data = await gather_messages(
-            self.messages, self.channel.guild, self.pytz_timezone, self.military_time, self.attachment_handler
-        )
-        await self.export_transcript(message_html, meta_data)
-        clear_cache()
-        Component.menu_div_id = 0
+        async with self.export_scope():
+            message_html, meta_data = await gather_messages(
+                self.messages,
+                self.channel.guild,
+                self.pytz_timezone,
+                self.military_time,
+                self.attachment_handler,
+                self.concurrency,
+                self.prefetch_members,
+                attachment_concurrency=self.attachment_concurrency,
+                render_executor=self.render_executor,
+            )
+            await self.export_transcript(message_html, meta_data)
         return self
 
-    async def export_transcript(self, message_html: str, meta_data: str):
-        guild_icon = (
-            self.channel.guild.icon
-            if (self.channel.guild.icon and len(self.channel.guild.icon) > 2)
-            else DiscordUtils.default_avatar
-        )
+    async def stream_transcript(self, sink):
+        """Render the messages as they are read from the history and write the transcript to the sink.
+        The head shows how many messages there are, so the rendered messages are spooled to a temporary file
+        until the history is read. Neither the messages nor their HTML are held in memory as a whole."""
+        async with self.export_scope():
+            meta_data: dict = {}
+            with tempfile.TemporaryFile("w+", encoding="utf-8") as body:
+                async for message_html in iter_messages(
+                    self.stream_history(),
+                    self.channel.guild,
+                    self.pytz_timezone,
+                    self.military_time,
+                    self.attachment_handler,
+                    meta_data,
+                    self.concurrency,
+                    self.prefetch_members,
+                    attachment_concurrency=self.attachment_concurrency,
+                    render_executor=self.render_executor,
+                ):
+                    body.write(message_html)
 
-        guild_name = html.escape(self.channel.guild.name)
+                await _write_to_sink(sink, await self.export_head())
+                body.seek(0)
+                for chunk in iter(lambda: body.read(SINK_CHUNK_SIZE), ""):
+                    await _write_to_sink(sink, chunk)
+            await _write_to_sink(sink, await self.export_tail(meta_data))
+        return self
+
+    async def stream_history(self) -> AsyncIterator[discord.Message]:
+        """The messages to export oldest first, read from the channel as they are rendered."""
+        if self.messages:
+            # Passed in, so already held, only put in order
+            await self.fetch_messages()
+            for message in self.messages:
+                yield message
+            return
+
+        after = self.after
+        if self.limit is not None and after is None:
+            # The latest messages are wanted, but Discord pages them newest first. They are walked once for
+            # the oldest of them, keeping nothing else, and read oldest first from there.
+            oldest = None
+            async for message in self.channel.history(limit=self.limit, before=self.before):
+                oldest = message.id
+            if oldest is None:
+                return
+            after = discord.Object(id=oldest - 1)
+
+        async for message in self.channel.history(
+            limit=self.limit,
+            before=self.before,
+            after=after,
+            oldest_first=True,
+        ):
+            self.streamed_message_count += 1
+            yield message
+
+    async def build_incremental_transcript(self, checkpoint: Optional[Checkpoint]):
+        """Render only the messages after the checkpoint and splice them on to the messages it stored."""
+        if checkpoint is None:
+            checkpoint = Checkpoint(self.channel.id, self.checkpoint_options())
+
+        self.render_context.menu_div_id = checkpoint.menu_div_id
+        self.previous_message_count = checkpoint.message_count
+        meta_data = checkpoint.meta_data
+        async with self.export_scope():
+            chunks = [checkpoint.messages_html]
+            async for message_html in iter_messages(
+                self.messages,
+                self.channel.guild,
+                self.pytz_timezone,
+                self.military_time,
+                self.attachment_handler,
+                meta_data,
+                self.concurrency,
+                self.prefetch_members,
+                checkpoint.previous_message_stub(),
+                attachment_concurrency=self.attachment_concurrency,
+                render_executor=self.render_executor,
+            ):
+                chunks.append(message_html)
+            await self.export_transcript("".join(chunks), meta_data)
+
+        # The last chunk closes the last message group, which the next run may still add to
+        if self.messages:
+            checkpoint.last_message_id = self.messages[-1].id
+            checkpoint.previous_message = describe_message(self.messages[-1])
+        checkpoint.message_count += len(self.messages)
+        checkpoint.messages_html = "".join(chunks[:-1])
+        checkpoint.menu_div_id = self.render_context.menu_div_id
+        self.checkpoint = checkpoint
+        return self
+
+    @property
+    def message_count(self) -> int:
+        messages = len(self.messages) if self.messages is not None else self.streamed_message_count
+        return self.previous_message_count + messages
+
+    def checkpoint_options(self) -> dict:
+        return {"timezone": self.pytz_timezone, "military_time": self.military_time}
+
+    async def export_transcript(self, message_html: str, meta_data: dict):
+        self.html = await self.export_head() + message_html.strip() + await self.export_tail(meta_data)
+
+    async def export_head(self):
+        return render(total_head, await self._resolve_transcript_replacements())
 
+    async def export_tail(self, meta_data: dict):
+        resolved = await self._resolve_transcript_replacements()
+        resolved["META_DATA"] = (await self._build_meta_data_html(meta_data)).strip()
+        resolved["MESSAGE_PARTICIPANTS"] = str(len(meta_data))
+        return render(total_tail, resolved)
+
+    async def _build_meta_data_html(self, meta_data: dict):
         timezone = pytz.timezone(self.pytz_timezone)
-        if self.military_time:
-            time_now = datetime.now(timezone).strftime("%e %B %Y at %H:%M:%S (%Z)")
-        else:
-            time_now = datetime.now(timezone).strftime("%e %B %Y at %I:%M:%S %p (%Z)")
 
         meta_data_html_chunks: List[str] = []
         for data in meta_data:
@@ -109,7 +254,7 @@ class TranscriptDAO:
                         ("BOT", str(meta_data[int(data)][2]), PARSE_MODE_NONE),
                         ("CREATED_AT", str(creation_time), PARSE_MODE_NONE),
                         ("JOINED_AT", str(joined_time), PARSE_MODE_NONE),
-                        ("GUILD_ICON", str(guild_icon), PARSE_MODE_NONE),
+                        ("GUILD_ICON", str(self._guild_icon()), PARSE_MODE_NONE),
                         ("DISCORD_ICON", str(DiscordUtils.logo), PARSE_MODE_NONE),
                         ("MEMBER_ID", str(data), PARSE_MODE_NONE),
                         ("USER_AVATAR", str(meta_data[int(data)][3]), PARSE_MODE_NONE),
@@ -119,7 +264,28 @@ class TranscriptDAO:
                 )
             )
 
-        meta_data_html = "".join(meta_data_html_chunks)
+        return "".join(meta_data_html_chunks)
+
+    def _guild_icon(self):
+        return (
+            self.channel.guild.icon
+            if (self.channel.guild.icon and len(self.channel.guild.icon) > 2)
+            else DiscordUtils.default_avatar
+        )
+
+    async def _resolve_transcript_replacements(self) -> dict:
+        # The head and the tail of the transcript share these, so they are only resolved once
+        if self._transcript_replacements is not None:
+            return dict(self._transcript_replacements)
+
+        guild_icon = self._guild_icon()
+        guild_name = html.escape(self.channel.guild.name)
+
+        timezone = pytz.timezone(self.pytz_timezone)
+        if self.military_time:
+            time_now = datetime.now(timezone).strftime("%e %B %Y at %H:%M:%S (%Z)")
+        else:
+            time_now = datetime.now(timezone).strftime("%e %B %Y at %I:%M:%S %p (%Z)")
 
         if self.military_time:
             channel_creation_time = self.channel.created_at.astimezone(timezone).strftime("%b %d, %Y (%H:%M:%S)")
@@ -170,33 +336,76 @@ class TranscriptDAO:
                 [("TIME_FORMAT", time_format, PARSE_MODE_NONE), ("TIMEZONE", str(self.pytz_timezone), PARSE_MODE_NONE)],
             )
 
-        self.html = await fill_out(
+        self._transcript_replacements = await resolve(
             self.channel.guild,
-            total,
             [
                 ("SERVER_NAME", f"{guild_name}"),
                 ("GUILD_ID", str(self.channel.guild.id), PARSE_MODE_NONE),
                 ("SERVER_AVATAR_URL", str(guild_icon), PARSE_MODE_NONE),
                 ("CHANNEL_NAME", f"{self.channel.name}"),
-                ("MESSAGE_COUNT", str(len(self.messages)), PARSE_MODE_NONE),
-                ("MESSAGES", message_html, PARSE_MODE_NONE),
-                ("META_DATA", meta_data_html, PARSE_MODE_NONE),
+                ("MESSAGE_COUNT", str(self.message_count), PARSE_MODE_NONE),
                 ("DATE_TIME", str(time_now)),
                 ("SUBJECT", subject, PARSE_MODE_NONE),
                 ("CHANNEL_CREATED_AT", str(channel_creation_time), PARSE_MODE_NONE),
                 ("CHANNEL_TOPIC", str(channel_topic_html), PARSE_MODE_NONE),
                 ("CHANNEL_ID", str(self.channel.id), PARSE_MODE_NONE),
-                ("MESSAGE_PARTICIPANTS", str(len(meta_data)), PARSE_MODE_NONE),
                 ("FANCY_TIME", _fancy_time, PARSE_MODE_NONE),
                 ("SD", sd, PARSE_MODE_NONE),
                 ("SERVER_NAME_SAFE", f"{guild_name}", PARSE_MODE_HTML_SAFE),
                 ("CHANNEL_NAME_SAFE", f"{html.escape(self.channel.name)}", PARSE_MODE_HTML_SAFE),
             ],
         )
+        return dict(self._transcript_replacements)
 
 
 class Transcript(TranscriptDAO):
     async def export(self):
+        await self.fetch_messages()
+
+        try:
+            return await super().build_transcript()
+        except Exception:
+            self.html = "Whoops! Something went wrong..."
+            traceback.print_exc()
+            print("Please send a screenshot of the above error to https://www.github.com/mahtoid/DiscordChatExporterPy")
+            if self.raise_exceptions:
+                raise
+            return self
+
+    async def export_to(self, sink) -> bool:
+        try:
+            await super().stream_transcript(sink)
+        except Exception:
+            traceback.print_exc()
+            print("Please send a screenshot of the above error to https://www.github.com/mahtoid/DiscordChatExporterPy")
+            if self.raise_exceptions:
+                raise
+            return False
+        return True
+
+    async def export_incremental(self, checkpoint: Optional[Checkpoint]):
+        if checkpoint is not None and not checkpoint.matches(self.channel.id, self.checkpoint_options()):
+            checkpoint = None
+        if checkpoint is not None and checkpoint.last_message_id is not None:
+            self.after = discord.Object(id=checkpoint.last_message_id)
+        await self.fetch_messages()
+
+        try:
+            return await super().build_incremental_transcript(checkpoint)
+        except Exception:
+            self.html = "Whoops! Something went wrong..."
+            traceback.print_exc()
+            print("Please send a screenshot of the above error to https://www.github.com/mahtoid/DiscordChatExporterPy")
+            if self.raise_exceptions:
+                raise
+            return self
+
+    async def fetch_messages(self):
+        if not self.messages and self.limit is None and self.history_slices > 1:
+            # Slices are merged oldest first already
+            self.messages = await self.fetch_history_slices()
+            return
+
         if not self.messages:
             self.messages = [
                 message
@@ -208,14 +417,43 @@ class Transcript(TranscriptDAO):
             ]
 
         if not self.after:
-            self.messages.reverse()
+            self.messages = self.messages[::-1]
 
-        try:
-            return await super().build_transcript()
-        except Exception:
-            self.html = "Whoops! Something went wrong..."
-            traceback.print_exc()
-            print("Please send a screenshot of the above error to https://www.github.com/mahtoid/DiscordChatExporterPy")
-            if self.raise_exceptions:
-                raise
-            return self
+    async def fetch_history_slices(self) -> List[discord.Message]:
+        """Split the channel's snowflake range in to `history_slices` parts and page through them at the same time.
+        The library's rate limiter keeps the parallel requests within Discord's limits."""
+        # Forum posts share their id with their first message, so start just before the channel
+        lower = _to_snowflake(self.after, high=True) if self.after else self.channel.id - 1
+        upper = _to_snowflake(self.before, high=False) if self.before else _to_snowflake(discord.utils.utcnow(), True)
+        if upper <= lower + 1:
+            return []
+
+        slices = min(self.history_slices, upper - lower - 1)
+        edges = [lower + 1 + (upper - lower - 1) * i // slices for i in range(slices + 1)]
+
+        async def fetch_slice(start: int, end: int) -> List[discord.Message]:
+            return [
+                message
+                async for message in self.channel.history(
+                    limit=None,
+                    after=discord.Object(id=start - 1),
+                    before=discord.Object(id=end),
+                    oldest_first=True,
+                )
+            ]
+
+        parts = await asyncio.gather(*(fetch_slice(start, end) for start, end in zip(edges, edges[1:])))
+        return [message for part in parts for message in part]
+
+
+def _to_snowflake(value, high: bool) -> int:
+    if isinstance(value, datetime):
+        return discord.utils.time_snowflake(value, high=high)
+    return value.id
+
+
+async def _write_to_sink(sink, data: str):
+    # Sinks can be a plain file-like object or one with an async ``write`` (e.g. aiofiles)
+    result = sink.write(data)
+    if inspect.isawaitable(result):
+        await result
@@ -1,60 +1,188 @@
+import asyncio
+import threading
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
 from functools import wraps
-from typing import Any, Dict, Tuple
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
 
-_internal_cache: dict = {}
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
 
+_MISSING = object()
 
-def _wrap_and_store_coroutine(cache, key, coro):
-    async def func():
-        value = await coro
-        cache[key] = value
-        return value
 
-    return func()
+class Cache:
+    """Holds the lookups made while rendering, each export binds its own so exports never evict each other."""
+
+    maxsize: Optional[int] = None
 
+    def __init__(self):
+        self._data: Dict[Any, Any] = {}
+        self.hits = 0
+        self.misses = 0
 
-def _wrap_new_coroutine(value):
-    async def new_coroutine():
+    def get(self, key, default=None):
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.hits += 1
         return value
 
-    return new_coroutine()
+    def set(self, key, value):
+        self._data[key] = value
+
+    def peek(self, key, default=None):
+        """Look up an entry without counting it as a hit or miss."""
+        return self._data.get(key, default)
+
+    def pop(self, key, default=None):
+        return self._data.pop(key, default)
+
+    def clear(self):
+        self._data.clear()
+
+    def info(self) -> CacheInfo:
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._data))
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+class LRUCache(Cache):
+    """A bounded cache which can be shared by many exports on the same event loop.
+    Once full, the least recently used entries are evicted.
+
+    :param maxsize: integer - the entries kept at most
+    :param lock: boolean - guard every call with a lock, for a cache which threads use as well
+    """
+
+    def __init__(self, maxsize: int = 4096, lock: bool = False):
+        super().__init__()
+        self.maxsize = maxsize
+        self._data: "OrderedDict[Any, Any]" = OrderedDict()
+        self._lock = threading.Lock() if lock else nullcontext()
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = super().get(key, _MISSING)
+            if value is _MISSING:
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def peek(self, key, default=None):
+        with self._lock:
+            return super().peek(key, default)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return super().pop(key, default)
 
+    def clear(self):
+        with self._lock:
+            super().clear()
 
-def clear_cache():
-    _internal_cache.clear()
 
+_current_cache = ContextVar("chat_exporter_cache", default=None)
+
+
+def current_cache() -> Cache:
+    """The cache bound to the running export. Outside of one nothing is cached, so nothing outlives the call."""
+    storage = _current_cache.get()
+    return storage if storage is not None else Cache()
+
+
+def has_cache() -> bool:
+    return _current_cache.get() is not None
+
+
+@contextmanager
+def use_cache(storage: Cache):
+    """Bind the cache to everything rendered within the block, including tasks started from it."""
+    token = _current_cache.set(storage)
+    try:
+        yield storage
+    finally:
+        _current_cache.reset(token)
+
+
+def _store_future(cache, key, coro):
+    # Concurrent callers with the same key await this one task instead of starting their own
+    future = asyncio.ensure_future(coro)
+    cache.set(key, future)
+
+    def done(fut):
+        if cache.peek(key) is not fut:
+            return
+        if fut.cancelled() or fut.exception() is not None:
+            # Never cache a failure, the next caller should try again
+            cache.pop(key)
+        else:
+            cache.set(key, fut.result())
+
+    future.add_done_callback(done)
+    return future
+
+
+def _identity(o):
+    if o is None or isinstance(o, (str, int, float, bool, bytes)):
+        return o
+    if o.__class__.__repr__ is object.__repr__:
+        # this is how MessageConstruct can retain
+        # caching across multiple instances
+        return o.__class__
+    object_id = getattr(o, "id", None)
+    if isinstance(object_id, int):
+        # Discord models are identified by their snowflake, no need to format their whole repr
+        return o.__class__, object_id
+    return repr(o)
+
+
+def cache(key: Optional[Callable[..., Hashable]] = None):
+    """
+    Cache the result of a coroutine function for the export it is called in.
+
+    :param key: (optional) callable taking the same arguments as the function and returning
+        what identifies a call, e.g. `lambda self, author: author.id`
+    """
 
-def cache():
     def decorator(func):
-        def _make_key(args: Tuple[Any, ...], kwargs: Dict[str, Any]) -> str:
-            def _true_repr(o):
-                if o.__class__.__repr__ is object.__repr__:
-                    # this is how MessageConstruct can retain
-                    # caching across multiple instances
-                    return f"<{o.__class__.__module__}.{o.__class__.__name__}>"
-                return repr(o)
-
-            key = [f"{func.__module__}.{func.__name__}"]
-            key.extend(_true_repr(o) for o in args)
-            for k, v in kwargs.items():
-                key.append(_true_repr(k))
-                key.append(_true_repr(v))
-
-            return ":".join(key)
+        name = f"{func.__module__}.{func.__qualname__}"
+
+        def _make_key(*args, **kwargs) -> Tuple[Hashable, ...]:
+            if key is not None:
+                return name, key(*args, **kwargs)
+            return (
+                name,
+                *(_identity(o) for o in args),
+                *((k, _identity(v)) for k, v in kwargs.items()),
+            )
 
         @wraps(func)
-        def wrapper(*args, **kwargs):
-            key = _make_key(args, kwargs)
-            try:
-                value = _internal_cache[key]
-            except KeyError:
-                value = func(*args, **kwargs)
-                return _wrap_and_store_coroutine(_internal_cache, key, value)
-            else:
-                return _wrap_new_coroutine(value)
-
-        wrapper.cache = _internal_cache
-        wrapper.clear_cache = _internal_cache.clear()
+        async def wrapper(*args, **kwargs):
+            storage = current_cache()
+            cache_key = _make_key(*args, **kwargs)
+            value = storage.get(cache_key, _MISSING)
+            if value is _MISSING:
+                value = _store_future(storage, cache_key, func(*args, **kwargs))
+            if isinstance(value, asyncio.Future):
+                # Shielded so one cancelled caller does not cancel the lookup for everyone waiting on it
+                return await asyncio.shield(value)
+            return value
+
+        wrapper.make_key = _make_key
         return wrapper
 
     return decorator
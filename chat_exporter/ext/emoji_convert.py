@@ -29,25 +29,27 @@
 #                                                                                #
 # Github: https://github.com/glasnt/emojificate                                  #
 ##################################################################################
+import re
 import unicodedata
+from functools import lru_cache
 
-import aiohttp
 import emoji
 from grapheme import graphemes
 
-from chat_exporter.ext.cache import cache
+from chat_exporter.ext.twemoji_index import codepoint, load_index
 
 cdn_fmt = "https://cdn.jsdelivr.net/gh/jdecked/twemoji@latest/assets/72x72/{codepoint}.png"
 
+# Every codepoint sequence with an asset on the CDN, so no request is needed to check an emoji
+twemoji_codepoints = load_index()
 
-@cache()
-async def valid_src(src):
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(src) as resp:
-                return resp.status == 200
-    except aiohttp.ClientConnectorError:
-        return False
+# Emoji are never plain ASCII. The character before a run is taken along as keycaps start with one,
+# and it decides where the first grapheme of the run starts.
+EMOJI_RUN = re.compile(r"[\x00-\x7f]?[^\x00-\x7f]+")
+
+
+def valid_codepoint(code):
+    return code in twemoji_codepoints
 
 
 def valid_category(char):
@@ -57,14 +59,8 @@ def valid_category(char):
         return False
 
 
-async def codepoint(codes):
-    # See https://github.com/twitter/twemoji/issues/419#issuecomment-637360325
-    if "200d" not in codes:
-        return "-".join([c for c in codes if c != "fe0f"])
-    return "-".join(codes)
-
-
-async def convert(char):
+@lru_cache(maxsize=4096)
+def convert_grapheme(char):
     if valid_category(char):
         name = unicodedata.name(char).title()
     else:
@@ -74,16 +70,27 @@ async def convert(char):
             shortcode = emoji.demojize(char)
             name = shortcode.replace(":", "").replace("_", " ").replace("selector", "").title()
 
-    src = cdn_fmt.format(codepoint=await codepoint(["{cp:x}".format(cp=ord(c)) for c in char]))
+    code = codepoint(["{cp:x}".format(cp=ord(c)) for c in char])
 
-    if await valid_src(src):
+    if valid_codepoint(code):
+        src = cdn_fmt.format(codepoint=code)
         return f'<img class="emoji emoji--small" src="{src}" alt="{char}" title="{name}" aria-label="Emoji: {name}">'
     else:
         return char
 
 
+def convert_run(run):
+    return "".join(convert_grapheme(ch) for ch in graphemes(run))
+
+
+def emojify(string):
+    """Swap every emoji in the string for its twemoji image, ASCII text in between is skipped over in bulk."""
+    return EMOJI_RUN.sub(lambda match: convert_run(match.group(0)), string)
+
+
+async def convert(char):
+    return convert_grapheme(char)
+
+
 async def convert_emoji(string):
-    x = []
-    for ch in graphemes(string):
-        x.append(await convert(ch))
-    return "".join(x)
+    return emojify("".join(string))
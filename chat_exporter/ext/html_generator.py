@@ -2,9 +2,9 @@ import html
 import json
 import os
 import re
+from typing import Dict
 
 from chat_exporter.parse.markdown import ParseMarkdown
-from chat_exporter.parse.markdown import bot as mention_bot
 
 dir_path = os.path.abspath(os.path.join((os.path.dirname(os.path.realpath(__file__))), ".."))
 
@@ -17,8 +17,27 @@ PARSE_MODE_REFERENCE = 5
 PARSE_MODE_EMOJI = 6
 PARSE_MODE_HTML_SAFE = 7
 
+# Printable ASCII without anything that could start markdown, a mention or an emoji. Ids, times, colours and
+# most names are like this, and every flow would return them unchanged.
+PLAIN_TEXT = re.compile(r"[ !\"#$%'()+,\-./0-9:;=?A-Z\\^a-z]*")
+
+
+def is_plain_text(value) -> bool:
+    return (
+        isinstance(value, str)
+        and PLAIN_TEXT.fullmatch(value) is not None
+        and "://" not in value
+        # Headers, subtext and list items only start at the beginning of a line
+        and not value.startswith(("#", "-# "))
+        and not value.lstrip(" ").startswith("- ")
+    )
+
 
 async def fill_out(guild, base, replacements):
+    return render(base, await resolve(guild, replacements))
+
+
+async def resolve(guild, replacements):
     resolved = {}
     for r in replacements:
         if len(r) == 2:  # default case
@@ -27,38 +46,76 @@ async def fill_out(guild, base, replacements):
         else:
             k, v, mode = r
 
+        if mode != PARSE_MODE_HTML_SAFE and is_plain_text(v):
+            mode = PARSE_MODE_NONE
+
         if mode == PARSE_MODE_MARKDOWN:
-            v = await ParseMarkdown(v, guild, mention_bot).standard_message_flow()
+            v = await ParseMarkdown(v, guild).standard_message_flow()
         elif mode == PARSE_MODE_EMBED:
-            v = await ParseMarkdown(v, guild, mention_bot).standard_embed_flow()
+            v = await ParseMarkdown(v, guild).standard_embed_flow()
         elif mode == PARSE_MODE_SPECIAL_EMBED:
-            v = await ParseMarkdown(v, guild, mention_bot).special_embed_flow()
+            v = await ParseMarkdown(v, guild).special_embed_flow()
         elif mode == PARSE_MODE_REFERENCE:
-            v = await ParseMarkdown(v, guild, mention_bot).message_reference_flow()
+            v = await ParseMarkdown(v, guild).message_reference_flow()
         elif mode == PARSE_MODE_EMOJI:
-            v = await ParseMarkdown(v, guild, mention_bot).special_emoji_flow()
+            v = await ParseMarkdown(v, guild).special_emoji_flow()
         elif mode == PARSE_MODE_HTML_SAFE:
-            if mode != PARSE_MODE_NONE:
-                v = await ParseMarkdown(v, guild, mention_bot).standard_embed_flow()
+            if not is_plain_text(v):
+                v = await ParseMarkdown(v, guild).standard_embed_flow()
             # escape html characters
             v = html.escape(v, quote=True)
             # escape characters that could be used for xss
             v = json.dumps(v, ensure_ascii=False)[1:-1]
         elif mode != PARSE_MODE_NONE:
-            v = await ParseMarkdown(v, guild, mention_bot).standard_embed_flow()
+            v = await ParseMarkdown(v, guild).standard_embed_flow()
 
         resolved[k] = str(v or "").strip()
 
-    def repl(match):
-        key = match.group(1)
-        return resolved.get(key, match.group(0))
+    return resolved
+
+
+class Template:
+    """A template split once in to its literal text and {{PLACEHOLDER}} slots.
+    Rendering is a list copy and join, no regex has to run over the template again."""
+
+    __slots__ = ("parts", "slots")
+
+    placeholder = re.compile(r"(\{\{[A-Z0-9_]+\}\})")
+
+    def __init__(self, source: str):
+        # Splitting on a capturing group alternates literal text and placeholders
+        self.parts = self.placeholder.split(source)
+        self.slots = [(i, self.parts[i][2:-2]) for i in range(1, len(self.parts), 2)]
+
+    def render(self, resolved: dict) -> str:
+        parts = self.parts.copy()
+        for i, key in self.slots:
+            value = resolved.get(key)
+            if value is not None:
+                parts[i] = value
+        return "".join(parts)
+
+
+_compiled_templates: Dict[str, Template] = {}
+
+
+def compile_template(base: str) -> Template:
+    template = _compiled_templates.get(base)
+    if template is None:
+        template = _compiled_templates[base] = Template(base)
+    return template
+
 
-    return re.sub(r"\{\{([A-Z0-9_]+)\}\}", repl, base)
+def render(base, resolved):
+    if not isinstance(base, Template):
+        base = compile_template(base)
+    return base.render(resolved)
 
 
 def read_file(filename):
     with open(filename, "r") as f:
         s = f.read()
+    compile_template(s)
     return s
 
 
@@ -122,6 +179,10 @@ video_attachment = read_file(dir_path + "/html/attachment/video.html")
 
 # GUILD / FULL TRANSCRIPT
 total = read_file(dir_path + "/html/base.html")
+# Split around the message list so the transcript can be streamed in three parts
+total_head, total_tail = total.split("{{MESSAGES}}", 1)
+compile_template(total_head)
+compile_template(total_tail)
 
 # SCRIPT
 fancy_time = read_file(dir_path + "/html/script/fancy_time.html")
@@ -0,0 +1,67 @@
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+import aiohttp
+
+# Attachments all come from Discord's CDN, so the per host limit is what bounds an export
+CONNECTION_LIMIT = 100
+CONNECTION_LIMIT_PER_HOST = 10
+DNS_CACHE_SECONDS = 300
+KEEPALIVE_SECONDS = 30
+
+
+def create_session() -> aiohttp.ClientSession:
+    """A session pooling its connections, so requests to the same host reuse the TLS handshake of earlier ones."""
+    connector = aiohttp.TCPConnector(
+        limit=CONNECTION_LIMIT,
+        limit_per_host=CONNECTION_LIMIT_PER_HOST,
+        ttl_dns_cache=DNS_CACHE_SECONDS,
+        keepalive_timeout=KEEPALIVE_SECONDS,
+    )
+    return aiohttp.ClientSession(connector=connector)
+
+
+class _SessionScope:
+    def __init__(self, session: Optional[aiohttp.ClientSession]):
+        self.session = session
+        # Only sessions opened by the scope are closed by it, a passed in one belongs to the caller
+        self.owned = False
+
+    def get(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            # Opened on first use, exports without attachments never make a request of their own
+            self.session = create_session()
+            self.owned = True
+        return self.session
+
+    async def close(self):
+        if self.owned and self.session is not None:
+            await self.session.close()
+
+
+_current_scope = ContextVar("chat_exporter_session", default=None)
+
+
+@asynccontextmanager
+async def use_session(session: Optional[aiohttp.ClientSession] = None):
+    """Share one session between every request made within the block, including tasks started from it."""
+    scope = _SessionScope(session)
+    token = _current_scope.set(scope)
+    try:
+        yield scope
+    finally:
+        _current_scope.reset(token)
+        await scope.close()
+
+
+@asynccontextmanager
+async def http_session():
+    """Yield the session of the running export, or a short-lived one when used outside of an export."""
+    scope = _current_scope.get()
+    if scope is not None:
+        yield scope.get()
+        return
+
+    async with create_session() as session:
+        yield session
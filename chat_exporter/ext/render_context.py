@@ -0,0 +1,55 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+from chat_exporter.ext.discord_import import discord
+
+
+class RenderContext:
+    """
+    The settings and counters of one export, seen by everything it renders.
+    Each export binds its own, so exports running at the same time never see each other's.
+
+    :param timezone: TZ Database Name - the timezone times are shown in
+    :param bot: (optional) discord.Client - used to look up users who are no longer in the guild
+    :param menu_div_id: integer - the id given to the next dropdown menu
+    """
+
+    def __init__(self, timezone: str = "UTC", bot: Optional[discord.Client] = None, menu_div_id: int = 0):
+        self.timezone = timezone
+        self.bot = bot
+        self.menu_div_id = menu_div_id
+        # Markdown rendered ahead of time for this export, by content
+        self.markdown: Dict[str, str] = {}
+
+    def next_menu_id(self) -> int:
+        # Claimed without awaiting, so messages building menus concurrently never share an id
+        menu_id = self.menu_div_id
+        self.menu_div_id += 1
+        return menu_id
+
+    def claim_menu_ids(self, count: int) -> range:
+        """Claim the ids of the next `count` dropdown menus, e.g. for a message before it is rendered."""
+        menu_ids = range(self.menu_div_id, self.menu_div_id + count)
+        self.menu_div_id += count
+        return menu_ids
+
+
+# Used for rendering outside of an export
+_default_context = RenderContext()
+_current_context = ContextVar("chat_exporter_render_context", default=None)
+
+
+def current_context() -> RenderContext:
+    context = _current_context.get()
+    return context if context is not None else _default_context
+
+
+@contextmanager
+def use_context(context: RenderContext):
+    """Bind the context to everything rendered within the block, including tasks started from it."""
+    token = _current_context.set(context)
+    try:
+        yield context
+    finally:
+        _current_context.reset(token)
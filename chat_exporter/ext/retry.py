@@ -0,0 +1,137 @@
+import asyncio
+import random
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+import aiohttp
+
+from chat_exporter.ext.discord_import import discord
+
+# Rate limited, or a server error which is likely gone on the next attempt
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+
+class TokenBucket:
+    """Lets `rate` calls through every `per` seconds, in bursts of up to `rate`."""
+
+    def __init__(self, rate: int, per: float):
+        self.rate = rate
+        self.per = per
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+        self.resume_at = 0.0
+
+    def pause(self, seconds: float):
+        """Hold back every call for the time a 429 asked to wait."""
+        self.resume_at = max(self.resume_at, time.monotonic() + seconds)
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.resume_at:
+                await asyncio.sleep(self.resume_at - now)
+                continue
+
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / self.per)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) * self.per / self.rate)
+
+
+class RetryPolicy:
+    """
+    Retry the calls of an attachment handler which failed on the connection, a rate limit or a server error.
+
+    Attempts are spaced by exponential backoff with full jitter, or by the time the server asked for in
+    its `Retry-After` header. Calls made for the same bucket (e.g. a channel or webhook) are limited to
+    `rate` every `per` seconds, and `max_concurrency` limits the calls running at the same time across
+    every handler sharing the policy.
+
+    :param retries: integer - attempts made after the first one failed
+    :param base_delay: float - seconds waited before the first retry, doubled for every next one
+    :param max_delay: float - the most seconds waited between two attempts
+    :param rate: (optional) integer - calls allowed per bucket every `per` seconds
+    :param per: float - seconds in which `rate` calls are allowed
+    :param max_concurrency: (optional) integer - calls allowed to run at the same time
+    """
+
+    def __init__(
+        self,
+        retries: int = 3,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+        rate: Optional[int] = None,
+        per: float = 1.0,
+        max_concurrency: Optional[int] = None,
+    ):
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.rate = rate
+        self.per = per
+        self.max_concurrency = max_concurrency
+        self._buckets: Dict[Hashable, TokenBucket] = {}
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    async def run(self, func: Callable[..., Awaitable[Any]], *args, bucket: Optional[Hashable] = None, **kwargs):
+        """Await `func(*args, **kwargs)`, calling it again while it fails with an error worth retrying."""
+        limiter = self._bucket(bucket)
+        attempt = 0
+        while True:
+            if limiter is not None:
+                await limiter.acquire()
+            try:
+                if self.max_concurrency is None:
+                    return await func(*args, **kwargs)
+                async with self._limit():
+                    return await func(*args, **kwargs)
+            except Exception as error:
+                if attempt >= self.retries or not is_retryable(error):
+                    raise
+                retry_after = get_retry_after(error)
+                if retry_after is not None and limiter is not None:
+                    limiter.pause(retry_after)
+                delay = retry_after if retry_after is not None else self.backoff(attempt)
+                attempt += 1
+                print(f"Retry {attempt}/{self.retries} | Error - {error!r}, trying again in {delay:.1f}s.")
+                await asyncio.sleep(delay)
+
+    def backoff(self, attempt: int) -> float:
+        # Full jitter, so handlers failing together do not retry together
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))  # noqa: S311
+
+    def _bucket(self, bucket: Optional[Hashable]) -> Optional[TokenBucket]:
+        if bucket is None or self.rate is None:
+            return None
+        if bucket not in self._buckets:
+            self._buckets[bucket] = TokenBucket(self.rate, self.per)
+        return self._buckets[bucket]
+
+    def _limit(self) -> asyncio.Semaphore:
+        # Created on first use, so the policy can be made before the event loop runs
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError)):
+        return True
+    if isinstance(error, (aiohttp.ClientResponseError, discord.HTTPException)):
+        return error.status in RETRY_STATUSES
+    return False
+
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    """The seconds the server asked to wait before the next attempt, if it did."""
+    headers = getattr(error, "headers", None)
+    if headers is None:
+        headers = getattr(getattr(error, "response", None), "headers", None)
+    value = headers.get("Retry-After") if headers else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        # Also allowed to be a date, backing off is close enough then
+        return None
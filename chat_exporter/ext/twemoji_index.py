@@ -0,0 +1,50 @@
+"""
+Builds the bundled index of emoji which have an asset on the twemoji CDN.
+
+The index is shipped with the package so that emoji conversion never has to
+ask the CDN whether an image exists. Regenerate it whenever the twemoji
+version used in `emoji_convert.cdn_fmt` is bumped:
+
+    python -m chat_exporter.ext.twemoji_index
+"""
+
+import os
+
+index_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "twemoji.txt")
+
+# Latest Emoji version with assets in jdecked/twemoji
+TWEMOJI_EMOJI_VERSION = 16.0
+
+# Single regional indicator letters have their own twemoji asset, but are not emoji on their own
+REGIONAL_INDICATORS = range(0x1F1E6, 0x1F1FF + 1)
+
+
+def codepoint(codes):
+    # See https://github.com/twitter/twemoji/issues/419#issuecomment-637360325
+    if "200d" not in codes:
+        return "-".join([c for c in codes if c != "fe0f"])
+    return "-".join(codes)
+
+
+def load_index(path=index_path):
+    with open(path, "r") as f:
+        return frozenset(line.strip() for line in f if line.strip())
+
+
+def build_index():
+    import emoji
+
+    codepoints = {"{cp:x}".format(cp=cp) for cp in REGIONAL_INDICATORS}
+    for char, data in emoji.EMOJI_DATA.items():
+        # Twemoji only ships fully-qualified sequences and components, named by the rule in codepoint()
+        if data["status"] > emoji.STATUS["fully_qualified"] or data["E"] > TWEMOJI_EMOJI_VERSION:
+            continue
+        codepoints.add(codepoint(["{cp:x}".format(cp=ord(c)) for c in char]))
+    return sorted(codepoints)
+
+
+if __name__ == "__main__":
+    index = build_index()
+    with open(index_path, "w") as f:
+        f.write("\n".join(index) + "\n")
+    print(f"Wrote {len(index)} codepoints to {index_path}")
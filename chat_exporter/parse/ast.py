@@ -264,210 +264,194 @@ class TimeMentionNode(Node):
         )
 
 
+TIME_FORMATS = {
+    "t": "%H:%M",
+    "T": "%T",
+    "d": "%d/%m/%Y",
+    "D": "%e %B %Y",
+    "f": "%e %B %Y %H:%M",
+    "F": "%A, %e %B %Y %H:%M",
+    "R": "%e %B %Y %H:%M",
+    None: "%e %B %Y %H:%M",
+}
+
+# Mentions, commands and timestamps as sent by Discord, and once the content has been html escaped
+MENTION = re.compile(
+    r"<#(?P<channel>[0-9]+)>"
+    r"|<@&(?P<role>[0-9]+)>"
+    r"|<@!?(?P<member>[0-9]+)>"
+    r"|<\/(?P<slash>[\w]+ ?[\w]*):[0-9]+>"
+    r"|<t:(?P<time>[0-9]{1,13})(?::(?P<time_format>[tTdDfFR]))?>"
+)
+ESCAPED_MENTION = re.compile(
+    r"&lt;#(?P<channel>[0-9]+)&gt;"
+    r"|&lt;@&amp;(?P<role>[0-9]+)&gt;"
+    r"|&lt;@!?(?P<member>[0-9]+)&gt;"
+    r"|&lt;\/(?P<slash>[\w]+ ?[\w]*):[0-9]+&gt;"
+    r"|&lt;t:(?P<time>[0-9]{1,13})(?::(?P<time_format>[tTdDfFR]))?&gt;"
+)
+EVERYONE = re.compile(r"@(everyone)(?:[$\s\t\n\f\r\0]|$)")
+HERE = re.compile(r"@(here)(?:[$\s\t\n\f\r\0]|$)")
+HEADER = re.compile(r"(#{1,3})\s+")
+LIST_ITEM = re.compile(r"(\s*)([-*])\s+")
+RAW_URL = re.compile(r"https?://[^\s<*\n\)]+")
+# Every character which can start markdown, the text in between is taken as is
+SPECIAL = re.compile(r"[<`*_~|\[h\n&#\-@]")
+
+
 class AstParser:
+    """
+    Parses message content in a single pass over the text.
+
+    Nested markup is parsed by index range rather than by slicing out substrings, and every search for a
+    closing marker is remembered, so no part of the text is scanned more than a few times.
+    """
+
+    def __init__(self):
+        self._found = {}
+
     def parse(self, text: str) -> List[Node]:
         if not text:
             return []
+        self._found = {}
         nodes = self._parse_inline(str(text))
         nodes = self._merge_text_nodes(nodes)
         nodes = self._merge_quote_nodes(nodes)
         nodes = self._merge_list_nodes(nodes)
         return nodes
 
-    def _parse_inline(self, text: str) -> List[Node]:
+    def _find(self, text: str, marker: str, start: int, end: int) -> int:
+        """text.find(marker, start, end), reusing the last search for the marker when it already covers start.
+        Scanning forward for a closer which never comes would otherwise cost the rest of the text every time."""
+        key = (marker, end)
+        last = self._found.get(key)
+        if last is not None and last[0] <= start and (last[1] == -1 or start <= last[1]):
+            return last[1]
+        found = text.find(marker, start, end)
+        self._found[key] = (start, found)
+        return found
+
+    def _parse_inline(self, text: str, start: int = 0, end: int = None) -> List[Node]:
         nodes = []
-        i = 0
-        n = len(text)
+        i = start
+        n = len(text) if end is None else end
 
         while i < n:
-            # Check HTML and Mentions
-            if text[i] == "<" or (text[i : i + 4] == "&lt;"):
-                is_escaped = text[i] == "&"
-
-                # Channel
-                chan_match = re.match(r"&lt;#([0-9]+)&gt;" if is_escaped else r"<#([0-9]+)>", text[i:])
-                if chan_match:
-                    nodes.append(ChannelMentionNode(int(chan_match.group(1))))
-                    i += len(chan_match.group(0))
-                    continue
+            char = text[i]
+            line_start = i == start or text[i - 1] == "\n"
 
-                # Role
-                role_match = re.match(r"&lt;@&amp;([0-9]+)&gt;" if is_escaped else r"<@&([0-9]+)>", text[i:])
-                if role_match:
-                    nodes.append(RoleMentionNode(int(role_match.group(1))))
-                    i += len(role_match.group(0))
-                    continue
-
-                # Member
-                mem_match = re.match(r"&lt;@!?([0-9]+)&gt;" if is_escaped else r"<@!?([0-9]+)>", text[i:])
-                if mem_match:
-                    nodes.append(UserMentionNode(int(mem_match.group(1))))
-                    i += len(mem_match.group(0))
-                    continue
-
-                # Slash Command
-                slash_match = re.match(
-                    r"&lt;\/([\w]+ ?[\w]*):[0-9]+&gt;" if is_escaped else r"<\/([\w]+ ?[\w]*):[0-9]+>",
-                    text[i:],
-                )
-                if slash_match:
-                    nodes.append(SlashCommandNode(slash_match.group(1)))
-                    i += len(slash_match.group(0))
-                    continue
-
-                # Time
-                time_patterns = [
-                    [r"&lt;t:([0-9]{1,13}):t&gt;", "%H:%M"],
-                    [r"&lt;t:([0-9]{1,13}):T&gt;", "%T"],
-                    [r"&lt;t:([0-9]{1,13}):d&gt;", "%d/%m/%Y"],
-                    [r"&lt;t:([0-9]{1,13}):D&gt;", "%e %B %Y"],
-                    [r"&lt;t:([0-9]{1,13}):f&gt;", "%e %B %Y %H:%M"],
-                    [r"&lt;t:([0-9]{1,13}):F&gt;", "%A, %e %B %Y %H:%M"],
-                    [r"&lt;t:([0-9]{1,13}):R&gt;", "%e %B %Y %H:%M"],
-                    [r"&lt;t:([0-9]{1,13})&gt;", "%e %B %Y %H:%M"],
-                ] if is_escaped else [
-                    [r"<t:([0-9]{1,13}):t>", "%H:%M"],
-                    [r"<t:([0-9]{1,13}):T>", "%T"],
-                    [r"<t:([0-9]{1,13}):d>", "%d/%m/%Y"],
-                    [r"<t:([0-9]{1,13}):D>", "%e %B %Y"],
-                    [r"<t:([0-9]{1,13}):f>", "%e %B %Y %H:%M"],
-                    [r"<t:([0-9]{1,13}):F>", "%A, %e %B %Y %H:%M"],
-                    [r"<t:([0-9]{1,13}):R>", "%e %B %Y %H:%M"],
-                    [r"<t:([0-9]{1,13})>", "%e %B %Y %H:%M"],
-                ]
-                time_found = False
-                for pattern, strf in time_patterns:
-                    t_match = re.match(pattern, text[i:])
-                    if t_match:
-                        nodes.append(TimeMentionNode(int(t_match.group(1)), strf, t_match.group(0)))
-                        i += len(t_match.group(0))
-                        time_found = True
-                        break
-                if time_found:
+            # Check HTML and Mentions
+            if char == "<" or (char == "&" and text.startswith("&lt;", i, n)):
+                mention_match = (MENTION if char == "<" else ESCAPED_MENTION).match(text, i, n)
+                if mention_match:
+                    kind = mention_match.lastgroup
+                    if kind == "channel":
+                        nodes.append(ChannelMentionNode(int(mention_match.group("channel"))))
+                    elif kind == "role":
+                        nodes.append(RoleMentionNode(int(mention_match.group("role"))))
+                    elif kind == "member":
+                        nodes.append(UserMentionNode(int(mention_match.group("member"))))
+                    elif kind == "slash":
+                        nodes.append(SlashCommandNode(mention_match.group("slash")))
+                    else:
+                        nodes.append(
+                            TimeMentionNode(
+                                int(mention_match.group("time")),
+                                TIME_FORMATS[mention_match.group("time_format")],
+                                mention_match.group(0),
+                            )
+                        )
+                    i = mention_match.end()
                     continue
 
                 # HTML fallback
-                if text[i] == "<":
-                    tag_match = re.match(r"(<[^>]+>)", text[i:])
-                    if tag_match:
-                        nodes.append(HtmlNode(tag_match.group(1)))
-                        i += len(tag_match.group(1))
+                if char == "<":
+                    endtag = self._find(text, ">", i + 1, n)
+                    if endtag > i + 1:
+                        nodes.append(HtmlNode(text[i : endtag + 1]))
+                        i = endtag + 1
                         continue
 
             # Newline handler (crucial to restart cursor for block elements)
-            if text[i] == "\n":
+            if char == "\n":
                 nodes.append(TextNode("\n"))
                 i += 1
                 continue
 
-            # Code block ```
-            if text[i : i + 3] == "```":
-                endtag = text.find("```", i + 3)
-                if endtag != -1:
-                    inner = text[i + 3 : endtag]
-                    lines = inner.split("\n", 1)
-                    if len(lines) > 1 and " " not in lines[0]:
-                        lang = lines[0]
-                        code = lines[1]
-                    else:
-                        lang = ""
-                        code = inner
-                    if code.startswith("\n"):
-                        code = code[1:]
-                    if code.endswith("\n"):
-                        code = code[:-1]
-                    nodes.append(CodeBlockNode(lang, code))
-                    i = endtag + 3
-                    continue
+            if char == "`":
+                # Code block ```
+                if text.startswith("```", i, n):
+                    endtag = self._find(text, "```", i + 3, n)
+                    if endtag != -1:
+                        inner = text[i + 3 : endtag]
+                        lines = inner.split("\n", 1)
+                        if len(lines) > 1 and " " not in lines[0]:
+                            lang = lines[0]
+                            code = lines[1]
+                        else:
+                            lang = ""
+                            code = inner
+                        if code.startswith("\n"):
+                            code = code[1:]
+                        if code.endswith("\n"):
+                            code = code[:-1]
+                        nodes.append(CodeBlockNode(lang, code))
+                        i = endtag + 3
+                        continue
 
-            # Code block ``
-            if text[i : i + 2] == "``":
-                endtag = text.find("``", i + 2)
-                if endtag != -1:
-                    nodes.append(InlineCodeNode(text[i + 2 : endtag]))
-                    i = endtag + 2
-                    continue
+                # Code block ``
+                if text.startswith("``", i, n):
+                    endtag = self._find(text, "``", i + 2, n)
+                    if endtag != -1:
+                        nodes.append(InlineCodeNode(text[i + 2 : endtag]))
+                        i = endtag + 2
+                        continue
 
-            # Inline code `
-            if text[i] == "`":
-                endtag = text.find("`", i + 1)
+                # Inline code `
+                endtag = self._find(text, "`", i + 1, n)
                 if endtag != -1:
                     nodes.append(InlineCodeNode(text[i + 1 : endtag]))
                     i = endtag + 1
                     continue
 
-            # Bold
-            if text[i : i + 2] == "**":
-                endtag = text.find("**", i + 2)
-                if endtag != -1:
-                    nodes.append(BoldNode(self._parse_inline(text[i + 2 : endtag])))
-                    i = endtag + 2
-                    continue
-
-            # Underline
-            if text[i : i + 2] == "__":
-                endtag = text.find("__", i + 2)
-                if endtag != -1:
-                    nodes.append(UnderlineNode(self._parse_inline(text[i + 2 : endtag])))
-                    i = endtag + 2
-                    continue
-
-            # Strikethrough
-            if text[i : i + 2] == "~~":
-                endtag = text.find("~~", i + 2)
+            # Bold, Underline, Strikethrough and Spoiler
+            if char in "*_~|" and text.startswith(char * 2, i, n):
+                endtag = self._find(text, char * 2, i + 2, n)
                 if endtag != -1:
-                    nodes.append(StrikethroughNode(self._parse_inline(text[i + 2 : endtag])))
+                    node_type = {"*": BoldNode, "_": UnderlineNode, "~": StrikethroughNode, "|": SpoilerNode}[char]
+                    nodes.append(node_type(self._parse_inline(text, i + 2, endtag)))
                     i = endtag + 2
                     continue
 
-            # Spoiler
-            if text[i : i + 2] == "||":
-                endtag = text.find("||", i + 2)
+            # Italic, never the start of an unclosed ** or __
+            if char in "*_" and not text.startswith(char * 2, i, n):
+                endtag = self._find(text, char, i + 1, n)
                 if endtag != -1:
-                    nodes.append(SpoilerNode(self._parse_inline(text[i + 2 : endtag])))
-                    i = endtag + 2
-                    continue
-
-            # Italic 1
-            if text[i] == "*":
-                endtag = text.find("*", i + 1)
-                if endtag != -1 and text[i : i + 2] != "**":
-                    nodes.append(ItalicNode(self._parse_inline(text[i + 1 : endtag])))
-                    i = endtag + 1
-                    continue
-
-            # Italic 2
-            if text[i] == "_":
-                endtag = text.find("_", i + 1)
-                # Ensure it's not part of __ and ideally isolated, but basic parse for discord
-                if endtag != -1 and text[i : i + 2] != "__":
-                    nodes.append(ItalicNode(self._parse_inline(text[i + 1 : endtag])))
+                    nodes.append(ItalicNode(self._parse_inline(text, i + 1, endtag)))
                     i = endtag + 1
                     continue
 
             # Everyone / Here
-            if text[i] == "@":
-                everyone_match = re.match(r"@(everyone)(?:[$\s\t\n\f\r\0]|$)", text[i:])
-                if everyone_match:
+            if char == "@":
+                if EVERYONE.match(text, i, n):
                     nodes.append(EveryoneMentionNode())
                     i += 9  # len("@everyone")
                     continue
-                here_match = re.match(r"@(here)(?:[$\s\t\n\f\r\0]|$)", text[i:])
-                if here_match:
+                if HERE.match(text, i, n):
                     nodes.append(HereMentionNode())
                     i += 5  # len("@here")
                     continue
 
-            # Headers
-            if (i == 0 or text[i - 1] == "\n") and text[i] == "#":
-                level_match = re.match(r"^(#{1,3})\s+", text[i:])
+            if line_start:
+                # Headers
+                level_match = HEADER.match(text, i, n) if char == "#" else None
                 if level_match:
                     level = len(level_match.group(1))
-                    prefix_len = len(level_match.group(0))
-                    endtag = text.find("\n", i + prefix_len)
+                    content_start = level_match.end()
+                    endtag = self._find(text, "\n", content_start, n)
                     if endtag == -1:
                         endtag = n
-                    nodes.append(HeaderNode(level, self._parse_inline(text[i + prefix_len : endtag])))
+                    nodes.append(HeaderNode(level, self._parse_inline(text, content_start, endtag)))
                     # consume the trailing newline if present, DO NOT append it so we don't get <br>
                     if endtag < n:
                         i = endtag + 1
@@ -477,53 +461,48 @@ class AstParser:
                         break
                     continue
 
-            # Subtext
-            if (i == 0 or text[i - 1] == "\n") and text[i : i + 3] == "-# ":
-                endtag = text.find("\n", i + 3)
-                if endtag == -1:
-                    endtag = n
-                nodes.append(SubtextNode(self._parse_inline(text[i + 3 : endtag])))
-                if endtag < n:
-                    nodes.append(TextNode("\n"))
-                    i = endtag + 1
-                else:
-                    break
-                continue
-
-            # Blockquote (>>>)
-            if (
-                (i == 0 or text[i - 1] == "\n") and
-                (text[i : i + 13] == "&gt;&gt;&gt; " or text[i : i + 12] == "&gt;&gt;&gt;")
-            ):
-                prefix_len = 13 if text[i : i + 13] == "&gt;&gt;&gt; " else 12
-                if text[i + prefix_len : i + prefix_len + 4] != "&gt;":
-                    nodes.append(QuoteNode(self._parse_inline(text[i + prefix_len :])))
-                    break
-
-            # Single line quote (>)
-            if (i == 0 or text[i - 1] == "\n") and text[i : i + 5] == "&gt; ":
-                prefix_len = 5
-                endtag = text.find("\n", i + prefix_len)
-                if endtag == -1:
-                    endtag = n
-                nodes.append(QuoteNode(self._parse_inline(text[i + prefix_len : endtag])))
-
-                if endtag < n:
-                    i = endtag + 1
+                # Subtext
+                if text.startswith("-# ", i, n):
+                    endtag = self._find(text, "\n", i + 3, n)
+                    if endtag == -1:
+                        endtag = n
+                    nodes.append(SubtextNode(self._parse_inline(text, i + 3, endtag)))
+                    if endtag < n:
+                        nodes.append(TextNode("\n"))
+                        i = endtag + 1
+                    else:
+                        break
                     continue
-                else:
-                    break
 
-            # Lists
-            if i == 0 or text[i - 1] == "\n":
-                list_match = re.match(r"^(\s*)([-*])\s+", text[i:])
+                # Blockquote (>>>)
+                if text.startswith("&gt;&gt;&gt;", i, n):
+                    prefix_len = 13 if text.startswith("&gt;&gt;&gt; ", i, n) else 12
+                    if not text.startswith("&gt;", i + prefix_len, n):
+                        nodes.append(QuoteNode(self._parse_inline(text, i + prefix_len, n)))
+                        break
+
+                # Single line quote (>)
+                if text.startswith("&gt; ", i, n):
+                    endtag = self._find(text, "\n", i + 5, n)
+                    if endtag == -1:
+                        endtag = n
+                    nodes.append(QuoteNode(self._parse_inline(text, i + 5, endtag)))
+
+                    if endtag < n:
+                        i = endtag + 1
+                        continue
+                    else:
+                        break
+
+                # Lists
+                list_match = LIST_ITEM.match(text, i, n)
                 if list_match:
                     indent = len(list_match.group(1))
-                    prefix_len = len(list_match.group(0))
-                    endtag = text.find("\n", i + prefix_len)
+                    content_start = list_match.end()
+                    endtag = self._find(text, "\n", content_start, n)
                     if endtag == -1:
                         endtag = n
-                    nodes.append(ListItemNode(indent, self._parse_inline(text[i + prefix_len : endtag])))
+                    nodes.append(ListItemNode(indent, self._parse_inline(text, content_start, endtag)))
                     if endtag < n:
                         i = endtag + 1
                     else:
@@ -531,69 +510,51 @@ class AstParser:
                     continue
 
             # Link [text](url)
-            if text[i] == "[":
-                close_bracket = text.find("](", i + 1)
+            if char == "[":
+                close_bracket = self._find(text, "](", i + 1, n)
                 if close_bracket != -1:
-                    end_paren = text.find(")", close_bracket + 2)
+                    end_paren = self._find(text, ")", close_bracket + 2, n)
                     if end_paren != -1:
-                        link_text = text[i + 1 : close_bracket]
                         link_url = text[close_bracket + 2 : end_paren]
-                        nodes.append(LinkNode(link_url, self._parse_inline(link_text)))
+                        nodes.append(LinkNode(link_url, self._parse_inline(text, i + 1, close_bracket)))
                         i = end_paren + 1
                         continue
 
             # Raw HTTP
-            if text[i : i + 4] == "http":
-                match = re.search(r"^https?://[^\s<*\n\)]+", text[i:])
+            if char == "h":
+                match = RAW_URL.match(text, i, n)
                 if match:
                     url = match.group(0)
                     nodes.append(LinkNode(url, [TextNode(url)]))
-                    i += len(url)
+                    i = match.end()
                     continue
 
             # Fallback consume characters to next special marker
-            next_special_options = [
-                text.find("<", i + 1),
-                text.find("`", i + 1),
-                text.find("*", i + 1),
-                text.find("_", i + 1),
-                text.find("~", i + 1),
-                text.find("|", i + 1),
-                text.find("[", i + 1),
-                text.find("h", i + 1),
-                text.find("\n", i + 1),
-                text.find("&", i + 1),
-                text.find("#", i + 1),
-                text.find("-", i + 1),
-                text.find("@", i + 1),
-            ]
-            valid_specials = [pos for pos in next_special_options if pos != -1]
-            next_special = min(valid_specials) if valid_specials else n
-
-            if next_special == i:  # rare edge case fallback
-                nodes.append(TextNode(text[i]))
-                i += 1
-            else:
-                raw_text = text[i:next_special]
-                # small mitigation for missing < inside url but we already parse urls
-                nodes.append(TextNode(raw_text))
-                i = next_special
+            special = SPECIAL.search(text, i + 1, n)
+            next_special = special.start() if special else n
+            nodes.append(TextNode(text[i:next_special]))
+            i = next_special
 
         return nodes
 
     def _merge_text_nodes(self, nodes: List[Node]) -> List[Node]:
         merged = []
+        # Runs of text are joined once, rather than growing one string a piece at a time
+        texts = []
         for node in nodes:
             if isinstance(node, TextNode):
-                node.text = node.text.replace("\n", "<br>")
-                if merged and isinstance(merged[-1], TextNode):
-                    merged[-1].text += node.text
-                else:
-                    merged.append(node)
-            else:
-                if isinstance(node, ContainerNode):
-                    node.children = self._merge_text_nodes(node.children)
-                merged.append(node)
+                texts.append(node.text)
+                continue
+
+            if texts:
+                merged.append(TextNode("".join(texts).replace("\n", "<br>")))
+                texts = []
+            if isinstance(node, ContainerNode):
+                node.children = self._merge_text_nodes(node.children)
+            merged.append(node)
+
+        if texts:
+            merged.append(TextNode("".join(texts).replace("\n", "<br>")))
         return merged
 
     def _merge_quote_nodes(self, nodes: List[Node]) -> List[Node]:
@@ -1,25 +1,66 @@
 import re
-from typing import Optional
-
-from chat_exporter.ext.discord_import import discord
-from chat_exporter.ext.emoji_convert import convert_emoji
-from chat_exporter.parse.ast import AstParser
-
-bot: Optional[discord.Client] = None
-
-
-def pass_bot(_bot):
-    # Bot is used to fetch a user who is no longer inside a guild
-    # This will stop the user from appearing as 'Unknown' which some people do not want
-    global bot
-    bot = _bot
+from typing import List
+
+from chat_exporter.ext.cache import LRUCache
+from chat_exporter.ext.emoji_convert import EMOJI_RUN, convert_run
+from chat_exporter.ext.render_context import current_context
+from chat_exporter.parse.ast import (
+    AstParser,
+    ChannelMentionNode,
+    ContainerNode,
+    Node,
+    RoleMentionNode,
+    UserMentionNode,
+)
+
+# Rendered markdown by content, shared by every export. Content which mentions users, roles or channels
+# keeps its parsed nodes instead, so the mentions are rendered against the guild of each export.
+# Locked, as a render executor may be a thread pool rendering in to it from many threads.
+render_cache = LRUCache(maxsize=4096, lock=True)
+# Longer content is rendered every time. Short messages are the ones which repeat, and the limit keeps the
+# cache under 4096 entries of a few KiB each however large the messages of an export are.
+RENDER_CACHE_MAX_CONTENT = 1024
+GUILD_STATE_NODES = (ChannelMentionNode, RoleMentionNode, UserMentionNode)
+
+
+# One scan over the content: code is left alone, custom emoji are linked and runs of unicode are converted
+EMOJI_SCAN = re.compile(
+    r'(?P<shield>(?s:<div class="pre pre--multiline.*?</div>|<span class="pre pre-inline">.*?</span>))'
+    r"|&lt;(?P<escaped_animated>a?):\w*:(?P<escaped_id>\d*)&gt;"
+    r"|<(?P<animated>a?):\w*:(?P<id>\d*)>"
+    rf"|(?P<unicode>{EMOJI_RUN.pattern})"
+)
+custom_emoji = '<img class="emoji emoji--small" src="https://cdn.discordapp.com/emojis/{id}.{ext}">'
+
+
+def _replace_emoji(match):
+    kind = match.lastgroup
+    if kind == "unicode":
+        if match.start() and match.group(0)[0] > "\x7f":
+            # The character before was part of a custom emoji or code block, but still joins the first grapheme
+            return convert_run(match.string[match.start() - 1] + match.group(0))[1:]
+        return convert_run(match.group(0))
+    if kind in ("escaped_id", "id"):
+        animated = match.group("escaped_animated") or match.group("animated")
+        return custom_emoji.format(id=match.group(kind), ext="gif" if animated else "png")
+    return match.group(0)
+
+
+def _renders_guild_state(nodes: List[Node]) -> bool:
+    return any(
+        isinstance(node, GUILD_STATE_NODES)
+        or (isinstance(node, ContainerNode) and _renders_guild_state(node.children))
+        for node in nodes
+    )
 
 
 class ParseMarkdown:
     def __init__(self, content, guild=None, _bot=None):
         self.content = content
         self.guild = guild
-        self.bot = _bot or bot
+        # Bot is used to fetch a user who is no longer inside a guild
+        # This will stop the user from appearing as 'Unknown' which some people do not want
+        self.bot = _bot or current_context().bot
         self.code_blocks = []
 
     def parse_code_block_markdown(self):
@@ -42,25 +83,13 @@ class ParseMarkdown:
             self.content = self.content.replace(f"{{{{CODE_BLOCK_{i}}}}}", block)
 
     async def standard_message_flow(self):
-        ast = AstParser()
-        nodes = ast.parse(self.content)
-        self.content = "".join(n.render(self.guild, self.bot) for n in nodes)
-        await self.parse_emoji()
-        return self.content
+        return self.render()
 
     async def link_embed_flow(self):
-        ast = AstParser()
-        nodes = ast.parse(self.content)
-        self.content = "".join(n.render(self.guild, self.bot) for n in nodes)
-        await self.parse_emoji()
-        return self.content
+        return self.render()
 
     async def standard_embed_flow(self):
-        ast = AstParser()
-        nodes = ast.parse(self.content)
-        self.content = "".join(n.render(self.guild, self.bot) for n in nodes)
-        await self.parse_emoji()
-        return self.content
+        return self.render()
 
     async def special_embed_flow(self):
         return await self.standard_embed_flow()
@@ -70,7 +99,37 @@ class ParseMarkdown:
         return await self.standard_embed_flow()
 
     async def special_emoji_flow(self):
+        key = ("emoji", self.content)
+        cached = render_cache.get(key)
+        if cached is not None:
+            self.content = cached
+            return self.content
+
         await self.parse_emoji()
+        if len(key[1]) <= RENDER_CACHE_MAX_CONTENT:
+            render_cache.set(key, self.content)
+        return self.content
+
+    def render(self) -> str:
+        """Render the content as markdown, without awaiting anything."""
+        # Rendered ahead of time for the running export, e.g. in a process pool
+        rendered = current_context().markdown.get(self.content)
+        if rendered is not None:
+            self.content = rendered
+            return self.content
+
+        key = ("markdown", self.content)
+        cacheable = len(self.content) <= RENDER_CACHE_MAX_CONTENT
+        cached = render_cache.get(key) if cacheable else None
+        if isinstance(cached, str):
+            self.content = cached
+            return self.content
+
+        nodes = cached if cached is not None else AstParser().parse(self.content)
+        self.content = EMOJI_SCAN.sub(_replace_emoji, "".join(n.render(self.guild, self.bot) for n in nodes))
+
+        if cacheable and cached is None:
+            render_cache.set(key, nodes if _renders_guild_state(nodes) else self.content)
         return self.content
 
     def strip_preserve(self):
@@ -78,31 +137,4 @@ class ParseMarkdown:
         self.content = re.sub(p, r"\1", self.content)
 
     async def parse_emoji(self):
-        holder = (
-            [r"&lt;:.*?:(\d*)&gt;", '<img class="emoji emoji--small" src="https://cdn.discordapp.com/emojis/%s.png">'],
-            [r"&lt;a:.*?:(\d*)&gt;", '<img class="emoji emoji--small" src="https://cdn.discordapp.com/emojis/%s.gif">'],
-            [r"<:.*?:(\d*)>", '<img class="emoji emoji--small" src="https://cdn.discordapp.com/emojis/%s.png">'],
-            [r"<a:.*?:(\d*)>", '<img class="emoji emoji--small" src="https://cdn.discordapp.com/emojis/%s.gif">'],
-        )
-
-        shield_blocks = []
-        def repl(match):
-            shield_blocks.append(match.group(0))
-            return f"{{{{SHIELD_{len(shield_blocks) - 1}}}}}"
-        self.content = re.sub(r'<div class="pre pre--multiline.*?</div>', repl, self.content, flags=re.DOTALL)
-        self.content = re.sub(r'<span class="pre pre-inline">.*?</span>', repl, self.content, flags=re.DOTALL)
-
-        self.content = await convert_emoji([word for word in self.content])
-
-        for p, r in holder:
-
-            def make_repl(template):
-                def repl(match):
-                    return template % match.group(1)
-
-                return repl
-
-            self.content = re.sub(p, make_repl(r), self.content)
-
-        for i, block in enumerate(shield_blocks):
-            self.content = self.content.replace(f"{{{{SHIELD_{i}}}}}", block)
+        self.content = EMOJI_SCAN.sub(_replace_emoji, self.content)
@@ -0,0 +1,183 @@
+import asyncio
+from collections import deque
+from concurrent.futures import Executor
+from types import SimpleNamespace
+from typing import Callable, Deque, Dict, Iterable, List, Optional
+
+from chat_exporter.construct.message_record import MessageRecord, starts_group
+from chat_exporter.ext.discord_import import discord
+from chat_exporter.ext.html_generator import is_plain_text
+from chat_exporter.ext.render_context import current_context
+from chat_exporter.parse.ast import ESCAPED_MENTION, MENTION
+from chat_exporter.parse.markdown import ParseMarkdown
+
+# Messages rendered by one call in to the executor, enough to outweigh sending them to another process
+CHUNK_SIZE = 250
+# Messages whose markdown is held at a time, the next window is rendered while this one is built
+WINDOW_SIZE = 4 * CHUNK_SIZE
+
+
+class MentionTable:
+    """
+    A picklable stand-in for the guild and bot, holding only the members, channels and roles
+    mentioned in the contents it was built for. Mentions render the same against it as against the guild.
+    """
+
+    def __init__(
+        self,
+        members: Dict[int, SimpleNamespace],
+        channels: Dict[int, SimpleNamespace],
+        roles: Dict[int, SimpleNamespace],
+    ):
+        self.members = members
+        self.channels = channels
+        self.roles = roles
+
+    def get_member(self, user_id: int) -> Optional[SimpleNamespace]:
+        return self.members.get(user_id)
+
+    def get_channel(self, channel_id: int) -> Optional[SimpleNamespace]:
+        return self.channels.get(channel_id)
+
+    def get_role(self, role_id: int) -> Optional[SimpleNamespace]:
+        return self.roles.get(role_id)
+
+    @classmethod
+    def build(cls, contents: Iterable[str], guild: discord.Guild, bot: Optional[discord.Client] = None):
+        members, channels, roles = {}, {}, {}
+        for content in contents:
+            for pattern in (MENTION, ESCAPED_MENTION):
+                for match in pattern.finditer(content):
+                    if match.group("member"):
+                        user_id = int(match.group("member"))
+                        # Users who left the guild are looked up through the bot, as the mention would be
+                        member = guild.get_member(user_id) or (bot.get_user(user_id) if bot else None)
+                        if member:
+                            members[user_id] = SimpleNamespace(display_name=member.display_name)
+                    elif match.group("channel"):
+                        channel = guild.get_channel(int(match.group("channel")))
+                        if channel:
+                            channels[channel.id] = SimpleNamespace(id=channel.id, name=channel.name)
+                    elif match.group("role"):
+                        role = guild.get_role(int(match.group("role")))
+                        if role:
+                            colour = SimpleNamespace(r=role.color.r, g=role.color.g, b=role.color.b)
+                            roles[role.id] = SimpleNamespace(name=role.name, color=colour)
+        return cls(members, channels, roles)
+
+
+def render_contents(contents: List[str], mentions: MentionTable) -> List[str]:
+    """Render markdown to HTML, run in a worker of the executor."""
+    return [ParseMarkdown(content, mentions).render() for content in contents]
+
+
+async def prerender_chunks(
+    chunks: List[List[str]],
+    guild: discord.Guild,
+    bot: Optional[discord.Client],
+    executor: Executor,
+) -> Dict[str, str]:
+    """Render the chunks of contents across the executor, one call each, and key the HTML by content."""
+    seen = set()
+    chunks = [[c for c in chunk if not (c in seen or seen.add(c))] for chunk in chunks]
+    chunks = [chunk for chunk in chunks if chunk]
+    mentions = MentionTable.build(seen, guild, bot)
+
+    loop = asyncio.get_event_loop()
+    rendered = await asyncio.gather(*(loop.run_in_executor(executor, render_contents, c, mentions) for c in chunks))
+    return {content: html for chunk, htmls in zip(chunks, rendered) for content, html in zip(chunk, htmls)}
+
+
+def group_slices(records: List[MessageRecord], size: int, start: int = 0, stop: Optional[int] = None) -> List[slice]:
+    """Split the records in to slices of about `size` messages, cut where a message group starts.
+    A group longer than twice the size is cut anyway. Only the records from `start` to `stop` are read."""
+    stop = len(records) if stop is None else stop
+    slices = []
+    begin = start
+    for i in range(start + 1, stop):
+        length = i - begin
+        if length >= size and (starts_group(records[i - 1], records[i]) or length >= 2 * size):
+            slices.append(slice(begin, i))
+            begin = i
+    if begin < stop:
+        slices.append(slice(begin, stop))
+    return slices
+
+
+class _Window:
+    __slots__ = ("span", "task", "markdown")
+
+    def __init__(self, span: slice, task: asyncio.Future):
+        self.span = span
+        self.task = task
+        self.markdown: Optional[Dict[str, str]] = None
+
+
+class MarkdownPrerenderer:
+    """
+    Render the markdown of the messages, their contents and embeds, across an executor, a window of messages
+    ahead of rendering.
+
+    The window after the one being rendered is sent as soon as rendering reaches it, and a window is dropped
+    once all of its messages are built, so no more than two windows of markdown are held at a time. Windows,
+    and the chunks each executor call renders, are cut between message groups.
+
+    :param history: the MessageHistory being rendered, windows are read from it as they are sent
+    :param markup: callable returning the texts of a message which are rendered as markdown
+    """
+
+    def __init__(
+        self,
+        history,
+        guild: discord.Guild,
+        executor: Executor,
+        markup: Callable[[MessageRecord], List[str]],
+    ):
+        self.history = history
+        self.guild = guild
+        self.executor = executor
+        self.markup = markup
+        context = current_context()
+        self.bot = context.bot
+        # Read by ParseMarkdown while the messages are rendered
+        self.markdown = context.markdown
+        # Where the next window starts
+        self._unsent = 0
+        self._sent: Deque[_Window] = deque()
+
+    async def ready(self, index: int):
+        """Wait for the markdown of the message at `index`, sending the window after it on its way."""
+        while sum(1 for w in self._sent if w.span.stop > index) < 2:
+            # Enough to find the end of the window, which is cut at twice its size at the latest
+            stop = await self.history.read_to(self._unsent + 2 * WINDOW_SIZE)
+            if self._unsent >= stop:
+                break
+            span = group_slices(self.history, WINDOW_SIZE, self._unsent, stop)[0]
+            self._send(span)
+            self._unsent = span.stop
+
+        window = next(w for w in self._sent if w.span.start <= index < w.span.stop)
+        if window.markdown is None:
+            window.markdown = await window.task
+            self.markdown.update(window.markdown)
+
+    def release(self, built: int):
+        """Drop the markdown of the windows whose messages are all built, the first `built` messages."""
+        while self._sent and self._sent[0].span.stop <= built:
+            window = self._sent.popleft()
+            for content in window.markdown or ():
+                # The same content may be waiting in the next window
+                if not any(w.markdown and content in w.markdown for w in self._sent):
+                    self.markdown.pop(content, None)
+
+    def close(self):
+        for window in self._sent:
+            window.task.cancel()
+
+    def _send(self, span: slice):
+        chunks = []
+        for chunk in group_slices(self.history, CHUNK_SIZE, span.start, span.stop):
+            contents = (content for record in self.history[chunk] for content in self.markup(record))
+            chunks.append([content for content in contents if content and not is_plain_text(content)])
+        task = asyncio.ensure_future(prerender_chunks(chunks, self.guild, self.bot, self.executor))
+        self._sent.append(_Window(span, task))
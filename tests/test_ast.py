@@ -160,6 +160,20 @@ class TestAST(unittest.TestCase):
         self.assertIn('unix-timestamp', out)
         self.assertIn('raw-content="&lt;t:1614556800:R&gt;"', out)
 
+    def test_nested_formatting(self):
+        text = "**bold _italic [link](https://a.b)_**\n- **# title**"
+        nodes = self.parser.parse(text)
+        out = "".join(n.render() for n in nodes)
+        self.assertIn('<strong>bold <em>italic <a href="https://a.b">link</a></em></strong>', out)
+        self.assertIn('<li class="markup"><strong><h1>title</h1></strong></li>', out)
+
+    def test_unclosed_markers_in_long_text(self):
+        # Pasted logs are full of markers which are never closed
+        text = "[INFO] a < b ~ c | d [e\n" * 5000
+        nodes = self.parser.parse(text)
+        out = "".join(n.render() for n in nodes)
+        self.assertEqual(out, text.replace("\n", "<br>"))
+
 
 if __name__ == "__main__":
     unittest.main()
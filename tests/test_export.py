@@ -7,7 +7,10 @@ tests/artifacts/ for visual inspection if needed.
 """
 
 import asyncio
+import io
+import itertools
 import os
+import re
 import unittest
 from datetime import datetime
 from unittest.mock import MagicMock
@@ -73,6 +76,22 @@ def _make_message(content="", msg_id=1, created_at=None, author=None, guild=None
     return msg
 
 
+_ATTACHMENT_IDS = itertools.count(1)
+
+
+def _make_attachment(filename="file.txt", size=100, content_type="text/plain", attachment_id=None, chunks=None):
+    """An attachment whose patched downloads yield `chunks`, by default `size` bytes."""
+    att = MagicMock(spec=discord.Attachment)
+    att.id = attachment_id if attachment_id is not None else next(_ATTACHMENT_IDS)
+    att.filename = filename
+    att.chunks = chunks if chunks is not None else (b"x" * size,)
+    att.size = sum(map(len, att.chunks))
+    att.content_type = content_type
+    att.url = att.proxy_url = f"https://cdn.discordapp.com/attachments/1/{att.id}/{filename}"
+    att.is_spoiler.return_value = False
+    return att
+
+
 def _make_channel(guild=None):
     ch = MagicMock()
     ch.name = "test-channel"
@@ -140,6 +159,32 @@ def _make_embed(
     return embed
 
 
+class _AsyncIterator:
+    def __init__(self, items):
+        self._items = iter(items)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._items)
+        except StopIteration:
+            raise StopAsyncIteration from None
+
+
+def _with_history(channel, messages):
+    """Serve messages from channel.history() like discord.py does, newest-first unless oldest_first is set."""
+    channel.history = lambda oldest_first=False, **kwargs: _AsyncIterator(
+        list(messages) if oldest_first else list(reversed(messages))
+    )
+    return channel
+
+
+def _strip_generated_time(html):
+    return re.sub(r"\d{1,2}:\d{2}:\d{2}( [AP]M)? \(UTC\)", "", html)
+
+
 def _run(coro):
     return asyncio.get_event_loop().run_until_complete(coro)
 
@@ -220,6 +265,14 @@ class TestRawExport(unittest.TestCase):
         self.assertIn("I am a bot!", html)
         self.assertIn("bot-tag", html)
 
+    def test_emoji_render_without_network(self):
+        """Unicode emoji should be converted to twemoji images using the bundled index."""
+        msg = _make_message("Nice 😀 #️⃣ 👨‍👩‍👧", guild=self.guild)
+        html = self._export([msg], "emoji.html")
+        self.assertIn("twemoji@latest/assets/72x72/1f600.png", html)
+        self.assertIn("twemoji@latest/assets/72x72/23-20e3.png", html)
+        self.assertIn("twemoji@latest/assets/72x72/1f468-200d-1f469-200d-1f467.png", html)
+
     def test_heading_no_trailing_breaks(self):
         """Headings followed by blank lines should not produce extra <br> before the next text."""
         msg = _make_message("# Title\n\n\n\nContent below", guild=self.guild)
@@ -603,3 +656,1213 @@ class TestRawExport(unittest.TestCase):
         html = self._export([msg], "grid_width.html", guild=guild)
 
         self.assertIn("max-width: 550px", html)
+
+
+class TestStreamingExport(unittest.TestCase):
+    def setUp(self):
+        self.guild = _make_guild()
+
+    def _messages(self):
+        return [
+            _make_message("First message", msg_id=1, guild=self.guild),
+            _make_message("Second **message**", msg_id=2, guild=self.guild),
+            _make_message("Third message", msg_id=3, guild=self.guild, author=_make_author("other", 5)),
+        ]
+
+    def test_stream_matches_export(self):
+        """Streaming to a writer should produce the same document as a regular export."""
+        channel = _with_history(_make_channel(guild=self.guild), self._messages())
+        html = _run(chat_exporter.export(channel, guild=self.guild))
+
+        buffer = io.StringIO()
+        self.assertTrue(_run(chat_exporter.export_to(channel, buffer, guild=self.guild)))
+
+        self.assertEqual(_strip_generated_time(buffer.getvalue()), _strip_generated_time(html))
+
+    def test_stream_to_async_writer(self):
+        """Sinks with an async write method should be awaited."""
+        written = []
+
+        class AsyncSink:
+            async def write(self, data):
+                written.append(data)
+
+        channel = _with_history(_make_channel(guild=self.guild), self._messages())
+        self.assertTrue(_run(chat_exporter.export_to(channel, AsyncSink(), guild=self.guild)))
+
+        html = "".join(written)
+        # The head, the messages and the tail
+        self.assertGreaterEqual(len(written), 3)
+        self.assertIn("<strong>message</strong>", html)
+        self.assertIn("Third message", html)
+        self.assertTrue(html.rstrip().endswith("</html>"))
+
+    def test_stream_to_file_path(self):
+        """A path sink should be opened and written to."""
+        import tempfile
+
+        channel = _with_history(_make_channel(guild=self.guild), self._messages())
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "streamed.html")
+            self.assertTrue(_run(chat_exporter.export_to(channel, path, guild=self.guild)))
+
+            with open(path, encoding="utf-8") as f:
+                self.assertIn("First message", f.read())
+
+    def test_failed_export_leaves_the_path_alone(self):
+        """A path is only replaced by a finished transcript, and no temporary file is left behind."""
+        import tempfile
+
+        channel = _make_channel(guild=self.guild)
+
+        async def history(**kwargs):
+            yield self._messages()[0]
+            raise discord.HTTPException(MagicMock(status=500), "history failed")
+
+        channel.history = history
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "streamed.html")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write("previous transcript")
+
+            self.assertFalse(_run(chat_exporter.export_to(channel, path, guild=self.guild)))
+
+            self.assertEqual(os.listdir(temp_dir), ["streamed.html"])
+            with open(path, encoding="utf-8") as f:
+                self.assertEqual(f.read(), "previous transcript")
+
+    def test_limit_streams_the_latest_messages(self):
+        """With a limit the latest messages are exported, still read oldest first."""
+        messages = [_make_message(f"Message {i}", msg_id=i + 1, guild=self.guild) for i in range(5)]
+
+        def history(limit=None, before=None, after=None, oldest_first=False):
+            found = [m for m in messages if after is None or m.id > after.id]
+            found = found if oldest_first else found[::-1]
+            return _AsyncIterator(found[:limit])
+
+        channel = _make_channel(guild=self.guild)
+        channel.history = history
+        sink = io.StringIO()
+        self.assertTrue(_run(chat_exporter.export_to(channel, sink, limit=2, guild=self.guild)))
+
+        html = sink.getvalue()
+        self.assertNotIn("Message 2", html)
+        self.assertLess(html.index("Message 3"), html.index("Message 4"))
+        self.assertIn("Message Count: 2 Messages", html)
+
+    def test_history_is_read_as_it_is_rendered(self):
+        """Messages are read oldest first, a page ahead of rendering rather than the whole history up front."""
+        from unittest.mock import patch
+
+        from chat_exporter.construct import message as message_module
+
+        messages = [_make_message(f"Message {i}", msg_id=i + 1, guild=self.guild) for i in range(12)]
+        read = []
+
+        def history(oldest_first=False, **kwargs):
+            self.assertTrue(oldest_first)
+
+            async def pages():
+                for message in messages:
+                    read.append(message.id)
+                    yield message
+
+            return pages()
+
+        channel = _make_channel(guild=self.guild)
+        channel.history = history
+        rendered = []
+        sink = io.StringIO()
+        construct_message = message_module.MessageConstruct.construct_message
+
+        async def recording_construct_message(construct):
+            rendered.append(len(read))
+            return await construct_message(construct)
+
+        with patch.object(message_module, "HISTORY_PAGE_SIZE", 2), patch.object(
+            message_module.MessageConstruct, "construct_message", recording_construct_message
+        ):
+            self.assertTrue(_run(chat_exporter.export_to(channel, sink, guild=self.guild)))
+
+        self.assertEqual(read, [message.id for message in messages])
+        # Each message is rendered once its page is read, not once the whole history is
+        self.assertEqual(rendered, [2, 2, 4, 4, 6, 6, 8, 8, 10, 10, 12, 12])
+        self.assertIn("Message 11", sink.getvalue())
+        # The head counts the messages although it is written after them
+        self.assertIn("Message Count: 12 Messages", sink.getvalue())
+
+
+class TestTemplate(unittest.TestCase):
+    def test_render_fills_known_placeholders(self):
+        """Known placeholders are replaced, unknown ones are left untouched."""
+        from chat_exporter.ext.html_generator import render
+
+        out = render("<a id='{{ID}}'>{{NAME}}{{MISSING}}</a>", {"ID": "1", "NAME": "{{ID}}"})
+        self.assertEqual(out, "<a id='1'>{{ID}}{{MISSING}}</a>")
+
+    def test_template_without_placeholders(self):
+        from chat_exporter.ext.html_generator import Template
+
+        self.assertEqual(Template("</div>").render({"X": "y"}), "</div>")
+
+    def test_plain_values_skip_markdown(self):
+        """Plain ids, times and colours should not be parsed, anything markdown could change still is."""
+        from unittest.mock import patch
+
+        from chat_exporter.ext.html_generator import is_plain_text, resolve
+
+        for value in ("1234567890", "01-01-2024 12:00", "color: #FFFFFF;", "Some User"):
+            self.assertTrue(is_plain_text(value), value)
+        for value in ("**bold**", "# Header", "- item", "https://a.b", "<@1>", "caf\u00e9", "line\nbreak"):
+            self.assertFalse(is_plain_text(value), value)
+
+        with patch("chat_exporter.ext.html_generator.ParseMarkdown") as parse_markdown:
+            resolved = _run(resolve(None, [("USER_ID", "1234"), ("TIME", "12:00 PM")]))
+        parse_markdown.assert_not_called()
+        self.assertEqual(resolved, {"USER_ID": "1234", "TIME": "12:00 PM"})
+
+
+class TestConcurrentRendering(unittest.TestCase):
+    def _export(self, concurrency):
+        guild = _make_guild()
+        in_flight = {"now": 0, "max": 0}
+
+        async def slow_fetch_member(user_id):
+            in_flight["now"] += 1
+            in_flight["max"] = max(in_flight["max"], in_flight["now"])
+            await asyncio.sleep(0.01)
+            in_flight["now"] -= 1
+            return None
+
+        guild.fetch_member.side_effect = slow_fetch_member
+        messages = [
+            _make_message(f"Message number {i}", msg_id=i, guild=guild, author=_make_author(f"user{i}", 1000 + i))
+            for i in range(8)
+        ]
+        html = _run(
+            chat_exporter.raw_export(_make_channel(guild=guild), messages, guild=guild, concurrency=concurrency)
+        )
+        return html, in_flight["max"]
+
+    def test_messages_render_concurrently_in_order(self):
+        """Network waits of different messages should overlap while the output keeps message order."""
+        serial_html, serial_in_flight = self._export(concurrency=1)
+        html, in_flight = self._export(concurrency=4)
+
+        self.assertEqual(serial_in_flight, 1)
+        self.assertGreater(in_flight, 1)
+
+        def normalise(out):
+            return re.sub(r"id='\d+'", "", _strip_generated_time(out))
+
+        self.assertEqual(normalise(html), normalise(serial_html))
+
+
+class TestReferencePrefetch(unittest.TestCase):
+    def test_replies_to_old_messages_are_fetched_once(self):
+        """Replies to messages outside the export should resolve each target once, clusters in one page."""
+        from chat_exporter.construct.message import gather_messages
+        from chat_exporter.ext.cache import Cache, use_cache
+
+        guild = _make_guild()
+        channel = _make_channel(guild=guild)
+        base_id = 1_000_000 << 22  # snowflakes a millisecond apart
+        old_single = _make_message("lonely old message", msg_id=base_id, guild=guild)
+        clustered = [
+            _make_message(f"clustered old message {i}", msg_id=base_id + ((10**9 + i) << 22), guild=guild)
+            for i in range(2)
+        ]
+
+        async def fetch_message(message_id):
+            return old_single
+
+        channel.fetch_message.side_effect = fetch_message
+        channel.history = MagicMock(side_effect=lambda **kwargs: _AsyncIterator(clustered))
+
+        replies = []
+        for i, target in enumerate([old_single, old_single, old_single, clustered[0], clustered[1]]):
+            reply = _make_message(f"reply {i}", msg_id=base_id + ((2 * 10**9 + i) << 22), guild=guild)
+            reply.channel = channel
+            reply.reference = MagicMock(spec=["message_id", "channel_id"])
+            reply.reference.message_id = target.id
+            reply.reference.channel_id = channel.id
+            replies.append(reply)
+
+        with use_cache(Cache()):
+            html, _ = _run(gather_messages(replies, guild, "UTC", True, None))
+
+        self.assertEqual(channel.fetch_message.call_count, 1)
+        self.assertEqual(channel.history.call_count, 1)
+        self.assertEqual(html.count("lonely old message"), 3)
+        self.assertIn("clustered old message 1", html)
+
+
+class TestExportCache(unittest.TestCase):
+    def _messages(self, guild, count=6):
+        author = _make_author("repeat", 4242)
+        messages = [_make_message(f"Message {i}", msg_id=i, guild=guild, author=author) for i in range(count)]
+        for message in messages:
+            message.interaction_metadata = None
+        return messages
+
+    def test_concurrent_exports_keep_their_own_cache(self):
+        """One export finishing must not evict the lookups of another which is still rendering."""
+        guilds = [_make_guild(guild_id=1), _make_guild(guild_id=2)]
+        for guild in guilds:
+            async def fetch_member(user_id):
+                await asyncio.sleep(0.001)
+                return None
+
+            guild.fetch_member.side_effect = fetch_member
+
+        async def export_both():
+            return await asyncio.gather(
+                *(
+                    chat_exporter.raw_export(_make_channel(guild=guild), self._messages(guild, count), guild=guild)
+                    for guild, count in zip(guilds, (2, 8))
+                )
+            )
+
+        _run(export_both())
+
+        for guild in guilds:
+            self.assertEqual(guild.fetch_member.call_count, 1)
+
+    def test_lookups_are_not_kept_after_gather_messages(self):
+        """Rendering outside of an export caches for the one call, not for the whole process."""
+        from chat_exporter.construct.message import gather_messages
+
+        guild = _make_guild()
+        guild.fetch_member.return_value = None
+        for _ in range(2):
+            _run(gather_messages(self._messages(guild), guild, "UTC", False, None))
+
+        self.assertEqual(guild.fetch_member.call_count, 2)
+
+    def test_shared_lru_cache_is_reused_and_bounded(self):
+        guild = _make_guild()
+        shared = chat_exporter.LRUCache(maxsize=1)
+
+        messages = self._messages(guild)
+        for _ in range(2):
+            _run(chat_exporter.raw_export(_make_channel(guild=guild), list(messages), guild=guild, cache=shared))
+
+        info = shared.info()
+        self.assertEqual(guild.fetch_member.call_count, 1)
+        self.assertGreater(info.hits, 0)
+        self.assertEqual(info.maxsize, 1)
+        self.assertLessEqual(info.currsize, 1)
+
+    def test_concurrent_lookups_share_one_request(self):
+        """Concurrent renders of the same uncached member should wait on a single fetch."""
+        guild = _make_guild()
+
+        async def fetch_member(user_id):
+            await asyncio.sleep(0.01)
+            return None
+
+        guild.fetch_member.side_effect = fetch_member
+        _run(chat_exporter.raw_export(_make_channel(guild=guild), self._messages(guild), guild=guild, concurrency=4))
+
+        self.assertEqual(guild.fetch_member.call_count, 1)
+
+    def test_failed_lookups_are_not_cached(self):
+        from chat_exporter.ext.cache import LRUCache, cache, use_cache
+
+        calls = []
+
+        @cache()
+        async def lookup(value):
+            calls.append(value)
+            if len(calls) == 1:
+                raise ValueError("first call fails")
+            return value
+
+        async def run():
+            with use_cache(LRUCache()):
+                with self.assertRaises(ValueError):
+                    await lookup(1)
+                return await lookup(1), await lookup(1)
+
+        self.assertEqual(_run(run()), (1, 1))
+        self.assertEqual(len(calls), 2)
+
+    def test_member_lookups_are_keyed_by_id(self):
+        """Separate objects for the same member should share a cache entry without being formatted."""
+        guild = _make_guild()
+        messages = []
+        for message in self._messages(guild):
+            message.author = _make_author("repeat", 4242)
+            message.author.__repr__ = MagicMock(side_effect=AssertionError("member repr used as cache key"))
+            messages.append(message)
+
+        _run(chat_exporter.raw_export(_make_channel(guild=guild), messages, guild=guild))
+
+        self.assertEqual(guild.fetch_member.call_count, 1)
+
+
+class TestMemberPrefetch(unittest.TestCase):
+    def test_members_are_requested_in_bulk(self):
+        """Authors and mentioned users should be resolved by one member request instead of a fetch each."""
+        guild = _make_guild()
+        authors = [_make_author(f"user{i}", 5000 + i) for i in range(3)]
+        messages = [
+            _make_message(f"hello <@{5000 + (i + 1) % 3}> and <@!9999>", msg_id=i, guild=guild, author=author)
+            for i, author in enumerate(authors)
+        ]
+        for message in messages:
+            message.interaction_metadata = None
+
+        async def query_members(user_ids, limit, cache):
+            return [author for author in authors if author.id in user_ids]
+
+        guild.query_members.side_effect = query_members
+        html = _run(
+            chat_exporter.raw_export(_make_channel(guild=guild), messages, guild=guild, prefetch_members=True)
+        )
+
+        guild.query_members.assert_called_once_with(user_ids=[5000, 5001, 5002, 9999], limit=100, cache=True)
+        guild.fetch_member.assert_not_called()
+        self.assertIn("user2", html)
+
+    def test_falls_back_to_fetching_without_gateway(self):
+        guild = _make_guild()
+        guild.query_members.side_effect = discord.ClientException("no gateway")
+        messages = [_make_message("hi", msg_id=1, guild=guild)]
+        messages[0].interaction_metadata = None
+
+        _run(chat_exporter.raw_export(_make_channel(guild=guild), messages, guild=guild, prefetch_members=True))
+
+        self.assertEqual(guild.fetch_member.call_count, 1)
+
+
+class TestSlicedHistory(unittest.TestCase):
+    def test_slices_are_fetched_and_merged_in_order(self):
+        """Slices of the channel's history are each read oldest first and joined back in to one timeline."""
+        from chat_exporter.construct.transcript import Transcript
+
+        guild = _make_guild()
+        channel = _make_channel(guild=guild)
+        step = 10**15
+        messages = [_make_message(f"m{i}", msg_id=channel.id + i * step, guild=guild) for i in range(1, 40)]
+
+        def history(limit, after, before, oldest_first):
+            return _AsyncIterator([m for m in messages if after.id < m.id < before.id])
+
+        channel.history = MagicMock(side_effect=history)
+        transcript = Transcript(
+            channel=channel,
+            limit=None,
+            messages=None,
+            pytz_timezone="UTC",
+            military_time=True,
+            fancy_times=True,
+            before=None,
+            after=None,
+            support_dev=False,
+            bot=None,
+            attachment_handler=None,
+            history_slices=4,
+        )
+        _run(transcript.fetch_messages())
+
+        self.assertEqual(channel.history.call_count, 4)
+        self.assertEqual([m.id for m in transcript.messages], [m.id for m in messages])
+
+
+class TestIncrementalExport(unittest.TestCase):
+    def test_resumed_export_matches_full_export(self):
+        """Exporting in two runs through a checkpoint should give the same transcript as one full export."""
+        import tempfile
+
+        guild = _make_guild()
+        other = _make_author("other", 5)
+        messages = [
+            _make_message(f"Message {i}", msg_id=i, guild=guild, author=other if i in (3, 4, 5) else None)
+            for i in range(1, 7)
+        ]
+        for message in messages:
+            message.interaction_metadata = None
+
+        def history(limit=None, before=None, after=None, **kwargs):
+            if after is None:
+                return _AsyncIterator(list(reversed(visible)))
+            return _AsyncIterator([m for m in visible if m.id > after.id])
+
+        channel = _make_channel(guild=guild)
+        channel.history = MagicMock(side_effect=history)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "incremental.json")
+            visible = messages[:4]
+            _run(chat_exporter.incremental_export(channel, path, guild=guild))
+            visible = messages
+            html = _run(chat_exporter.incremental_export(channel, path, guild=guild))
+        self.assertEqual(channel.history.call_args.kwargs["after"].id, 4)
+
+        full = _run(chat_exporter.raw_export(channel, list(reversed(messages)), guild=guild, military_time=True))
+
+        def normalise(out):
+            return re.sub(r"id='\d+'", "", _strip_generated_time(out))
+
+        self.assertEqual(normalise(html), normalise(full))
+        self.assertEqual(html.count("Message 5"), 1)
+
+
+class TestRenderCache(unittest.TestCase):
+    def test_repeated_content_is_rendered_once(self):
+        from chat_exporter.parse.markdown import ParseMarkdown, render_cache
+
+        content = "Build **#4521** passed in 3m 12s"
+        first = _run(ParseMarkdown(content).standard_message_flow())
+        hits = render_cache.info().hits
+        self.assertEqual(_run(ParseMarkdown(content).standard_embed_flow()), first)
+        self.assertEqual(render_cache.info().hits, hits + 1)
+
+    def test_long_content_is_not_cached(self):
+        from chat_exporter.parse.markdown import RENDER_CACHE_MAX_CONTENT, ParseMarkdown, render_cache
+
+        content = "**log** " + "x" * RENDER_CACHE_MAX_CONTENT
+        first = _run(ParseMarkdown(content).standard_message_flow())
+        self.assertNotIn(("markdown", content), render_cache)
+        self.assertEqual(_run(ParseMarkdown(content).standard_message_flow()), first)
+
+    def test_mentions_follow_the_guild(self):
+        """Cached content with mentions should still show the members of the guild it is rendered for."""
+        from chat_exporter.parse.markdown import ParseMarkdown
+
+        content = "ping <@42> about **the report**"
+        rendered = []
+        for name in ("Alice", "Bob"):
+            guild = _make_guild()
+            guild.get_member.return_value = _make_author(name, 42)
+            rendered.append(_run(ParseMarkdown(content, guild).standard_message_flow()))
+
+        self.assertIn("@Alice", rendered[0])
+        self.assertIn("@Bob", rendered[1])
+        self.assertIn("<strong>the report</strong>", rendered[1])
+
+
+class TestEmojiConversion(unittest.TestCase):
+    def test_unicode_and_custom_emoji(self):
+        from chat_exporter.parse.markdown import ParseMarkdown
+
+        parsed = ParseMarkdown("hi 😀 <:smile:123> <a:dance:456>")
+        _run(parsed.parse_emoji())
+        self.assertIn('alt="😀"', parsed.content)
+        self.assertIn("emojis/123.png", parsed.content)
+        self.assertIn("emojis/456.gif", parsed.content)
+        self.assertTrue(parsed.content.startswith("hi "))
+
+    def test_code_is_left_alone(self):
+        from chat_exporter.parse.markdown import ParseMarkdown
+
+        content = '<span class="pre pre-inline">😀 <:smile:123></span>'
+        parsed = ParseMarkdown(content)
+        _run(parsed.parse_emoji())
+        self.assertEqual(parsed.content, content)
+
+    def test_plain_text_is_unchanged(self):
+        from chat_exporter.ext.emoji_convert import emojify
+
+        content = "no emoji here, just text #1 *2* 3" * 1000
+        self.assertEqual(emojify(content), content)
+
+
+class TestSharedSession(unittest.TestCase):
+    class _SessionRecorder(chat_exporter.AttachmentHandler):
+        def __init__(self):
+            self.sessions = []
+
+        async def process_asset(self, attachment):
+            from chat_exporter.ext.http_session import http_session
+
+            async with http_session() as session:
+                self.sessions.append(session)
+            return attachment
+
+    def _messages(self, guild, count=3):
+        messages = []
+        for i in range(count):
+            msg = _make_message("", msg_id=i + 1, guild=guild)
+            msg.attachments = [_make_attachment(f"{i}.png", content_type="image/png")]
+            messages.append(msg)
+        return messages
+
+    def test_one_session_per_export(self):
+        guild = _make_guild()
+        handler = self._SessionRecorder()
+        _run(chat_exporter.raw_export(_make_channel(guild), self._messages(guild), attachment_handler=handler))
+
+        self.assertEqual(len(handler.sessions), 3)
+        self.assertEqual(len(set(map(id, handler.sessions))), 1)
+        # Opened for the export, so closed with it
+        self.assertTrue(handler.sessions[0].closed)
+
+    def test_passed_session_is_used_and_left_open(self):
+        import aiohttp
+
+        async def export():
+            async with aiohttp.ClientSession() as session:
+                await chat_exporter.raw_export(
+                    _make_channel(guild), self._messages(guild), attachment_handler=handler, session=session
+                )
+                return session, session.closed
+
+        guild = _make_guild()
+        handler = self._SessionRecorder()
+        session, closed = _run(export())
+
+        self.assertTrue(all(s is session for s in handler.sessions))
+        self.assertFalse(closed)
+
+
+class TestAttachmentQueue(unittest.TestCase):
+    class _SlowHandler(chat_exporter.AttachmentHandler):
+        def __init__(self, delays):
+            self.delays = delays
+            self.running = 0
+            self.most_running = 0
+
+        async def process_asset(self, attachment):
+            self.running += 1
+            self.most_running = max(self.most_running, self.running)
+            await asyncio.sleep(self.delays[attachment.filename])
+            self.running -= 1
+            attachment.url = attachment.proxy_url = f"https://cdn.example.com/{attachment.filename}"
+            return attachment
+
+    def _export(self, handler, attachment_concurrency):
+        guild = _make_guild()
+        messages = []
+        for i in range(3):
+            msg = _make_message(f"message {i}", msg_id=i + 1, guild=guild)
+            msg.attachments = [_make_attachment(f"{i}-{j}.txt") for j in range(3)]
+            messages.append(msg)
+        return _run(
+            chat_exporter.raw_export(
+                _make_channel(guild),
+                messages,
+                attachment_handler=handler,
+                attachment_concurrency=attachment_concurrency,
+            )
+        )
+
+    def test_results_keep_their_order(self):
+        # Later attachments finish first
+        delays = {f"{i}-{j}.txt": (8 - i * 3 - j) / 1000 for i in range(3) for j in range(3)}
+        handler = self._SlowHandler(delays)
+        concurrent = self._export(handler, 4)
+
+        self.assertEqual(handler.most_running, 4)
+        names = re.findall(r"https://cdn\.example\.com/([\d-]+)\.txt", concurrent)
+        # raw_export takes the messages newest first
+        self.assertEqual(list(dict.fromkeys(names)), [f"{i}-{j}" for i in (2, 1, 0) for j in range(3)])
+
+    def test_handler_limit(self):
+        handler = self._SlowHandler({f"{i}-{j}.txt": 0.001 for i in range(3) for j in range(3)})
+        handler.max_concurrency = 2
+        self._export(handler, 8)
+        self.assertEqual(handler.most_running, 2)
+
+    def test_queue_stays_within_its_window(self):
+        from unittest.mock import patch
+
+        from chat_exporter.construct.attachment_handler import AttachmentQueue
+
+        held = []
+        submit = AttachmentQueue.submit
+
+        def recording_submit(queue, attachment):
+            future = submit(queue, attachment)
+            held.append(len(queue))
+            return future
+
+        guild = _make_guild()
+        messages = []
+        for i in range(20):
+            msg = _make_message(f"message {i}", msg_id=i + 1, guild=guild)
+            msg.attachments = [_make_attachment(f"{i}-0.txt")]
+            messages.append(msg)
+        handler = self._SlowHandler({f"{i}-0.txt": 0 for i in range(20)})
+
+        with patch.object(AttachmentQueue, "submit", recording_submit):
+            _run(
+                chat_exporter.raw_export(
+                    _make_channel(guild), messages, attachment_handler=handler, attachment_concurrency=2
+                )
+            )
+
+        # Two workers taking one attachment each, and results are dropped once handed out
+        self.assertLessEqual(max(held), 2)
+
+    def test_attachment_shown_twice_is_processed_once(self):
+        from unittest.mock import AsyncMock
+
+        guild = _make_guild()
+        attachment = _make_attachment("cat.png", attachment_id=4660)
+        messages = []
+        for i in range(2):
+            msg = _make_message(f"message {i}", msg_id=i + 1, guild=guild)
+            msg.attachments = [attachment]
+            messages.append(msg)
+        handler = self._SlowHandler({"cat.png": 0})
+        handler.process_asset = AsyncMock(side_effect=handler.process_asset)
+
+        html = _run(chat_exporter.raw_export(_make_channel(guild), messages, attachment_handler=handler))
+
+        self.assertEqual(handler.process_asset.await_count, 1)
+        self.assertEqual(html.count("https://cdn.example.com/cat.png"), 2)
+
+    def test_system_messages_queue_nothing(self):
+        from chat_exporter.construct.attachment_handler import AttachmentQueue
+        from chat_exporter.construct.message import queue_attachments
+
+        async def queue_pin():
+            queue = AttachmentQueue(self._SlowHandler({}))
+            msg = _make_message("pinned a message", guild=_make_guild())
+            msg.type = discord.MessageType.pins_add
+            msg.attachments = [_make_attachment()]
+            queue_attachments(queue, msg)
+            queue.close()
+            return len(queue)
+
+        # A pin never renders its attachments, so nothing would take them off the queue
+        self.assertEqual(_run(queue_pin()), 0)
+
+
+class TestLocalFileStore(unittest.TestCase):
+    def setUp(self):
+        from unittest.mock import patch
+
+        self.downloads = []
+
+        async def iter_attachment(attachment):
+            self.downloads.append(attachment.id)
+            for chunk in attachment.chunks:
+                yield chunk
+
+        patcher = patch("chat_exporter.construct.attachment_handler.iter_attachment", iter_attachment)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _attachment(self, attachment_id, filename="cat.png", chunks=(b"me", b"ow")):
+        return _make_attachment(filename, attachment_id=attachment_id, chunks=chunks)
+
+    def test_stored_once_by_id(self):
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as base_path:
+            first = chat_exporter.AttachmentToLocalFileHostHandler(base_path, "https://example.com", address="id")
+            url = _run(first.process_asset(self._attachment(4660))).url
+
+            # A later export, with a handler of its own, finds the file through the index
+            handler = chat_exporter.AttachmentToLocalFileHostHandler(base_path, "https://example.com", address="id")
+            self.assertEqual(_run(handler.process_asset(self._attachment(4660))).url, url)
+            self.assertEqual(self.downloads, [4660])
+
+            self.assertEqual(url, "https://example.com/34/4660/cat.png")
+            with open(os.path.join(base_path, "34", "4660", "cat.png"), "rb") as f:
+                self.assertEqual(f.read(), b"meow")
+
+    def test_same_content_stored_once_by_hash(self):
+        import hashlib
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            # A directory which does not exist yet, created on the first download
+            base_path = os.path.join(temp_dir, "assets")
+            handler = chat_exporter.AttachmentToLocalFileHostHandler(base_path, "https://example.com", address="sha256")
+            first = _run(handler.process_asset(self._attachment(1, "a.PNG"))).url
+            second = _run(handler.process_asset(self._attachment(2, "b.png", (b"meow",)))).url
+
+            digest = hashlib.sha256(b"meow").hexdigest()
+            self.assertEqual(first, second)
+            self.assertEqual(first, f"https://example.com/{digest[:2]}/{digest[2:4]}/{digest}.png")
+            self.assertEqual(os.listdir(os.path.join(base_path, digest[:2], digest[2:4])), [f"{digest}.png"])
+            self.assertEqual(sorted(os.listdir(base_path)), sorted([digest[:2], "index.jsonl"]))
+            with open(os.path.join(base_path, "index.jsonl")) as f:
+                self.assertEqual(len(f.readlines()), 2)
+
+    def test_concurrent_stores_do_not_share_a_temp_file(self):
+        import tempfile
+        from unittest.mock import patch
+
+        async def iter_attachment(attachment):
+            for chunk in attachment.chunks:
+                # Lets the other store write in between
+                await asyncio.sleep(0)
+                yield chunk
+
+        async def store_twice(base_path, address):
+            handlers = [
+                chat_exporter.AttachmentToLocalFileHostHandler(base_path, "https://example.com", address=address)
+                for _ in range(2)
+            ]
+            return await asyncio.gather(*(h.process_asset(self._attachment(4660)) for h in handlers))
+
+        for address in ("id", "sha256"):
+            with tempfile.TemporaryDirectory() as base_path, patch(
+                "chat_exporter.construct.attachment_handler.iter_attachment", iter_attachment
+            ):
+                first, second = _run(store_twice(base_path, address))
+                self.assertEqual(first.url, second.url)
+                path = os.path.join(base_path, first.url[len("https://example.com/"):])
+                with open(path, "rb") as f:
+                    self.assertEqual(f.read(), b"meow")
+                for _, _, files in os.walk(base_path):
+                    self.assertFalse([name for name in files if name.endswith(".tmp")])
+
+    def test_large_attachments_are_spooled_to_disk(self):
+        from chat_exporter.construct.attachment_handler import SPOOL_MAX_SIZE, spool_attachment
+
+        small = _run(spool_attachment(self._attachment(1)))
+        large = self._attachment(2, chunks=(b"x" * SPOOL_MAX_SIZE, b"x"))
+        with small, _run(spool_attachment(large)) as spooled:
+            self.assertIsInstance(small, io.BytesIO)
+            self.assertNotIsInstance(spooled, io.BytesIO)
+            self.assertEqual(small.read(), b"meow")
+            self.assertEqual(len(spooled.read()), SPOOL_MAX_SIZE + 1)
+
+    def test_spooled_memory_is_bounded(self):
+        from chat_exporter.construct.attachment_handler import spool_attachment, spool_budget
+
+        used = spool_budget.used
+        spool_budget.used = spool_budget.limit - 4
+        try:
+            first = _run(spool_attachment(self._attachment(1)))
+            # The budget is spent, the next small attachment goes to disk
+            second = _run(spool_attachment(self._attachment(2)))
+            self.assertIsInstance(first, io.BytesIO)
+            self.assertNotIsInstance(second, io.BytesIO)
+            first.close()
+            second.close()
+            self.assertEqual(spool_budget.used, spool_budget.limit - 4)
+        finally:
+            spool_budget.used = used
+
+
+class TestBatchedUploads(unittest.TestCase):
+    def setUp(self):
+        from unittest.mock import patch
+
+        async def iter_attachment(attachment):
+            yield b"x" * attachment.size
+
+        patcher = patch("chat_exporter.construct.attachment_handler.iter_attachment", iter_attachment)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_pack_uploads(self):
+        from chat_exporter.construct.attachment_handler import pack_uploads
+
+        self.assertEqual(pack_uploads([6, 5, 4, 3, 2], 10), [[0, 2], [1, 3, 4]])
+        self.assertEqual(pack_uploads([1] * 12, 100), [list(range(10)), [10, 11]])
+        self.assertEqual(pack_uploads([20, 1], 10), [[0], [1]])
+
+    def test_channel_handler_maps_uploads_back(self):
+        from unittest.mock import AsyncMock
+
+        sent = []
+
+        async def send(files):
+            sent.append([(f.filename, f.fp) for f in files])
+            message = MagicMock()
+            message.attachments = [MagicMock(url=f"https://cdn.discordapp.com/{f.filename}") for f in files]
+            return message
+
+        channel = MagicMock()
+        channel.guild.filesize_limit = 10
+        channel.send = AsyncMock(side_effect=send)
+        handler = chat_exporter.AttachmentToDiscordChannelHandler(channel)
+        attachments = [_make_attachment(f"{i}.png", size) for i, size in enumerate([6, 5, 4, 3, 2])]
+
+        results = _run(handler.process_assets(attachments))
+
+        self.assertEqual([r.url for r in results], [f"https://cdn.discordapp.com/{i}.png" for i in range(5)])
+        names = [[name for name, _ in files] for files in sent]
+        self.assertEqual(names, [["0.png", "2.png"], ["1.png", "3.png", "4.png"]])
+        self.assertTrue(all(fp.closed for files in sent for _, fp in files))
+
+    def test_missing_uploads_raise(self):
+        from unittest.mock import AsyncMock
+
+        channel = MagicMock()
+        channel.guild.filesize_limit = 10
+        # Discord dropped one of the two files
+        channel.send = AsyncMock(return_value=MagicMock(attachments=[MagicMock()]))
+        handler = chat_exporter.AttachmentToDiscordChannelHandler(channel)
+
+        with self.assertRaises(ValueError):
+            _run(handler.process_assets([_make_attachment("0.png", 1), _make_attachment("1.png", 1)]))
+        self.assertEqual(channel.send.call_count, 1)
+
+    def test_queue_hands_over_batches(self):
+        class BatchRecorder(chat_exporter.AttachmentHandler):
+            batch_size = 4
+
+            def __init__(self):
+                self.batches = []
+
+            async def process_assets(self, attachments):
+                self.batches.append([a.filename for a in attachments])
+                return attachments
+
+        guild = _make_guild()
+        messages = []
+        for i in range(3):
+            msg = _make_message(f"message {i}", msg_id=i + 1, guild=guild)
+            msg.attachments = [_make_attachment(f"{i}-{j}.txt", 1) for j in range(3)]
+            msg.attachments[0].content_type = "text/plain"
+            messages.append(msg)
+        handler = BatchRecorder()
+        _run(chat_exporter.raw_export(_make_channel(guild), messages, attachment_handler=handler))
+
+        # The queue holds no more than a batch ahead of rendering, each batch keeps transcript order
+        self.assertEqual(len(handler.batches[0]), 4)
+        self.assertTrue(all(len(batch) <= 4 for batch in handler.batches))
+        names = [name for batch in handler.batches for name in batch]
+        self.assertEqual(names, [f"{i}-{j}.txt" for i in (2, 1, 0) for j in range(3)])
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def _failing(self, errors, result="done"):
+        calls = []
+
+        async def call():
+            calls.append(asyncio.get_event_loop().time())
+            if len(calls) <= len(errors):
+                raise errors[len(calls) - 1]
+            return result
+
+        return call, calls
+
+    def _rate_limited(self, retry_after):
+        import aiohttp
+
+        return aiohttp.ClientResponseError(
+            MagicMock(), (), status=429, headers={"Retry-After": str(retry_after)}
+        )
+
+    def test_retries_until_success(self):
+        import aiohttp
+
+        call, calls = self._failing([aiohttp.ClientConnectionError(), self._rate_limited(0.01)])
+        policy = chat_exporter.RetryPolicy(retries=3, base_delay=0.001)
+        self.assertEqual(_run(policy.run(call)), "done")
+        self.assertEqual(len(calls), 3)
+        # The second retry waited as long as the server asked
+        self.assertGreaterEqual(calls[2] - calls[1], 0.01)
+
+    def test_gives_up(self):
+        import aiohttp
+
+        call, calls = self._failing([aiohttp.ClientConnectionError()] * 5)
+        with self.assertRaises(aiohttp.ClientConnectionError):
+            _run(chat_exporter.RetryPolicy(retries=2, base_delay=0.001).run(call))
+        self.assertEqual(len(calls), 3)
+
+        call, calls = self._failing([ValueError()])
+        with self.assertRaises(ValueError):
+            _run(chat_exporter.RetryPolicy(base_delay=0.001).run(call))
+        self.assertEqual(len(calls), 1)
+
+    def test_bucket_rate(self):
+        call, calls = self._failing([])
+        policy = chat_exporter.RetryPolicy(rate=2, per=0.05)
+
+        async def burst():
+            await asyncio.gather(*(policy.run(call, bucket="channel") for _ in range(4)))
+            await policy.run(call, bucket="other")
+
+        _run(burst())
+        # Two went through at once, the other two waited for the bucket to refill
+        self.assertGreaterEqual(calls[3] - calls[0], 0.045)
+        self.assertLess(calls[1] - calls[0], 0.02)
+
+
+class TestConcurrentExports(unittest.TestCase):
+    def _export(self, name, bot):
+        guild = _make_guild(guild_id=hash(name) % 10**18)
+        messages = []
+        for i in range(3):
+            msg = _make_message(f"ping <@42> {i}", msg_id=i + 1, guild=guild)
+            menu = MagicMock(spec=discord.SelectMenu)
+            menu.placeholder = f"{name} menu"
+            menu.options = []
+            menu.disabled = False
+            msg.components = [menu]
+            messages.append(msg)
+        return chat_exporter.raw_export(_make_channel(guild), messages, bot=bot, concurrency=3)
+
+    def test_exports_do_not_share_state(self):
+        bots = {}
+        for name in ("alpha", "beta"):
+            bots[name] = MagicMock()
+            bots[name].get_user.return_value = _make_author(f"{name}-user", 42)
+
+        async def both():
+            return await asyncio.gather(*(self._export(name, bot) for name, bot in bots.items()))
+
+        for name, html in zip(bots, _run(both())):
+            self.assertIn(f"@{name}-user", html)
+            # Every export numbers its own menus from 0
+            self.assertEqual(re.findall(r'id="dropdownButton(\d+)"', html), ["0", "1", "2"])
+
+
+    def test_menu_ids_follow_the_transcript(self):
+        guild = _make_guild()
+        messages = []
+        delays = {}
+        for i in range(3):
+            msg = _make_message(f"message {i}", msg_id=i + 1, guild=guild)
+            menu = MagicMock(spec=discord.SelectMenu)
+            menu.placeholder = f"menu {i}"
+            menu.options = []
+            menu.disabled = False
+            msg.components = [menu]
+            # Earlier messages wait longer on their attachment, so they finish last
+            msg.attachments = [_make_attachment(f"{i}.txt")]
+            delays[f"{i}.txt"] = (3 - i) / 100
+            messages.append(msg)
+        handler = TestAttachmentQueue._SlowHandler(delays)
+
+        html = _run(
+            chat_exporter.raw_export(
+                _make_channel(guild),
+                messages[::-1],
+                attachment_handler=handler,
+                attachment_concurrency=3,
+                concurrency=3,
+            )
+        )
+
+        self.assertEqual(re.findall(r'id="dropdownButton(\d+)"', html), ["0", "1", "2"])
+
+class TestBatchExport(unittest.TestCase):
+    def _channel(self, name, channel_id, guild, delay=0.0):
+        channel = _make_channel(guild)
+        channel.name = name
+        channel.id = channel_id
+        messages = [_make_message(f"{name} message {i}", msg_id=channel_id + i, guild=guild) for i in range(2)]
+
+        async def history(**kwargs):
+            await asyncio.sleep(delay)
+            for message in reversed(messages):
+                yield message
+
+        channel.history = history
+        return channel
+
+    def test_yields_channels_as_they_finish(self):
+        guild = _make_guild()
+        channels = [
+            self._channel("slow", 1000, guild, delay=0.05),
+            self._channel("fast", 2000, guild),
+            self._channel("forbidden", 3000, guild),
+        ]
+
+        def forbidden(**kwargs):
+            raise discord.Forbidden(MagicMock(status=403), "Missing Access")
+
+        channels[2].history = forbidden
+        guild.text_channels = channels
+        cache = chat_exporter.LRUCache()
+
+        async def collect():
+            return [item async for item in chat_exporter.batch_export(guild, cache=cache, channel_concurrency=2)]
+
+        results = _run(collect())
+
+        self.assertEqual([channel.name for channel, _ in results], ["fast", "forbidden", "slow"])
+        transcripts = {channel.name: html for channel, html in results}
+        self.assertIn("fast message 1", transcripts["fast"])
+        self.assertIn("slow message 0", transcripts["slow"])
+        self.assertIsNone(transcripts["forbidden"])
+        # Both channels looked their shared author up through the one cache
+        self.assertGreater(cache.info().hits, 0)
+
+    def test_stopping_early_waits_for_cancelled_exports(self):
+        guild = _make_guild()
+        cancelled = []
+        slow = self._channel("slow", 1000, guild)
+
+        async def history(**kwargs):
+            from chat_exporter.ext.http_session import http_session
+
+            async with http_session() as session:
+                try:
+                    await asyncio.sleep(10)
+                except asyncio.CancelledError:
+                    # Cleaning up takes a moment, the session must still be open for it
+                    await asyncio.sleep(0.01)
+                    cancelled.append(session.closed)
+                    raise
+            yield
+
+        slow.history = history
+
+        async def first():
+            exports = chat_exporter.batch_export([slow, self._channel("fast", 2000, guild)])
+            item = await exports.__anext__()
+            await exports.aclose()
+            return item
+
+        self.assertEqual(_run(first())[0].name, "fast")
+        # The export still running was cancelled and waited for before the session closed
+        self.assertEqual(cancelled, [False])
+
+
+class TestRenderExecutor(unittest.TestCase):
+    def _export(self, executor=None):
+        guild = _make_guild()
+        guild.get_member.side_effect = lambda user_id: _make_author("pinged", user_id) if user_id == 42 else None
+        contents = ["**bold** <@42>", "__under__ <@7> :smile:", "plain text", "> quote with `code`"]
+        messages = [_make_message(content, msg_id=i + 1, guild=guild) for i, content in enumerate(contents)]
+        html = _run(chat_exporter.raw_export(_make_channel(guild), messages, render_executor=executor))
+        return re.findall(r'<span class="chatlog__markdown-preserve">(.*?)</span>\n', html, re.DOTALL)
+
+    def test_process_pool_renders_the_same_content(self):
+        from concurrent.futures import ProcessPoolExecutor
+
+        expected = self._export()
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            rendered = self._export(executor)
+
+        self.assertEqual(len(rendered), 4)
+        self.assertEqual(rendered, expected)
+        self.assertTrue(any("@pinged" in content for content in rendered))
+
+    def test_windows_are_cut_between_groups(self):
+        from chat_exporter.construct.message_record import MessageRecord
+        from chat_exporter.parse.render_pool import group_slices
+
+        created_at = datetime(2024, 1, 1, tzinfo=pytz.utc)
+        records = [
+            MessageRecord(i, discord.MessageType.default, author, created_at) for i, author in enumerate("aaabbc")
+        ]
+        self.assertEqual(group_slices(records, 2), [slice(0, 3), slice(3, 5), slice(5, 6)])
+        # One long group is cut anyway
+        self.assertEqual(group_slices(records[:3], 1), [slice(0, 2), slice(2, 3)])
+
+    def test_markdown_is_held_a_window_at_a_time(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from unittest.mock import patch
+
+        from chat_exporter.parse import render_pool
+
+        held = []
+        ready = render_pool.MarkdownPrerenderer.ready
+
+        async def recording_ready(prerenderer, index):
+            await ready(prerenderer, index)
+            held.append(len(prerenderer.markdown))
+
+        guild = _make_guild()
+        messages = [_make_message(f"**message {i}**", msg_id=i + 1, guild=guild) for i in range(12)]
+        expected = _run(chat_exporter.raw_export(_make_channel(guild), messages))
+        with patch.object(render_pool, "CHUNK_SIZE", 1), patch.object(render_pool, "WINDOW_SIZE", 2):
+            with patch.object(render_pool.MarkdownPrerenderer, "ready", recording_ready):
+                with ThreadPoolExecutor(max_workers=2) as executor:
+                    html = _run(chat_exporter.raw_export(_make_channel(guild), messages, render_executor=executor))
+
+        self.assertEqual(len(held), 12)
+        # The window being built and the one after it
+        self.assertLessEqual(max(held), 4)
+        bold = re.findall(r"<strong>message \d+</strong>", html)
+        self.assertEqual(len(bold), 12)
+        self.assertEqual(bold, re.findall(r"<strong>message \d+</strong>", expected))
+
+
+    def test_embed_markdown_is_prerendered(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from unittest.mock import patch
+
+        from chat_exporter.parse import render_pool
+
+        sent = []
+        render_contents = render_pool.render_contents
+
+        def recording_render_contents(contents, mentions):
+            sent.extend(contents)
+            return render_contents(contents, mentions)
+
+        guild = _make_guild()
+        msg = _make_message("see below", guild=guild)
+        msg.embeds = [
+            _make_embed(title="**Build** <passed>", description="took __3m__", fields=[{"name": "n", "value": "*v*"}])
+        ]
+        expected = _run(chat_exporter.raw_export(_make_channel(guild), [msg]))
+        with patch.object(render_pool, "render_contents", recording_render_contents):
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                html = _run(chat_exporter.raw_export(_make_channel(guild), [msg], render_executor=executor))
+
+        # Plain text is left to the loop
+        self.assertEqual(sorted(sent), sorted(["**Build** &lt;passed&gt;", "took __3m__", "*v*"]))
+        self.assertEqual(_strip_generated_time(html), _strip_generated_time(expected))
+
+class TestMessageRecords(unittest.TestCase):
+    def test_exports_leave_messages_unchanged(self):
+        """Rendering reads records of the messages, so the same messages can be exported again."""
+        guild = _make_guild()
+        channel = _make_channel(guild=guild)
+        target = _make_message("original message", msg_id=1, guild=guild)
+        reply = _make_message("reply message", msg_id=2, guild=guild)
+        reference = MagicMock(spec=["message_id", "channel_id"])
+        reference.message_id = target.id
+        reference.channel_id = channel.id
+        reply.reference = reference
+        messages = [reply, target]
+
+        html = _run(chat_exporter.raw_export(channel, messages, guild=guild))
+
+        self.assertIn("chatlog__reference", html)
+        self.assertIs(reply.reference, reference)
+        self.assertEqual(reply.content, "reply message")
+        self.assertEqual(messages, [reply, target])
+        # Exporting them again renders the reply the same way
+        self.assertIn("chatlog__reference", _run(chat_exporter.raw_export(channel, messages, guild=guild)))
+
+    def test_rendered_from_the_record_alone(self):
+        """Everything rendered is copied in to the record, the message can be dropped once it is taken."""
+        from chat_exporter.construct.message import MessageConstruct
+        from chat_exporter.construct.message_record import message_record
+
+        guild = _make_guild()
+        msg = _make_message("hello there", guild=guild, author=_make_author("alice", 7))
+        msg.attachments = [_make_attachment("notes.txt")]
+        reaction = MagicMock()
+        reaction.emoji = "👍"
+        reaction.count = 2
+        msg.reactions = [reaction]
+        record = message_record(msg)
+
+        # A message whose fields are gone by the time it is rendered
+        for attr in ("author", "attachments", "embeds", "reactions", "components", "stickers", "content"):
+            setattr(msg, attr, None)
+        construct = MessageConstruct(record, None, "UTC", False, guild, {}, {}, None)
+        html, meta_data = _run(construct.construct_message())
+
+        self.assertFalse(hasattr(construct, "message"))
+        self.assertIn("hello there", html)
+        self.assertIn("notes.txt", html)
+        self.assertIn('<span class="chatlog__reaction-count">2</span>', html.replace("\n", ""))
+        self.assertEqual(meta_data[7][4], 1)
+
+    def test_handler_gets_library_attachments(self):
+        guild = _make_guild()
+        msg = _make_message("with a file", guild=guild)
+        msg.attachments = [_make_attachment("notes.txt", attachment_id=4660)]
+        received = []
+
+        class Handler(chat_exporter.AttachmentHandler):
+            async def process_asset(self, attachment):
+                received.append(attachment)
+                attachment.url = attachment.proxy_url = "https://example.com/notes.txt"
+                return attachment
+
+        html = _run(chat_exporter.raw_export(_make_channel(guild), [msg], attachment_handler=Handler()))
+
+        self.assertIsInstance(received[0], discord.Attachment)
+        self.assertEqual((received[0].id, received[0].filename), (4660, "notes.txt"))
+        self.assertIn("https://example.com/notes.txt", html)